@@ -1,11 +1,16 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Dict, Optional, Tuple, Iterator
+from typing import Dict, Optional, Iterator, List, Tuple
 
 import tiktoken
 from PySide6.QtCore import QTranslator
 
 from backend.agents.base_agent import BaseAgent, BaseTrigger, BaseResult
 from backend.models import Error
+from backend.tools.llm_cache import llm_cache, LLMCache, CachedReply
+from backend.tools.llm_client import llm_client
 from backend.tools.utils import logger
 from setting.setting_reader import setting
 
@@ -21,8 +26,12 @@ MODEL_INFO = {
         "unit_price_output": 0.0002,  # for 1000 tokens
         "extra_tokens_per_message": 3,  # openai add 3 extra tokens to every message to format it
         "extra_tokens_for_reply": 3,  # every reply is primed with <|start|>assistant<|message|>, hence the 3 here
+        "context_window": 4096,  # maximum tokens of messages and the reply
     }
 }
+# default of the setting MAX_INPUT_TOKENS. Older messages of a conversation are left out to stay under it.
+DEFAULT_MAX_INPUT_TOKENS = 3000
+MIN_REPLY_TOKENS = 512  # tokens of the context window that are always left for the reply
 
 DEFAULT_PROMPTS = {
     "REVISE_FOR_SEARCH": "Revise the following text in its own language to create an effective Google search query. "
@@ -31,6 +40,151 @@ DEFAULT_PROMPTS = {
 }
 
 
+class MessageTokenCache:
+    """Least recently used token counts of messages, so messages of a conversation, which are sent again with every
+    new message, are tokenized once.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._entries: OrderedDict[Tuple, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name: "Model", message: Dict[str, str]) -> Tuple:
+        return model_name, tuple(sorted(message.items()))
+
+    def get(self, key: Tuple) -> Optional[int]:
+        with self._lock:
+            num_tokens = self._entries.get(key)
+            if num_tokens is not None:
+                self._entries.move_to_end(key)
+            return num_tokens
+
+    def put(self, key: Tuple, num_tokens: int):
+        with self._lock:
+            self._entries[key] = num_tokens
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+message_token_cache = MessageTokenCache()
+
+
+class TokenCounter:
+    """Count tokens of a chat request and of its reply while the reply is streamed.
+    The messages of the request are counted once, and every delta of the reply is counted once when it arrives,
+    so the usage, and hence the cost of LLMResult, is available at any moment without tokenizing the reply again.
+    Deltas of a streamed reply are single tokens in practice, so the sum of their counts is the count of the reply.
+
+    see https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    for how tokens of messages are counted.
+    """
+
+    def __init__(self, model_name: Model):
+        self.model_name = model_name
+        self.encoding = tiktoken.encoding_for_model(model_name)
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._reply_parts: List[str] = []  # joined only when the reply is read
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        """tokens of a message, including the tokens that format it"""
+        cache_key = message_token_cache.make_key(self.model_name, message)
+        num_tokens = message_token_cache.get(cache_key)
+        if num_tokens is None:
+            num_tokens = MODEL_INFO[self.model_name].get("extra_tokens_per_message", 0)
+            for key, value in message.items():
+                num_tokens += self.count_tokens(value)
+                if key == "name":
+                    num_tokens += 1
+            message_token_cache.put(cache_key, num_tokens)
+        return num_tokens
+
+    def add_messages(self, messages: List[Dict[str, str]]) -> int:
+        """count messages sent to the model, returning their number of tokens"""
+        num_tokens = sum(self.count_message(message) for message in messages)
+        num_tokens += MODEL_INFO[self.model_name].get("extra_tokens_for_reply", 0)
+        self.input_tokens += num_tokens
+        return num_tokens
+
+    def add_delta(self, delta: str) -> int:
+        """count a delta of the reply, returning its number of tokens"""
+        if not delta:
+            return 0
+        num_tokens = self.count_tokens(delta)
+        self.output_tokens += num_tokens
+        self._reply_parts.append(delta)
+        return num_tokens
+
+    @property
+    def reply(self) -> str:
+        return "".join(self._reply_parts)
+
+
+@dataclass
+class Context:
+    messages: List[Dict[str, str]]  # messages to send, from the oldest to the newest
+    input_tokens: int  # tokens of messages, including the tokens that prime the reply
+    saved_tokens: int = 0  # tokens of messages that are left out
+    dropped_messages: List[Dict[str, str]] = field(default_factory=list)
+
+
+class ContextBuilder:
+    """Fit the history of a conversation and a new message into a budget of input tokens.
+    System messages and the new message are always kept. Other messages are left out a turn at a time from the oldest,
+    where a turn is a user message and the replies to it, so no reply is sent without its question.
+
+    The budget is the smaller of max_input_tokens and the context window of the model minus MIN_REPLY_TOKENS.
+    Messages are counted with TokenCounter, whose counts are cached, so building the context of a long conversation
+    again for every new message tokenizes only the new message.
+    """
+
+    def __init__(self, model_name: Model, max_input_tokens: Optional[int] = None):
+        self.model_name = model_name
+        self.token_counter = TokenCounter(model_name=model_name)
+        if max_input_tokens is None:
+            max_input_tokens = setting.get("MAX_INPUT_TOKENS", DEFAULT_MAX_INPUT_TOKENS)
+        self.max_input_tokens = min(max_input_tokens, MODEL_INFO[model_name]["context_window"] - MIN_REPLY_TOKENS)
+
+    @staticmethod
+    def split_turns(messages: List[Dict[str, str]]) -> List[List[int]]:
+        """indexes of messages that are not system messages, grouped into turns"""
+        turns = []
+        for index, message in enumerate(messages):
+            if message["role"] == "system":
+                continue
+            if message["role"] == "user" or not turns:
+                turns.append([])
+            turns[-1].append(index)
+        return turns
+
+    def build(self, history: List[Dict[str, str]], message: Dict[str, str]) -> Context:
+        counts = [self.token_counter.count_message(m) for m in history]
+        input_tokens = (
+            sum(counts)
+            + self.token_counter.count_message(message)
+            + MODEL_INFO[self.model_name].get("extra_tokens_for_reply", 0)
+        )
+        dropped_indexes = set()
+        saved_tokens = 0
+        for turn in self.split_turns(history):
+            if input_tokens - saved_tokens <= self.max_input_tokens:
+                break
+            dropped_indexes.update(turn)
+            saved_tokens += sum(counts[index] for index in turn)
+        return Context(
+            messages=[m for index, m in enumerate(history) if index not in dropped_indexes] + [message],
+            input_tokens=input_tokens - saved_tokens,
+            saved_tokens=saved_tokens,
+            dropped_messages=[m for index, m in enumerate(history) if index in dropped_indexes],
+        )
+
+
 class LLMTrigger(BaseTrigger):
     def __init__(
             self,
@@ -39,13 +193,26 @@ class LLMTrigger(BaseTrigger):
             model_name=Model.GPT_3_5_TURBO,
             conversation_id: str = "",
             temperature: float = 0.5,
+            prompt_name: str = "",
+            use_cache: bool = False,
     ):
         super().__init__(content=content)  # input to model
         self.model_name = model_name
         self.stream = stream
         self.conversation_id = conversation_id
-        self.history = []  # history of conversation
+        # earlier messages of the conversation, e.g. [{"role": "user", "content": "..."}], from the oldest to the newest
+        self.history = []
         self.temperature = temperature
+        self.prompt_name = prompt_name  # key of DEFAULT_PROMPTS that content is made from
+        self.use_cache = use_cache  # whether the reply is read from and written to llm_cache
+
+    @property
+    def messages(self) -> List[Dict[str, str]]:
+        return self.history + [{"role": "user", "content": self.content}]
+
+    @property
+    def cache_key(self) -> str:
+        return LLMCache.make_key(self.model_name, self.messages, self.temperature, self.prompt_name)
 
     def to_dict(self):
         return {
@@ -56,6 +223,8 @@ class LLMTrigger(BaseTrigger):
             "conversation_id": self.conversation_id,
             "temperature": self.temperature,
             "history": self.history,
+            "prompt_name": self.prompt_name,
+            "use_cache": self.use_cache,
         }
 
 
@@ -71,9 +240,13 @@ class LLMResult(BaseResult):
         super().__init__(trigger=trigger, content=content, success=success, error=error, error_message=error_message)
         self.input_token_usage = 0
         self.output_token_usage = 0
+        self.saved_token_usage = 0  # input tokens of older messages that are left out of the request, see Context
+        self.is_cached = False  # the reply is read from llm_cache, which costs nothing
 
     @property
     def cost(self) -> float:
+        if self.is_cached:
+            return 0
         return (
                 self.input_token_usage / 1000 * MODEL_INFO[self.trigger.model_name]["unit_price_input"]
                 + self.output_token_usage / 1000 * MODEL_INFO[self.trigger.model_name]["unit_price_output"]
@@ -88,13 +261,13 @@ class LLMResult(BaseResult):
             "error_message": self.error_message,
             "input_token_usage": self.input_token_usage,
             "output_token_usage": self.output_token_usage,
+            "saved_token_usage": self.saved_token_usage,
             "cost": self.cost,
+            "is_cached": self.is_cached,
         }
 
 
 class LLMAgent(BaseAgent):
-    import openai
-
     TRIGGER_CLASS = LLMTrigger
     RESULT_CLASS = LLMResult
 
@@ -105,51 +278,95 @@ class LLMAgent(BaseAgent):
             prompt = DEFAULT_PROMPTS[trigger_attrs["prompt_name"]] + "\n" + trigger_attrs["user_input"]
         else:
             prompt = trigger_attrs["user_input"]
-        trigger = self.TRIGGER_CLASS(content=prompt, stream=trigger_attrs.get("stream", True))
-        return trigger, self.RESULT_CLASS(trigger=trigger)
+        trigger = self.TRIGGER_CLASS(
+            content=prompt,
+            stream=trigger_attrs.get("stream", True),
+            conversation_id=trigger_attrs.get("conversation_id", ""),
+            prompt_name=trigger_attrs.get("prompt_name", ""),
+            # replies to default prompts are worth caching, since they are requested again with the same input
+            use_cache=trigger_attrs.get("use_cache", bool(trigger_attrs.get("prompt_name"))),
+        )
+        result = self.RESULT_CLASS(trigger=trigger)
+        context = ContextBuilder(model_name=trigger.model_name).build(
+            history=trigger_attrs.get("history", []), message={"role": "user", "content": trigger.content}
+        )
+        trigger.history = context.messages[:-1]
+        result.saved_token_usage = context.saved_tokens
+        if context.saved_tokens:
+            logger.debug(f"{len(context.dropped_messages)} older messages ({context.saved_tokens} tokens) are left out")
+        return trigger, result
 
     def do(self, trigger: LLMTrigger, result: LLMResult):
-        self.openai.api_key = setting.get("OPENAI_API_KEY")
-        self.openai.proxy = setting.get("PROXY")
+        cached_reply = llm_cache.get(trigger.cache_key) if trigger.use_cache else None
+        if cached_reply is not None:
+            result.set(
+                content=cached_reply.content,
+                input_token_usage=cached_reply.input_token_usage,
+                output_token_usage=cached_reply.output_token_usage,
+                is_cached=True,
+            )
+            return self.replay(result=result) if trigger.stream else result
         if trigger.stream:
             return self.stream_chat(trigger=trigger, result=result)
         else:
             return self.chat(trigger=trigger, result=result)
 
+    @staticmethod
+    def replay(result: LLMResult) -> Iterator[str | LLMResult]:
+        """yield a cached reply like stream_chat does, as a single chunk followed by the result"""
+        yield result.content
+        yield result
+
+    @staticmethod
+    def _save_to_cache(trigger: LLMTrigger, result: LLMResult):
+        if trigger.use_cache and result.success and result.content:
+            llm_cache.set(
+                trigger.cache_key,
+                CachedReply(
+                    content=result.content,
+                    input_token_usage=result.input_token_usage,
+                    output_token_usage=result.output_token_usage,
+                ),
+            )
+
     def stream_chat(self, trigger: LLMTrigger, result: LLMResult, cutoff_value=6) -> Iterator[str | LLMResult]:
-        token_encoding = tiktoken.encoding_for_model(trigger.model_name)
-        complete_message = ""
-        collected_message = ""
+        """Yield the reply so far whenever at least cutoff_value tokens have arrived since the last yield,
+        and finally the result. Token usages of the result are kept up to date while the reply is streamed.
+        """
+        messages = trigger.messages
+        token_counter = TokenCounter(model_name=trigger.model_name)
+        result.input_token_usage = token_counter.add_messages(messages)
+        unflushed_tokens = 0  # tokens that have arrived since the last yield
+        is_stopped = False
         try:
-            res = self.openai.ChatCompletion.create(
+            res = llm_client.stream_chat_completion(
+                api_key=setting.get("OPENAI_API_KEY"),
+                proxy=setting.get("PROXY"),
                 model=trigger.model_name,
-                messages=trigger.history + [{"role": "user", "content": trigger.content}],
+                messages=messages,
                 temperature=trigger.temperature,
-                stream=trigger.stream,
             )
             for chunk in res:
-                collected_message += chunk["choices"][0]["delta"].get("content", "")  # extract the message
-                if len(token_encoding.encode(collected_message)) >= cutoff_value:
-                    complete_message += collected_message
-                    collected_message = ""
-                    value = yield complete_message
+                # extract the message
+                unflushed_tokens += token_counter.add_delta(chunk["choices"][0]["delta"].get("content", ""))
+                result.output_token_usage = token_counter.output_tokens
+                if unflushed_tokens >= cutoff_value:
+                    unflushed_tokens = 0
+                    value = yield token_counter.reply
                     if value == "STOP":
                         res.close()
+                        is_stopped = True
                         break
-            if collected_message:
-                complete_message += collected_message
+            complete_message = token_counter.reply
+            if unflushed_tokens:
                 yield complete_message
-            input_token_usage, output_token_usage = self._calculate_token_usages(
-                encoding=token_encoding,
-                model_name=trigger.model_name,
-                history_messages=trigger.history + [{"role": "user", "content": trigger.content}],
-                reply_message=complete_message,
-            )
             result.set(
                 content=complete_message,
-                input_token_usage=input_token_usage,
-                output_token_usage=output_token_usage,
+                input_token_usage=token_counter.input_tokens,
+                output_token_usage=token_counter.output_tokens,
             )
+            if not is_stopped:  # a stopped reply is incomplete
+                self._save_to_cache(trigger=trigger, result=result)
             logger.debug(f"Stream chat completed with message: {complete_message}")
         except Exception as e:
             result.set(success=False, error=Error.API_CONNECTION,
@@ -158,48 +375,30 @@ class LLMAgent(BaseAgent):
         yield result
 
     def chat(self, trigger: LLMTrigger, result: LLMResult):
-        token_encoding = tiktoken.encoding_for_model(trigger.model_name)
+        messages = trigger.messages
+        token_counter = TokenCounter(model_name=trigger.model_name)
+        token_counter.add_messages(messages)
         try:
-            res = self.openai.ChatCompletion.create(
+            res = llm_client.chat_completion(
+                api_key=setting.get("OPENAI_API_KEY"),
+                proxy=setting.get("PROXY"),
                 model=trigger.model_name,
-                messages=trigger.history + [{"role": "user", "content": trigger.content}],
+                messages=messages,
                 temperature=trigger.temperature,
-                stream=trigger.stream,
             )
             message = res["choices"][0].message.content
-            input_token_usage, output_token_usage = self._calculate_token_usages(
-                encoding=token_encoding,
-                model_name=trigger.model_name,
-                history_messages=trigger.history + [{"role": "user", "content": trigger.content}],
-                reply_message=message,
-            )
+            token_counter.add_delta(message)
             result.set(
                 content=message,
-                input_token_usage=input_token_usage,
-                output_token_usage=output_token_usage,
+                input_token_usage=token_counter.input_tokens,
+                output_token_usage=token_counter.output_tokens,
             )
+            self._save_to_cache(trigger=trigger, result=result)
         except Exception as e:
             result.set(success=False, error=Error.API_CONNECTION,
                        error_message=QTranslator.tr("Connection to API failed."))
         return result
 
-    @staticmethod
-    def _calculate_token_usages(encoding, model_name, history_messages, reply_message) -> Tuple[int, int]:
-        """see https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-        for reference
-        """
-        extra_tokens_per_message = MODEL_INFO[model_name].get("extra_tokens_per_message", 0)
-        input_num_tokens = 0
-        for message in history_messages:
-            input_num_tokens += extra_tokens_per_message
-            for key, value in message.items():
-                input_num_tokens += len(encoding.encode(value))
-                if key == "name":
-                    input_num_tokens += 1
-        input_num_tokens += MODEL_INFO[model_name].get("extra_tokens_for_reply", 0)
-        output_num_tokens = len(encoding.encode(reply_message))
-        return input_num_tokens, output_num_tokens
-
 
 if __name__ == "__main__":
     agent = LLMAgent()
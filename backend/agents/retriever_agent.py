@@ -1,21 +1,44 @@
-from typing import List, Optional
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import List, Optional, Callable, Tuple, Dict, Set, Iterator
 
 from backend.agents.base_agent import BaseAgent, BaseResult, BaseTrigger
-from backend.models import Match
-from backend.tools.database import db_manager
+from backend.models import Match, Error
+from backend.tools.database import db_manager, Prompt, ChatMessage
+from backend.tools.prompt_index import prompt_index
+from backend.tools.semantic_index import semantic_index
+from backend.tools.utils import logger
 from frontend.commands import command_manager
+from setting.setting_reader import setting
+
+# default of the setting SEARCH_SOURCE_DEADLINE. Sources slower than this are dropped from search results.
+DEFAULT_SOURCE_DEADLINE_MS = 300
 
 
 class RetrieverTrigger(BaseTrigger):
-    def __init__(self, content=None, sources: Optional[List[str]] = None):
+    def __init__(
+            self,
+            content=None,
+            sources: Optional[List[str]] = None,
+            is_cancelled: Optional[Callable[[], bool]] = None,
+            stream: bool = False,
+    ):
         """
         :param sources: limit the search to these sources
+        :param is_cancelled: checked while waiting for sources. If it returns True, the search is abandoned.
+        :param stream: yield matches of each source as soon as it finishes, see RetrieverAgent.stream_search
         """
         super().__init__(content=content)
         self.sources = sources if sources else []
+        self.is_cancelled = is_cancelled if is_cancelled else lambda: False
+        self.stream = stream
 
     def to_dict(self):
-        return {"content": self.content, "sources": self.sources}
+        return {"content": self.content, "sources": self.sources, "stream": self.stream}
 
 
 class RetrieverResult(BaseResult):
@@ -39,17 +62,381 @@ class RetrieverResult(BaseResult):
         }
 
 
+class RefinementCache:
+    """Matches of recently searched strings of every source.
+    While the user is typing, a search string usually extends the previous one, e.g. "expla" -> "explai",
+    so its matches are a subset of the matches of the previous search string and can be filtered from them in memory.
+    When the user deletes characters, matches of the shorter search string are returned directly.
+    """
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size  # maximum number of (source, search string) entries
+        self._entries: OrderedDict[Tuple[str, str], List[Match]] = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by every write to prompts, so that matches searched before the write are not cached after it
+        self.generation = 0
+
+    def get(self, source: str, search_str: str) -> Optional[List[Match]]:
+        with self._lock:
+            matches = self._entries.get((source, search_str))
+            if matches is None:
+                return None
+            self._entries.move_to_end((source, search_str))
+            return list(matches)
+
+    def get_longest_prefix(self, source: str, search_str: str) -> Optional[Tuple[str, List[Match]]]:
+        """get the longest cached search string that search_str starts with, and its matches"""
+        with self._lock:
+            for end in range(len(search_str) - 1, 0, -1):
+                matches = self._entries.get((source, search_str[:end]))
+                if matches is not None:
+                    return search_str[:end], list(matches)
+            return None
+
+    def put(self, source: str, search_str: str, matches: List[Match], generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[(source, search_str)] = list(matches)
+            self._entries.move_to_end((source, search_str))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+@dataclass
+class QueryCacheEntry:
+    matches: List[Match]
+    size: int  # estimated bytes
+    generation: int  # QueryCache.generation when the search started
+    # whether any source searched prompts or chat messages, i.e. the entry is invalidated by writes to them
+    depends_on_writes: bool
+
+
+class QueryCache:
+    """Least recently used results of RetrieverAgent.search, e.g. of "translate" typed every time the window opens.
+    Keys are lowercased search strings with sources, because every source ignores cases.
+    Entries that searched prompts or chat messages are invalid once the generation is bumped by a write to them.
+    They are dropped lazily when looked up or evicted, so that bulk writes only bump the counter.
+    """
+
+    MATCH_OVERHEAD = 200  # rough bytes of a Match and its containers, excluding the texts of matched fields
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Tuple[str, Tuple[str, ...]], QueryCacheEntry] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def get_key(search_str: str, sources: List[str]) -> Tuple[str, Tuple[str, ...]]:
+        return search_str.lower(), tuple(sources)
+
+    @classmethod
+    def estimate_size(cls, matches: List[Match]) -> int:
+        return sum(
+            cls.MATCH_OVERHEAD + sum(len(str(value)) for value in match.match_fields_values.values())
+            for match in matches
+        )
+
+    def _is_valid(self, entry: QueryCacheEntry) -> bool:
+        return not entry.depends_on_writes or entry.generation == self.generation
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key).size
+
+    def get(self, search_str: str, sources: List[str]) -> Optional[List[Match]]:
+        key = self.get_key(search_str, sources)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._is_valid(entry):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return list(entry.matches)
+
+    def put(self, search_str: str, sources: List[str], matches: List[Match], generation: int, depends_on_writes: bool):
+        """generation is the value of self.generation when the search started,
+        so that results searched before a write are not cached after it"""
+        entry = QueryCacheEntry(
+            matches=list(matches),
+            size=self.estimate_size(matches),
+            generation=generation,
+            depends_on_writes=depends_on_writes,
+        )
+        if entry.size > self.max_bytes:
+            return
+        key = self.get_key(search_str, sources)
+        with self._lock:
+            if not self._is_valid(entry):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            if len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                # invalid entries go first, then the least recently used ones
+                for stale_key in [k for k, e in self._entries.items() if not self._is_valid(e)]:
+                    self._remove(stale_key)
+                while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+                    self.evictions += 1
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """counters for diagnostics"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "generation": self.generation,
+            }
+
+
+@dataclass
+class RetrieverSource:
+    """a source that RetrieverAgent searches, e.g. prompts in memory, commands or chat messages"""
+
+    name: str
+    search: Callable[[str], List[Match]]  # takes a search string and returns a list of matches
+    # narrows down matches of a prefix of a search string to matches of the search string.
+    # It returns None if it cannot do so. Sources without one are searched again for every search string.
+    refine: Optional[Callable[[List[Match], str], Optional[List[Match]]]] = None
+    # whether the source searches prompts or chat messages, whose matches are invalidated by writes to them
+    depends_on_writes: bool = False
+    # seconds a search of the source may take. If None, the setting SEARCH_SOURCE_DEADLINE (in milliseconds) is used.
+    deadline: Optional[float] = None
+
+    def get_deadline(self) -> float:
+        if self.deadline is not None:
+            return self.deadline
+        return setting.get("SEARCH_SOURCE_DEADLINE", DEFAULT_SOURCE_DEADLINE_MS) / 1000
+
+
 class RetrieverAgent(BaseAgent):
-    """retrieve data from database, memory, hard disk, or other sources"""
+    """Retrieve data from database, memory, hard disk, or other sources.
+    Sources are searched concurrently on a thread pool, so the slowest source no longer adds to the others.
+    A source that misses its deadline or fails is dropped from the result of that search, rather than holding back
+    the matches of the other sources.
+    """
 
     TRIGGER_CLASS = RetrieverTrigger
     RESULT_CLASS = RetrieverResult
 
+    # key is source name. Sources are added by register_source.
+    SOURCES: Dict[str, RetrieverSource] = {}
+    # sources searched when no sources are given, in the order their matches are merged
+    DEFAULT_SOURCES: List[str] = []
+    MAX_WORKERS = 8  # threads of the pool that searches sources
+    CANCELLATION_CHECK_INTERVAL = 0.02  # seconds between checks of whether a search is cancelled
+
+    def __init__(self):
+        self.refinement_cache = RefinementCache()
+        self.query_cache = QueryCache()
+        self.executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix="retriever")
+        Prompt.add_write_listener(self._handle_write)
+        ChatMessage.add_write_listener(self._handle_write)
+
+    @classmethod
+    def register_source(cls, source: RetrieverSource, is_default: bool = True):
+        """add a source, or replace the source of the same name. Default sources are merged in registration order."""
+        cls.SOURCES[source.name] = source
+        if is_default and source.name not in cls.DEFAULT_SOURCES:
+            cls.DEFAULT_SOURCES.append(source.name)
+
+    def close(self):
+        """stop listening to writes and shut down the thread pool. The agent cannot search after it is closed."""
+        Prompt.remove_write_listener(self._handle_write)
+        ChatMessage.remove_write_listener(self._handle_write)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _handle_write(self, action: str, instance: Prompt | ChatMessage):
+        self.refinement_cache.clear()
+        self.query_cache.invalidate()
+
     def do(self, trigger, result):
-        result.set(content=self.search(search_str=trigger.content))
+        if trigger.stream:
+            return self.stream_search(trigger=trigger, result=result)
+        matches = self.search(search_str=trigger.content, sources=trigger.sources, is_cancelled=trigger.is_cancelled)
+        if trigger.is_cancelled():
+            return result.set(content=[], success=False, error=Error.CANCELLED)
+        result.set(content=matches)
         return result
 
-    def search(self, search_str):
-        db_matches = db_manager.search_by_string(search_str=search_str)
-        command_matches = command_manager.search(search_str=search_str)
-        return db_matches + command_matches
+    def stream_search(
+            self, trigger: RetrieverTrigger, result: RetrieverResult
+    ) -> Iterator[List[Match] | RetrieverResult]:
+        """Like search, but yield a batch of new matches whenever a source finishes, fastest sources first,
+        so that they can be displayed before slower sources finish. Matches already yielded by another source are
+        left out of later batches. The last item is the result with all matches.
+        A result from the query cache is yielded as a single batch.
+        """
+        search_str = trigger.content
+        sources = trigger.sources if trigger.sources else self.DEFAULT_SOURCES
+        matches = self.query_cache.get(search_str, sources)
+        if matches is not None:
+            yield matches
+            yield result.set(content=matches)
+            return
+        generation = self.query_cache.generation
+
+        matches_of_sources = {}
+        found_ids: Set[Tuple[str, uuid.UUID]] = set()
+        for source, source_matches in self.iterate_sources(search_str, sources, is_cancelled=trigger.is_cancelled):
+            matches_of_sources[source] = source_matches
+            batch = self._remove_found_matches(source_matches, found_ids)
+            if batch:
+                yield batch
+        if trigger.is_cancelled():
+            yield result.set(content=[], success=False, error=Error.CANCELLED)
+            return
+        yield result.set(content=self._merge_and_cache(search_str, sources, matches_of_sources, generation))
+
+    def search(
+            self,
+            search_str,
+            sources: Optional[List[str]] = None,
+            is_cancelled: Optional[Callable[[], bool]] = None,
+    ) -> List[Match]:
+        sources = sources if sources else self.DEFAULT_SOURCES
+        matches = self.query_cache.get(search_str, sources)
+        if matches is not None:
+            return matches
+        generation = self.query_cache.generation
+
+        matches_of_sources = self.search_sources(search_str, sources, is_cancelled=is_cancelled)
+        return self._merge_and_cache(search_str, sources, matches_of_sources, generation)
+
+    @staticmethod
+    def _remove_found_matches(matches: List[Match], found_ids: Set[Tuple[str, uuid.UUID]]) -> List[Match]:
+        """the same prompt or chat message may be found by more than one source. Only its first match is kept."""
+        new_matches = []
+        for match in matches:
+            if match.category in ("prompt", "chat_message"):
+                if (match.category, match.data.id) in found_ids:
+                    continue
+                found_ids.add((match.category, match.data.id))
+            new_matches.append(match)
+        return new_matches
+
+    def _merge_and_cache(
+            self, search_str: str, sources: List[str], matches_of_sources: Dict[str, List[Match]], generation: int
+    ) -> List[Match]:
+        """merge matches of sources in the order of sources"""
+        found_ids: Set[Tuple[str, uuid.UUID]] = set()
+        matches = []
+        for source in sources:
+            matches.extend(self._remove_found_matches(matches_of_sources.get(source, []), found_ids))
+        if len(matches_of_sources) == len(sources):
+            # results without dropped sources are complete, and only they are cached
+            self.query_cache.put(
+                search_str,
+                sources,
+                matches,
+                generation=generation,
+                depends_on_writes=any(self.SOURCES[source].depends_on_writes for source in sources),
+            )
+        return matches
+
+    def search_sources(
+            self, search_str: str, sources: List[str], is_cancelled: Optional[Callable[[], bool]] = None
+    ) -> Dict[str, List[Match]]:
+        """matches of the sources that finish in time, see iterate_sources"""
+        return dict(self.iterate_sources(search_str, sources, is_cancelled=is_cancelled))
+
+    def iterate_sources(
+            self, search_str: str, sources: List[str], is_cancelled: Optional[Callable[[], bool]] = None
+    ) -> Iterator[Tuple[str, List[Match]]]:
+        """Search sources concurrently and wait for each of them until its deadline, counted from now.
+        Yields (source, matches) of each source in the order the sources finish. Late and failed sources are left out.
+        A late search keeps running in its thread, and its matches still fill the refinement cache for the next search.
+        If the search is cancelled, no more sources are yielded.
+        """
+        start = time.perf_counter()
+        futures = {self.executor.submit(self.search_source, search_str, source): source for source in sources}
+        deadlines = {future: start + self.SOURCES[source].get_deadline() for future, source in futures.items()}
+        pending = set(futures)
+        try:
+            while pending and not (is_cancelled and is_cancelled()):
+                now = time.perf_counter()
+                for future in [future for future in pending if deadlines[future] <= now]:
+                    pending.remove(future)
+                    logger.debug(f"Source {futures[future]} missed its deadline when searching {search_str}")
+                if not pending:
+                    break
+                timeout = min(min(deadlines[future] for future in pending) - now, self.CANCELLATION_CHECK_INTERVAL)
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        matches = future.result()
+                    except Exception as e:
+                        logger.error(f"Source {futures[future]} failed when searching {search_str}: {e}")
+                        continue
+                    yield futures[future], matches
+        finally:
+            for future in futures:
+                future.cancel()  # takes effect if the search has not started yet
+
+    def search_source(self, search_str: str, source: str) -> List[Match]:
+        retriever_source = self.SOURCES[source]
+        generation = self.refinement_cache.generation
+        matches = self.refinement_cache.get(source, search_str)
+        if matches is not None:
+            return matches
+        if retriever_source.refine is not None:
+            cached = self.refinement_cache.get_longest_prefix(source, search_str)
+            if cached is not None:
+                matches = retriever_source.refine(cached[1], search_str)
+        if matches is None:
+            matches = retriever_source.search(search_str)
+        if retriever_source.refine is not None:
+            self.refinement_cache.put(source, search_str, matches, generation=generation)
+        return matches
+
+
+# prompts are searched in the in-memory index by default, so searching prompts while typing never touches the disk
+RetrieverAgent.register_source(
+    RetrieverSource("memory", prompt_index.search_by_string, refine=Prompt.refine_matches, depends_on_writes=True)
+)
+# finds prompts that are worded differently from the search string. Prompts already found are skipped.
+RetrieverAgent.register_source(RetrieverSource("semantic", semantic_index.search_by_string, depends_on_writes=True))
+RetrieverAgent.register_source(RetrieverSource("command", command_manager.search))
+# chat messages are too many to be kept in memory
+RetrieverAgent.register_source(
+    RetrieverSource(
+        "chat",
+        lambda search_str: ChatMessage.search_by_string(search_str, use_fts=db_manager.fts_enabled, source="chat"),
+        depends_on_writes=True,
+    )
+)
+RetrieverAgent.register_source(
+    RetrieverSource(
+        "database", db_manager.search_by_string, refine=Prompt.refine_matches, depends_on_writes=True
+    ),
+    is_default=False,
+)
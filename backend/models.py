@@ -6,6 +6,7 @@ from typing import Any, List, Tuple, Dict
 class Error(str, Enum):
     UNKNOWN = "UNKNOWN"
     API_CONNECTION = "APIConnectionError"
+    CANCELLED = "Cancelled"
 
 
 @dataclass
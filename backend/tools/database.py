@@ -1,22 +1,125 @@
 import uuid
 from collections.abc import Sequence
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, List
+from pathlib import Path
+from typing import Optional, List, Callable, Type, Iterable, Tuple, Dict
 
 import peewee as pw
+from playhouse.migrate import SqliteMigrator, migrate
 from playhouse.shortcuts import model_to_dict
 
 from backend.models import Match
+from backend.tools.fuzzy_matcher import highlight_positions
 from backend.tools.string_template import StringTemplate
-from backend.tools.utils import get_subsequences, find_positions_of_subsequence
+from backend.tools.utils import get_subsequences, logger
 from setting.setting_reader import setting
 
+FTS_MIN_SEARCH_LENGTH = 3  # the trigram tokenizer of FTS5 cannot match strings shorter than 3 characters
+SEARCH_RESULT_LIMIT = 200  # maximum number of matches returned by a search
+IDENTIFIER_PLACEHOLDER = "\x1f"  # replaces identifiers in Prompt.searchable_content. It cannot be typed by users.
+SCHEMA_VERSION = 3  # current version of the database schema, stored in _Meta.version
+MIGRATION_BATCH_SIZE = 1000  # rows processed in each transaction of a migration
+# variables per IN (...) query, which stays under SQLite's default limit of 999 variables
+BULK_QUERY_BATCH_SIZE = 500
+CHAT_PAGE_SIZE = 30  # messages loaded at a time when a conversation is opened or scrolled up
+CONVERSATION_PAGE_SIZE = 50  # conversations loaded at a time into the list of conversations
+
+
+DB_PATH = setting.user_data_path / "data.db"
+READ_PRAGMAS = {
+    "cache_size": -16 * 1024,  # 16MB of page cache. Negative values are in KiB
+    "mmap_size": 256 * 1024 * 1024,  # read pages through memory mapping instead of read() calls
+    "temp_store": "memory",  # temporary tables and indices for sorting, e.g. ORDER BY, are kept in memory
+}
+WRITE_PRAGMAS = {
+    # readers read from the database file while a writer appends to the write-ahead log,
+    # so searches never wait for a prompt being saved
+    "journal_mode": "wal",
+    # with WAL, commits no longer fsync, only checkpoints do. A power loss may roll back the last commits,
+    # but never corrupts the database.
+    "synchronous": "normal",
+    **READ_PRAGMAS,
+}
+
+
+def create_db_connection(read_only: bool = False) -> pw.SqliteDatabase:
+    """peewee keeps a connection per thread, so the GUI thread and QThreads never share a connection.
+    Pragmas are applied to every new connection.
+
+    :param read_only: open the database in read-only mode, which is used for searching.
+    """
+    if read_only:
+        return pw.SqliteDatabase(_read_only_uri(DB_PATH), uri=True, pragmas=READ_PRAGMAS)
+    return pw.SqliteDatabase(DB_PATH, pragmas=WRITE_PRAGMAS)
+
+
+def _read_only_uri(path: Path) -> str:
+    return f"{path.resolve().as_uri()}?mode=ro"
 
-def create_db_connection():
-    return pw.SqliteDatabase(setting.root_path / "user_data/data.db")
+
+def open_database(path: Path):
+    """switch db and read_only_db to another database file, e.g. a temporary one for benchmarking.
+    Connections of the calling thread are closed. Tables are not created.
+    """
+    db.init(path)
+    read_only_db.init(_read_only_uri(Path(path)))
 
 
 db = create_db_connection()
+# The file must already exist when it is opened in read-only mode. It is only connected to on the first query,
+# i.e. after tables are created by DBManager.
+read_only_db = create_db_connection(read_only=True)
+
+
+def insert_rows(model: Type[pw.Model], fields: List[pw.Field], rows: Iterable[Sequence]):
+    """Insert rows of values of fields with one prepared statement and executemany.
+    Generating SQL for each row with peewee takes much longer than SQLite executing it when inserting many rows.
+    """
+    columns = ", ".join(f'"{field.column_name}"' for field in fields)
+    placeholders = ", ".join("?" for _ in fields)
+    sql = f'INSERT INTO "{model._meta.table_name}" ({columns}) VALUES ({placeholders})'
+    db.cursor().executemany(
+        sql, ([field.db_value(value) for field, value in zip(fields, row)] for row in rows)
+    )
+
+
+def update_rows(model: Type[pw.Model], fields: List[pw.Field], rows: Iterable[Sequence]):
+    """Update fields of rows with one prepared statement and executemany, like insert_rows.
+    Each row is the values of fields followed by the primary key.
+    """
+    assignments = ", ".join(f'"{field.column_name}" = ?' for field in fields)
+    primary_key = model._meta.primary_key
+    sql = f'UPDATE "{model._meta.table_name}" SET {assignments} WHERE "{primary_key.column_name}" = ?'
+    db.cursor().executemany(
+        sql, ([field.db_value(value) for field, value in zip(fields + [primary_key], row)] for row in rows)
+    )
+
+
+def select_page(
+        query: pw.ModelSelect, sort_field: pw.Field, before: Optional[pw.Model] = None, limit: int = 50
+) -> List[pw.Model]:
+    """Keyset pagination over a query of a single table, in descending order of (sort_field, rowid).
+    Returns at most `limit` rows that come right after `before`, which is the last row of the previous page,
+    or the first page if `before` is None. The rowid of a row is available as row.rowid_.
+
+    Unlike OFFSET, which reads and skips every row of the previous pages, the condition on (sort_field, rowid)
+    seeks an index on sort_field, so a page deep in the history costs as much as the first one.
+    Rowids, which are implicitly the last column of every index, break ties of sort_field.
+    """
+    rowid = pw.SQL("rowid")
+    if before is not None:
+        before_rowid = getattr(before, "rowid_", None)
+        if before_rowid is None:  # e.g. a row that is saved rather than selected
+            before_rowid = query.model.select(rowid).where(query.model._meta.primary_key == before.get_id()).scalar()
+        before_key = pw.Tuple(sort_field.db_value(getattr(before, sort_field.name)), before_rowid)
+        query = query.where(pw.Tuple(sort_field, rowid) < before_key)
+    return list(
+        query.select_extend(rowid.alias("rowid_"))
+        .order_by(sort_field.desc(), rowid.desc())
+        .limit(limit)
+        .bind(read_only_db)
+    )
 
 
 class ArrayField(pw.TextField):
@@ -28,6 +131,8 @@ class ArrayField(pw.TextField):
         super().__init__(**kwargs)
 
     def db_value(self, value):
+        if value is None:
+            return None
         if isinstance(value, Sequence) and not isinstance(value, str):
             value = self.seperator.join((str(x) for x in value))
         if not isinstance(value, str):
@@ -49,6 +154,100 @@ class ModelWithTags:
         return tags
 
 
+class ModelWithFTSIndex:
+    """A model with an FTS5 index over FTS_COLUMNS, kept in sync with the table of the model by triggers.
+    The index is named {table}_fts and linked to the table by rowid.
+    """
+
+    FTS_COLUMNS: List[str] = []
+
+    @classmethod
+    def create_fts_index(cls) -> bool:
+        """Create the FTS5 index and the triggers that keep it in sync with the table.
+        The trigram tokenizer is used so that languages without spaces between words (e.g. Chinese) can be searched.
+        The index is an external content table, i.e. it only stores the index and reads content from the table.
+
+        Returns False if the SQLite library does not support FTS5 or the trigram tokenizer (requires SQLite 3.34+).
+        """
+        table = cls._meta.table_name
+        fts_table = f"{table}_fts"
+        columns = ", ".join(cls.FTS_COLUMNS)
+        new_values = ", ".join(f"new.{column}" for column in cls.FTS_COLUMNS)
+        old_values = ", ".join(f"old.{column}" for column in cls.FTS_COLUMNS)
+        is_new_index = not db.table_exists(fts_table)
+        try:
+            with db.atomic():
+                db.execute_sql(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5("
+                    f"{columns}, content='{table}', content_rowid='rowid', tokenize='trigram')"
+                )
+                db.execute_sql(
+                    f"CREATE TRIGGER IF NOT EXISTS {fts_table}_after_insert AFTER INSERT ON {table} BEGIN "
+                    f"INSERT INTO {fts_table}(rowid, {columns}) VALUES (new.rowid, {new_values}); END"
+                )
+                db.execute_sql(
+                    f"CREATE TRIGGER IF NOT EXISTS {fts_table}_after_delete AFTER DELETE ON {table} BEGIN "
+                    f"INSERT INTO {fts_table}({fts_table}, rowid, {columns}) "
+                    f"VALUES ('delete', old.rowid, {old_values}); END"
+                )
+                db.execute_sql(
+                    f"CREATE TRIGGER IF NOT EXISTS {fts_table}_after_update AFTER UPDATE ON {table} BEGIN "
+                    f"INSERT INTO {fts_table}({fts_table}, rowid, {columns}) "
+                    f"VALUES ('delete', old.rowid, {old_values}); "
+                    f"INSERT INTO {fts_table}(rowid, {columns}) VALUES (new.rowid, {new_values}); END"
+                )
+                if is_new_index:
+                    # index rows that were saved before the index existed
+                    cls.rebuild_fts_index()
+        except pw.OperationalError as e:
+            logger.warning(f"FTS5 is unavailable for {table}, falling back to LIKE search: {e}")
+            return False
+        return True
+
+    @classmethod
+    def drop_fts_index(cls):
+        fts_table = f"{cls._meta.table_name}_fts"
+        for trigger in ["after_insert", "after_delete", "after_update"]:
+            db.execute_sql(f"DROP TRIGGER IF EXISTS {fts_table}_{trigger}")
+        db.execute_sql(f"DROP TABLE IF EXISTS {fts_table}")
+
+    @classmethod
+    def rebuild_fts_index(cls):
+        """Rebuild the FTS index from the table.
+        The index is linked to the table by rowid, so it must be rebuilt if rowids change (e.g. after VACUUM).
+        """
+        fts_table = f"{cls._meta.table_name}_fts"
+        db.execute_sql(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')")
+
+    @classmethod
+    def _fts_condition(cls, search_str: str, limit: Optional[int] = None) -> pw.SQL:
+        """Condition on rows whose FTS_COLUMNS contain search_str, using the FTS index.
+        If limit is given, only the `limit` matching rows with the largest rowids are included,
+        which FTS5 finds without reading every matching row.
+        """
+        fts_table = f"{cls._meta.table_name}_fts"
+        phrase = '"{}"'.format(search_str.replace('"', '""'))
+        if limit is None:
+            return pw.SQL(f"rowid IN (SELECT rowid FROM {fts_table} WHERE {fts_table} MATCH ?)", [phrase])
+        return pw.SQL(
+            f"rowid IN (SELECT rowid FROM {fts_table} WHERE {fts_table} MATCH ? ORDER BY rowid DESC LIMIT ?)",
+            [phrase, limit],
+        )
+
+    @classmethod
+    def _fts_select(cls, search_str: str, limit: int) -> pw.ModelRaw:
+        """the `limit` rows whose FTS_COLUMNS contain search_str, best ranked by bm25 first"""
+        table = cls._meta.table_name
+        fts_table = f"{table}_fts"
+        phrase = '"{}"'.format(search_str.replace('"', '""'))
+        return cls.raw(
+            f"SELECT {table}.* FROM {fts_table} JOIN {table} ON {table}.rowid = {fts_table}.rowid "
+            f"WHERE {fts_table} MATCH ? ORDER BY {fts_table}.rank LIMIT ?",
+            phrase,
+            limit,
+        )
+
+
 class _Meta(pw.Model):
     """model that stores info about the database schema"""
 
@@ -62,17 +261,25 @@ class _Meta(pw.Model):
         database = db
 
 
-class Prompt(pw.Model, ModelWithTags):
+class Prompt(pw.Model, ModelWithTags, ModelWithFTSIndex):
     """
     Note: when we update the content of a prompt instance and call prompt.save(),
-            the identifier_positions field is updated.
-        However, when we use Prompt.update(xxx).where(xxx).execute(), the identifier_positions field is not updated.
+            the identifier_positions and searchable_content fields are updated.
+        However, when we use Prompt.update(xxx).where(xxx).execute(), these fields are not updated.
+        Likewise, write listeners are only notified by prompt.save() and prompt.delete_instance().
+        To update many prompts at once, use Prompt.bulk_update(), which keeps these fields and tags consistent.
     """
 
+    _write_listeners: List[Callable[[str, "Prompt"], None]] = []
+    FTS_COLUMNS = ["searchable_content", "tags"]
+
     role = pw.TextField(choices=[("user", "user"), ("system", "system")], default="user")
     content = pw.TextField(index=True)
-    tags = ArrayField(index=True, null=True)  # semi-colon separated string in the database, but list in python
+    # semi-colon separated string in the database, but list in python.
+    # It is a denormalized copy of Tag/PromptTag, which should be used for looking up prompts by tags.
+    tags = ArrayField(null=True)
     identifier_positions = pw.TextField(null=True)  # start1,end1;start2,end2;...;startN,endN
+    searchable_content = pw.TextField(null=True)  # content with identifiers replaced by IDENTIFIER_PLACEHOLDER
 
     id = pw.UUIDField(primary_key=True, default=uuid.uuid4)
     created_at = pw.DateTimeField(default=datetime.now)
@@ -89,96 +296,658 @@ class Prompt(pw.Model, ModelWithTags):
     def content_template(self) -> StringTemplate:
         return StringTemplate(self.content)
 
+    @property
+    def tag_names(self) -> List[str]:
+        """tags without empty or duplicate names"""
+        return self.normalize_tag_names(self.tags)
+
+    @staticmethod
+    def normalize_tag_names(tags) -> List[str]:
+        """tags without empty or duplicate names. A string is split as it is stored, e.g. "a;b" into ["a", "b"].
+
+        >>> Prompt.normalize_tag_names("physics")
+        ['physics']
+        """
+        if not tags:
+            return []
+        tags = Prompt.tags.python_value(Prompt.tags.db_value(tags))
+        return list(dict.fromkeys(tag.strip() for tag in tags if tag.strip()))
+
+    @classmethod
+    def select_by_tag(cls, tag_name: str) -> pw.ModelSelect:
+        """select prompts that have exactly this tag"""
+        return cls.select().join(PromptTag).join(Tag).where(Tag.name == tag_name)
+
+    @classmethod
+    def add_write_listener(cls, listener: Callable[[str, "Prompt"], None]):
+        """listener is called with ("save" or "delete", prompt instance) after a prompt is saved or deleted"""
+        cls._write_listeners.append(listener)
+
+    @classmethod
+    def remove_write_listener(cls, listener: Callable[[str, "Prompt"], None]):
+        cls._write_listeners.remove(listener)
+
+    def _notify_write_listeners(self, action: str):
+        for listener in self._write_listeners:
+            listener(action, self)
+
     def save(self, **kwargs):
         self.identifier_positions = self.calculate_identifier_positions()
-        return super().save(**kwargs)
+        self.searchable_content = self.calculate_searchable_content()
+        with db.atomic():
+            rows = super().save(**kwargs)
+            PromptTag.set_tags(prompt=self, tag_names=self.tag_names)
+        self._notify_write_listeners("save")
+        return rows
 
-    @staticmethod
-    def _filter_out_matches_in_identifiers(matches: List["Prompt"], search_str: str) -> List["Prompt"]:
-        result = []
-        for match in matches:
-            if not match.identifier_positions:
-                result.append(match)
-                continue
-            for subcontent in get_subsequences(seq=match.content, exclude_indices=match.identifier_positions_list):
-                if search_str.lower() in subcontent.lower():
-                    result.append(match)
-                    break
-        return result
+    @classmethod
+    def bulk_insert(cls, prompts: List["Prompt"]) -> int:
+        """Insert new prompts in a single transaction, which is much faster than calling save() on each prompt.
+        Derived fields and tags are handled as in save(), and write listeners are notified of each prompt
+        after the transaction is committed.
+        """
+        if not prompts:
+            return 0
+        for prompt in prompts:
+            prompt.identifier_positions = prompt.calculate_identifier_positions()
+            prompt.searchable_content = prompt.calculate_searchable_content()
+        table = cls._meta.table_name
+        fts_table = f"{table}_fts"
+        fields = cls._meta.sorted_fields
+        with db.atomic():
+            # indexing all new rows with one statement is several times faster than the trigger indexing them one by one
+            fts_insert_trigger = f"{fts_table}_after_insert"
+            is_fts_indexed = db.execute_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?", (fts_insert_trigger,)
+            ).fetchone()
+            if is_fts_indexed:
+                db.execute_sql(f"DROP TRIGGER {fts_insert_trigger}")
+            max_rowid = db.execute_sql(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+
+            insert_rows(cls, fields, ([getattr(prompt, field.name) for field in fields] for prompt in prompts))
+            PromptTag.bulk_set_tags(prompts)
+
+            if is_fts_indexed:
+                fts_columns = ", ".join(cls.FTS_COLUMNS)
+                db.execute_sql(
+                    f"INSERT INTO {fts_table}(rowid, {fts_columns}) "
+                    f"SELECT rowid, {fts_columns} FROM {table} WHERE rowid > ?",
+                    (max_rowid,),
+                )
+                cls.create_fts_index()  # recreates the trigger
+        for prompt in prompts:
+            prompt._notify_write_listeners("save")
+        return len(prompts)
 
     @classmethod
-    def search_by_string(cls, search_str: str) -> List[Match]:
-        raw_content_matches: List["Prompt"] = list(cls.select().where(cls.content.contains(search_str)))
-        raw_content_matches = cls._filter_out_matches_in_identifiers(raw_content_matches, search_str)
-        raw_tag_matches: List["Prompt"] = list(cls.select().where(cls.tags.contains(search_str)))
-        matches = []
-        for raw_match in raw_content_matches:
-            is_also_tag_match = raw_match in raw_tag_matches
-            match_fields = ["content"] if not is_also_tag_match else ["content", "tags"]
-            if is_also_tag_match:
-                match_fields_values = {
-                    "content": raw_match.content,
-                    "tags": [tag for tag in raw_match.tags if search_str in tag],
+    def bulk_update(cls, model_list: List["Prompt"], fields: List, batch_size: int = BULK_QUERY_BATCH_SIZE) -> int:
+        """Write fields of prompts to the database in a single transaction, e.g. after editing or re-tagging prompts.
+        Unlike the bulk_update of peewee, derived fields and tags are kept consistent as in save(),
+        and write listeners are notified. Only prompts whose values differ from the database are written,
+        and derived fields are only recalculated for prompts whose content changed.
+
+        :param fields: fields or names of fields to write. Derived fields are ignored since they are calculated.
+        :return: number of prompts that changed
+        """
+        derived_fields = [cls.identifier_positions, cls.searchable_content]
+        # fields are compared by names, since == of peewee fields builds query expressions
+        ignored_field_names = {field.name for field in derived_fields + [cls._meta.primary_key]}
+        field_names = [field if isinstance(field, str) else field.name for field in fields]
+        fields = [cls._meta.fields[name] for name in dict.fromkeys(field_names) if name not in ignored_field_names]
+        if not fields:
+            return 0
+        changed_ids = []
+        with db.atomic():
+            for batch in pw.chunked(model_list, batch_size):
+                stored_values = {
+                    row[0]: row[1:]
+                    for row in cls.select(cls.id, *fields).where(cls.id.in_([p.id for p in batch])).tuples()
                 }
-            else:
-                match_fields_values = {"content": raw_match.content}
-            match = Match(
-                source="database",
-                match_fields=match_fields,
-                data=raw_match,
-                category="prompt",
-                match_fields_values=match_fields_values,
-                match_positions={"content": find_positions_of_subsequence(raw_match.content, search_str)},
-            )
-            matches.append(match)
-        for raw_match in raw_tag_matches:
-            if raw_match in raw_content_matches:
-                continue
-            match_fields = ["tags"]
-            match_fields_values = {"tags": [tag for tag in raw_match.tags if search_str in tag]}
-            match = Match(
+                content_changed_rows = []
+                other_changed_rows = []
+                retagged_prompts = []
+                for prompt in batch:
+                    if prompt.id not in stored_values:
+                        continue  # the prompt has been deleted
+                    values = [getattr(prompt, field.name) for field in fields]
+                    changed_field_names = {
+                        field.name
+                        for field, value, stored_value in zip(fields, values, stored_values[prompt.id])
+                        if field.db_value(value) != field.db_value(stored_value)
+                    }
+                    if not changed_field_names:
+                        continue
+                    changed_ids.append(prompt.id)
+                    if "content" in changed_field_names:
+                        prompt.identifier_positions = prompt.calculate_identifier_positions()
+                        prompt.searchable_content = prompt.calculate_searchable_content()
+                        content_changed_rows.append(
+                            values + [prompt.identifier_positions, prompt.searchable_content, prompt.id]
+                        )
+                    else:
+                        other_changed_rows.append(values + [prompt.id])
+                    if "tags" in changed_field_names:
+                        retagged_prompts.append(prompt)
+                update_rows(cls, fields + derived_fields, content_changed_rows)
+                update_rows(cls, fields, other_changed_rows)
+                if retagged_prompts:
+                    PromptTag.delete().where(PromptTag.prompt.in_([p.id for p in retagged_prompts])).execute()
+                    PromptTag.bulk_set_tags(retagged_prompts)
+        # prompts in model_list may only have some fields loaded, so listeners are given the stored prompts
+        for batch in pw.chunked(changed_ids, batch_size):
+            for prompt in cls.select().where(cls.id.in_(batch)):
+                prompt._notify_write_listeners("save")
+        return len(changed_ids)
+
+    def delete_instance(self, **kwargs):
+        with db.atomic():
+            PromptTag.set_tags(prompt=self, tag_names=[])
+            rows = super().delete_instance(**kwargs)
+        self._notify_write_listeners("delete")
+        return rows
+
+    @classmethod
+    def search_by_string(cls, search_str: str, use_fts: bool = False, limit: int = SEARCH_RESULT_LIMIT) -> List[Match]:
+        """Search content and tags in a single query.
+        Content is matched against searchable_content, so identifiers in the content are never matched.
+
+        :param use_fts: use the FTS index instead of LIKE scans. The `limit` best rows ranked by bm25 are returned,
+            and which fields match is worked out in Python for these rows only.
+            The trigram tokenizer cannot match strings shorter than 3 characters, so LIKE scans are used for them.
+            With LIKE scans, every row comes with flags telling which fields match.
+            Tags are matched against the Tag table and mapped to prompts through the index of PromptTag.
+            Only the `limit` best rows are returned, where a row is better if its matching text is shorter,
+            the same rule as in TextMatchesSorter.
+        """
+        # the FTS index has tags joined by their separator, which would match across tags
+        if use_fts and len(search_str) >= FTS_MIN_SEARCH_LENGTH and cls.tags.seperator not in search_str:
+            matches = [
+                prompt.to_match(search_str, source="database")
+                for prompt in cls._fts_select(search_str, limit).bind(read_only_db)
+            ]
+            return [match for match in matches if match]
+
+        is_content_match = cls.searchable_content.contains(search_str)
+        is_tag_match = cls.id.in_(
+            PromptTag.select(PromptTag.prompt).join(Tag).where(Tag.name.contains(search_str))
+        )
+        matched_text_length = pw.Case(
+            None,
+            [
+                (is_content_match & is_tag_match, pw.fn.MIN(pw.fn.LENGTH(cls.content), pw.fn.LENGTH(cls.tags))),
+                (is_content_match, pw.fn.LENGTH(cls.content)),
+            ],
+            pw.fn.LENGTH(cls.tags),
+        )
+        query = (
+            cls.select(cls, is_content_match.alias("is_content_match"), is_tag_match.alias("is_tag_match"))
+            .where(is_content_match | is_tag_match)
+            .order_by(matched_text_length.asc())
+            .limit(limit)
+            .bind(read_only_db)
+        )
+
+        matches = []
+        for prompt in query:
+            match = prompt.to_match(
+                search_str,
                 source="database",
-                match_fields=match_fields,
-                data=raw_match,
-                category="prompt",
-                match_fields_values=match_fields_values,
+                is_content_match=prompt.is_content_match,
+                is_tag_match=prompt.is_tag_match,
             )
-            matches.append(match)
+            if match:
+                matches.append(match)
         return matches
 
+    def to_match(self, search_str: str, source: str, is_content_match=None, is_tag_match=None) -> Optional[Match]:
+        """Turn the prompt into a match of search_str. Returns None if the prompt does not match search_str.
+        is_content_match and is_tag_match are worked out in Python if they are not already known, e.g. from a query.
+        """
+        lowered_search_str = search_str.lower()
+        if is_content_match is None:
+            is_content_match = lowered_search_str in (self.searchable_content or "").lower()
+        match_fields = []
+        match_fields_values = {}
+        match_positions = {}
+        if is_content_match:
+            match_fields.append("content")
+            match_fields_values["content"] = self.content
+            match_positions["content"] = highlight_positions(search_str, self.content)
+        if is_tag_match or is_tag_match is None:
+            matched_tags = [tag for tag in self.tag_names if lowered_search_str in tag.lower()]
+            if matched_tags:
+                match_fields.append("tags")
+                match_fields_values["tags"] = matched_tags
+        if not match_fields:
+            return None
+        return Match(
+            source=source,
+            category="prompt",
+            data=self,
+            match_fields=match_fields,
+            match_fields_values=match_fields_values,
+            match_positions=match_positions,
+        )
+
+    @staticmethod
+    def refine_matches(matches: List[Match], search_str: str) -> Optional[List[Match]]:
+        """Narrow down prompt matches of a prefix of search_str to matches of search_str without searching again.
+        Returns None if the matches may have been truncated by SEARCH_RESULT_LIMIT,
+        because some matches of search_str could then be missing from them.
+        """
+        if len(matches) >= SEARCH_RESULT_LIMIT:
+            return None
+        refined_matches = []
+        for match in matches:
+            refined_match = match.data.to_match(search_str, source=match.source)
+            if refined_match:
+                refined_matches.append(refined_match)
+        return refined_matches
+
     def calculate_identifier_positions(self) -> str:
         """Identifiers in the content should not be matched against the search query.
         Therefore, identifier positions, including ${}, are stored in the database and used to filter out.
 
         identifier_positions is a string of the form "start1,end1;start2,end2;...;startN,endN"
         """
+        if "${" not in self.content:
+            # skip parsing the template, since most prompts have no identifiers
+            return ""
         template = StringTemplate(self.content)
         if not template.is_template:
             return ""
         id_positions = template.get_identifiers_with_positions()
         return ";".join(f"{id_pos[1]},{id_pos[2]}" for id_pos in id_positions)
 
+    def calculate_searchable_content(self) -> str:
+        """content with identifiers, including ${}, replaced by IDENTIFIER_PLACEHOLDER.
+        Searching it rather than content keeps identifiers from being matched against the search query.
+        """
+        if not self.identifier_positions:
+            return self.content
+        return IDENTIFIER_PLACEHOLDER.join(
+            get_subsequences(seq=self.content, exclude_indices=self.identifier_positions_list)
+        )
+
     def to_dict(self):
         return model_to_dict(self)
 
 
-class ChatMessage(pw.Model):
-    ...
+class Tag(pw.Model):
+    name = pw.TextField(unique=True)
+
+    id = pw.UUIDField(primary_key=True, default=uuid.uuid4)
+    created_at = pw.DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = db
+
+    @classmethod
+    def list_names(cls) -> List[str]:
+        """names of all tags that are used by at least one prompt"""
+        query = cls.select(cls.name).where(pw.fn.EXISTS(PromptTag.select().where(PromptTag.tag == cls.id)))
+        return [name for (name,) in query.order_by(cls.name).tuples()]
+
+
+class PromptTag(pw.Model):
+    """many-to-many relation between Prompt and Tag"""
+
+    prompt = pw.ForeignKeyField(Prompt, backref="prompt_tags", on_delete="CASCADE")
+    tag = pw.ForeignKeyField(Tag, backref="prompt_tags", on_delete="CASCADE")
+
+    class Meta:
+        database = db
+        primary_key = pw.CompositeKey("prompt", "tag")
+
+    @classmethod
+    def set_tags(cls, prompt: Prompt, tag_names: List[str]):
+        """replace tags of the prompt with tag_names, creating tags that do not exist yet"""
+        current_tag_ids = {row.tag_id for row in cls.select(cls.tag).where(cls.prompt == prompt.id)}
+        tag_ids = set()
+        if tag_names:
+            Tag.insert_many([{"name": name} for name in tag_names]).on_conflict_ignore().execute()
+            tag_ids = {tag.id for tag in Tag.select(Tag.id).where(Tag.name.in_(tag_names))}
+        if current_tag_ids - tag_ids:
+            cls.delete().where((cls.prompt == prompt.id) & cls.tag.in_(current_tag_ids - tag_ids)).execute()
+        if tag_ids - current_tag_ids:
+            cls.insert_many([{"prompt": prompt.id, "tag": tag_id} for tag_id in tag_ids - current_tag_ids]).execute()
+
+    @classmethod
+    def bulk_set_tags(cls, prompts: List[Prompt]):
+        """add tags of prompts that have no tags in the database yet, e.g. prompts that are newly inserted"""
+        tag_names_of_prompts = [(prompt.id, prompt.tag_names) for prompt in prompts]
+        tag_names = list(dict.fromkeys(name for _, names in tag_names_of_prompts for name in names))
+        if not tag_names:
+            return
+        tag_ids = {}
+        for batch in pw.chunked(tag_names, BULK_QUERY_BATCH_SIZE):
+            Tag.insert_many([{"name": name} for name in batch]).on_conflict_ignore().execute()
+            tag_ids.update(Tag.select(Tag.name, Tag.id).where(Tag.name.in_(batch)).tuples())
+        insert_rows(
+            cls,
+            [cls.prompt, cls.tag],
+            ((prompt_id, tag_ids[name]) for prompt_id, names in tag_names_of_prompts for name in names),
+        )
+
+
+class Conversation(pw.Model):
+    title = pw.TextField(default="")
+
+    id = pw.UUIDField(primary_key=True, default=uuid.uuid4)
+    created_at = pw.DateTimeField(default=datetime.now)
+    updated_at = pw.DateTimeField(default=datetime.now, index=True)  # bumped by every new message
+
+    class Meta:
+        database = db
+
+    @classmethod
+    def select_page(
+            cls, before: Optional["Conversation"] = None, limit: int = CONVERSATION_PAGE_SIZE
+    ) -> List["Conversation"]:
+        """the most recently updated conversations after `before`, the last conversation of the previous page"""
+        return select_page(cls.select(), sort_field=cls.updated_at, before=before, limit=limit)
+
+
+class ChatMessage(pw.Model, ModelWithFTSIndex):
+    """A message of a conversation. Messages are only ever loaded a page at a time, see select_page."""
+
+    _write_listeners: List[Callable[[str, "ChatMessage"], None]] = []
+    FTS_COLUMNS = ["content"]
+
+    conversation = pw.ForeignKeyField(Conversation, backref="messages", on_delete="CASCADE")
+    role = pw.TextField(choices=[("user", "user"), ("assistant", "assistant"), ("system", "system")])
+    content = pw.TextField()
+
+    id = pw.UUIDField(primary_key=True, default=uuid.uuid4)
+    created_at = pw.DateTimeField(default=datetime.now)
+    updated_at = pw.DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = db
+        # pages of a conversation are read from this index, which also holds rowids that break ties of created_at
+        indexes = ((("conversation", "created_at"), False),)
+
+    @classmethod
+    def add_write_listener(cls, listener: Callable[[str, "ChatMessage"], None]):
+        """listener is called with ("save" or "delete", message instance) after a message is saved or deleted"""
+        cls._write_listeners.append(listener)
+
+    @classmethod
+    def remove_write_listener(cls, listener: Callable[[str, "ChatMessage"], None]):
+        cls._write_listeners.remove(listener)
+
+    def _notify_write_listeners(self, action: str):
+        for listener in self._write_listeners:
+            listener(action, self)
+
+    def save(self, **kwargs):
+        with db.atomic():
+            rows = super().save(**kwargs)
+            Conversation.update(updated_at=datetime.now()).where(Conversation.id == self.conversation_id).execute()
+        self._notify_write_listeners("save")
+        return rows
+
+    def delete_instance(self, **kwargs):
+        rows = super().delete_instance(**kwargs)
+        self._notify_write_listeners("delete")
+        return rows
+
+    @classmethod
+    def select_page(
+            cls, conversation_id, before: Optional["ChatMessage"] = None, limit: int = CHAT_PAGE_SIZE
+    ) -> List["ChatMessage"]:
+        """Messages of a conversation that are older than `before`, or the newest messages if `before` is None.
+        Messages are returned from the oldest to the newest, i.e. in the order they are displayed.
+        """
+        query = cls.select().where(cls.conversation == conversation_id)
+        messages = select_page(query, sort_field=cls.created_at, before=before, limit=limit)
+        messages.reverse()
+        return messages
+
+    @classmethod
+    def get_history(cls, conversation_id, limit: int = CHAT_PAGE_SIZE) -> List[Dict[str, str]]:
+        """the newest messages of a conversation in the format of messages of the OpenAI chat API"""
+        return [{"role": m.role, "content": m.content} for m in cls.select_page(conversation_id, limit=limit)]
+
+    @classmethod
+    def search_by_string(
+            cls, search_str: str, use_fts: bool = False, limit: int = SEARCH_RESULT_LIMIT, source: str = "database"
+    ) -> List[Match]:
+        """Messages whose content contains search_str, the newest first.
+        Messages are inserted in the order they are written, so the newest messages are those with the largest rowids.
+        Both the FTS index and the table are read backwards by rowid and reading stops after `limit` matches,
+        so a search string that matches most messages is as fast as one that matches a few.
+
+        :param use_fts: use the FTS index instead of LIKE scans.
+            The trigram tokenizer cannot match strings shorter than 3 characters, so LIKE scans are used for them.
+        :param source: source of the matches, e.g. "chat" when searched by the chat source of RetrieverAgent
+        """
+        if use_fts and len(search_str) >= FTS_MIN_SEARCH_LENGTH:
+            condition = cls._fts_condition(search_str, limit=limit)
+        else:
+            condition = cls.content.contains(search_str)
+        query = cls.select().where(condition).order_by(pw.SQL("rowid").desc()).limit(limit).bind(read_only_db)
+        return [match for match in (message.to_match(search_str, source=source) for message in query) if match]
+
+    def to_match(self, search_str: str, source: str, **kwargs) -> Optional[Match]:
+        """turn the message into a match of search_str, like Prompt.to_match"""
+        if search_str.lower() not in self.content.lower():
+            return None
+        return Match(
+            source=source,
+            category="chat_message",
+            data=self,
+            match_fields=["content"],
+            match_fields_values={"content": self.content},
+            match_positions={"content": highlight_positions(search_str, self.content)},
+        )
+
+
+class _MigrationProgress(pw.Model):
+    """progress of a running migration, so that it resumes where it stopped if ProPal is closed halfway"""
+
+    version = pw.IntegerField(primary_key=True)  # schema version the migration upgrades to
+    last_rowid = pw.IntegerField(default=0)  # rowid of the last row processed
+    done = pw.IntegerField(default=0)  # number of rows processed
+
+    updated_at = pw.DateTimeField(default=datetime.now)
+
+    class Meta:
+        database = db
+
+
+@dataclass
+class MigrationProgress:
+    version: int
+    description: str
+    done: int
+    total: int
+
+
+class Migration:
+    """A step that upgrades the schema to `version`.
+    Rows are processed in batches of rowids, each of which is committed in its own transaction together with
+    the progress, so the database is never locked for long and an interrupted migration resumes from the last batch.
+    """
+
+    version: int = 0
+    description: str = ""
+
+    def prepare(self):
+        """change the schema before rows are processed. It runs again when the migration resumes, so it must be
+        idempotent."""
+
+    def count(self) -> int:
+        """number of rows to process, which is only used for reporting progress"""
+        return 0
+
+    def migrate_batch(self, after_rowid: int, batch_size: int) -> Tuple[int, int]:
+        """process at most batch_size rows whose rowids are larger than after_rowid, in the order of rowid.
+        Returns the rowid of the last processed row and the number of processed rows, which is 0 if no rows are left.
+        """
+        return after_rowid, 0
+
+    def finish(self):
+        """change the schema after all rows are processed, e.g. create indexes over the backfilled columns"""
+
+    @staticmethod
+    def select_batch(query: pw.ModelSelect, after_rowid: int, batch_size: int) -> pw.ModelSelect:
+        """the batch of rows of a query over a single table. The rowid of a row is available as row.rowid_."""
+        return (
+            query.select_extend(pw.SQL("rowid").alias("rowid_"))
+            .where(pw.SQL("rowid > ?", [after_rowid]))
+            .order_by(pw.SQL("rowid"))
+            .limit(batch_size)
+        )
+
+
+class AddSearchableContentMigration(Migration):
+    version = 2
+    description = "add and backfill Prompt.searchable_content"
+
+    def prepare(self):
+        # the FTS index is recreated over searchable_content after migrations
+        Prompt.drop_fts_index()
+        table = Prompt._meta.table_name
+        if "searchable_content" not in {column.name for column in db.get_columns(table)}:
+            migrate(SqliteMigrator(db).add_column(table, "searchable_content", Prompt.searchable_content))
+
+    def count(self) -> int:
+        return Prompt.select().count()
+
+    def migrate_batch(self, after_rowid: int, batch_size: int) -> Tuple[int, int]:
+        prompts = list(self.select_batch(Prompt.select(Prompt.id, Prompt.content), after_rowid, batch_size))
+        for prompt in prompts:
+            prompt.identifier_positions = prompt.calculate_identifier_positions()
+            prompt.searchable_content = prompt.calculate_searchable_content()
+            Prompt.update(
+                identifier_positions=prompt.identifier_positions, searchable_content=prompt.searchable_content
+            ).where(Prompt.id == prompt.id).execute()
+        return (prompts[-1].rowid_ if prompts else after_rowid), len(prompts)
+
+
+class MoveTagsToTagTablesMigration(Migration):
+    version = 3
+    description = "move tags from the serialized Prompt.tags column into Tag and PromptTag"
+
+    def prepare(self):
+        db.execute_sql(f"DROP INDEX IF EXISTS {Prompt._meta.table_name}_tags")  # useless for substring search
+
+    def count(self) -> int:
+        return Prompt.select().where(Prompt.tags.is_null(False)).count()
+
+    def migrate_batch(self, after_rowid: int, batch_size: int) -> Tuple[int, int]:
+        query = Prompt.select(Prompt.id, Prompt.tags).where(Prompt.tags.is_null(False))
+        prompts = list(self.select_batch(query, after_rowid, batch_size))
+        for prompt in prompts:
+            PromptTag.set_tags(prompt=prompt, tag_names=prompt.tag_names)
+        return (prompts[-1].rowid_ if prompts else after_rowid), len(prompts)
+
+
+class MigrationRunner:
+    """Upgrade a database created by an older version of ProPal by running migrations newer than _Meta.version
+    in the order of their versions. _Meta.version is bumped after each migration is finished.
+    """
+
+    def __init__(
+            self,
+            migrations: List[Migration],
+            batch_size: int = MIGRATION_BATCH_SIZE,
+            progress_callback: Optional[Callable[[MigrationProgress], None]] = None,
+    ):
+        self.migrations = sorted(migrations, key=lambda m: m.version)
+        self.batch_size = batch_size
+        self.progress_callback = progress_callback or self.log_progress
+
+    @staticmethod
+    def log_progress(progress: MigrationProgress):
+        logger.info(
+            f"Migrating to version {progress.version} ({progress.description}): {progress.done}/{progress.total}"
+        )
+
+    def run(self, meta_info: _Meta):
+        for migration in self.migrations:
+            if migration.version > meta_info.version:
+                self.run_migration(migration, meta_info)
+
+    def run_migration(self, migration: Migration, meta_info: _Meta):
+        with db.atomic():
+            migration.prepare()
+            progress, _ = _MigrationProgress.get_or_create(version=migration.version)
+        total = migration.count()
+        self.progress_callback(MigrationProgress(migration.version, migration.description, progress.done, total))
+        while True:
+            with db.atomic():
+                last_rowid, processed = migration.migrate_batch(progress.last_rowid, self.batch_size)
+                if not processed:
+                    break
+                progress.last_rowid = last_rowid
+                progress.done += processed
+                progress.updated_at = datetime.now()
+                progress.save()
+            self.progress_callback(
+                MigrationProgress(migration.version, migration.description, progress.done, max(total, progress.done))
+            )
+        with db.atomic():
+            migration.finish()
+            progress.delete_instance()
+            meta_info.version = migration.version
+            meta_info.updated_at = datetime.now()
+            meta_info.save()
 
 
 class DBManager:
-    MODELS = {"prompt": Prompt, "_meta": _Meta}
+    MODELS = {
+        "prompt": Prompt,
+        "tag": Tag,
+        "prompt_tag": PromptTag,
+        "conversation": Conversation,
+        "chat_message": ChatMessage,
+        "_meta": _Meta,
+        "_migration_progress": _MigrationProgress,
+    }
+    # ordered by version. The version of the last migration must be SCHEMA_VERSION.
+    MIGRATIONS = [AddSearchableContentMigration(), MoveTagsToTagTablesMigration()]
 
     def __init__(self):
+        self.fts_enabled = False  # whether prompts and chat messages are searched with the FTS5 indexes
+        # whether the database was created by an older version of ProPal and waits for migrate()
+        self.is_migration_pending = False
+        self._migration_listeners: List[Callable[[], None]] = []
         self._create_tables()
 
     def _create_tables(self):
-        """only create tables once"""
+        """only create tables once. Migrations are left to migrate(), which may take long for a large database."""
         db.create_tables(self.MODELS.values())
 
         meta_info = _Meta.select().first()
         if not meta_info:
-            _Meta.create(version=1)
+            _Meta.create(version=SCHEMA_VERSION)
+        self.is_migration_pending = bool(meta_info) and meta_info.version < SCHEMA_VERSION
+        if self.is_migration_pending:
+            self.fts_enabled = False  # migrations may drop and recreate the FTS indexes
+        else:
+            self._create_fts_indexes()
+
+    def _create_fts_indexes(self):
+        # a list rather than a generator, so that every index is created
+        self.fts_enabled = all([Prompt.create_fts_index(), ChatMessage.create_fts_index()])
+
+    def add_migration_listener(self, listener: Callable[[], None]):
+        """listener is called after pending migrations are finished, in the thread that runs them.
+        Prompts cannot be read before that, since the table may lack columns of the current schema."""
+        self._migration_listeners.append(listener)
+
+    def migrate(self, progress_callback: Optional[Callable[[MigrationProgress], None]] = None):
+        """Run pending migrations. It is slow for a large database, so the GUI runs it in a worker thread
+        after the window is shown."""
+        if not self.is_migration_pending:
+            return
+        MigrationRunner(self.MIGRATIONS, progress_callback=progress_callback).run(_Meta.select().first())
+        self._create_fts_indexes()
+        self.is_migration_pending = False
+        for listener in self._migration_listeners:
+            listener()
 
     def search_by_string(self, search_str, in_models: Optional[List[str]] = None) -> List[Match]:
         if in_models is None:
@@ -188,9 +957,11 @@ class DBManager:
         for model_name, model_class in self.MODELS.items():
             if in_models and model_class not in in_models:
                 continue
-            if model_name in ["_meta"]:
+            if model_name in ["_meta", "_migration_progress", "tag", "prompt_tag", "conversation"]:
+                continue
+            if model_class is Prompt and self.is_migration_pending:
                 continue
-            result.extend(model_class.search_by_string(search_str))
+            result.extend(model_class.search_by_string(search_str, use_fts=self.fts_enabled))
         return result
 
 
@@ -0,0 +1,197 @@
+"""
+A fuzzy matcher similar to fzf (https://github.com/junegunn/fzf), i.e. the characters of a pattern must appear in
+the text in order, but not necessarily next to each other. For example, "anp" matches "Add New Prompt".
+
+Matching is done in three steps:
+1. a cheap prefilter on bitmasks of characters rules out texts that lack some characters of the pattern;
+2. the first occurrence of the pattern as a subsequence is located and then shrunk from its end backwards,
+    which favours compact matches;
+3. the match is scored. Every matched character earns points, gaps cost points,
+    and characters at word boundaries, right after the previous matched character, or at the start of the text
+    earn bonuses.
+"""
+from dataclasses import dataclass, field
+from typing import List, Tuple, Optional
+
+SCORE_MATCH = 16
+SCORE_GAP_START = -3
+SCORE_GAP_EXTENSION = -1
+BONUS_BOUNDARY = 8  # the character follows a non-word character, e.g. "-" or "."
+BONUS_BOUNDARY_WHITE = BONUS_BOUNDARY + 2  # the character follows a whitespace
+BONUS_BOUNDARY_DELIMITER = BONUS_BOUNDARY + 1  # the character follows a delimiter, e.g. "/" or ","
+BONUS_NON_WORD = 8  # the character itself is a non-word character
+BONUS_CAMEL = BONUS_BOUNDARY + SCORE_GAP_EXTENSION  # e.g. "P" in "AddNewPrompt" or "1" in "gpt3.5"
+BONUS_CONSECUTIVE = -(SCORE_GAP_START + SCORE_GAP_EXTENSION)  # the character follows the previous matched one
+BONUS_FIRST_CHAR_MULTIPLIER = 2  # bonus of the first character of the pattern counts double
+BONUS_PREFIX = 8  # the match starts at the beginning of the text
+
+CHAR_WHITE, CHAR_DELIMITER, CHAR_NON_WORD, CHAR_LOWER, CHAR_UPPER, CHAR_LETTER, CHAR_NUMBER = range(7)
+DELIMITERS = "/,:;|"
+
+
+@dataclass
+class FuzzyMatch:
+    score: int = 0
+    positions: List[Tuple[int, int]] = field(default_factory=list)  # ranges of matched characters, end exclusive
+
+
+def char_bitmask(text: str) -> int:
+    """A bitmask of the characters in text, ignoring cases.
+    Letters and digits have a bit each, other characters share the remaining bits.
+    If a pattern's bitmask is not a subset of a text's bitmask, the pattern cannot match the text.
+
+    >>> char_bitmask("ab") == char_bitmask("BA")
+    True
+    >>> char_bitmask("abc") & ~char_bitmask("a-b-c") == 0
+    True
+    """
+    mask = 0
+    for char in set(text.lower()):
+        if "a" <= char <= "z":
+            mask |= 1 << (ord(char) - ord("a"))
+        elif "0" <= char <= "9":
+            mask |= 1 << (ord(char) - ord("0") + 26)
+        else:
+            mask |= 1 << (ord(char) % 28 + 36)
+    return mask
+
+
+def _char_class(char: str) -> int:
+    if char.islower():
+        return CHAR_LOWER
+    if char.isupper():
+        return CHAR_UPPER
+    if char.isdigit():
+        return CHAR_NUMBER
+    if char.isalpha():
+        return CHAR_LETTER
+    if char.isspace():
+        return CHAR_WHITE
+    if char in DELIMITERS:
+        return CHAR_DELIMITER
+    return CHAR_NON_WORD
+
+
+def _bonus(previous_class: int, current_class: int) -> int:
+    """bonus of a matched character given the class of itself and of the character before it"""
+    if current_class > CHAR_NON_WORD:
+        if previous_class == CHAR_WHITE:
+            return BONUS_BOUNDARY_WHITE
+        if previous_class == CHAR_DELIMITER:
+            return BONUS_BOUNDARY_DELIMITER
+        if previous_class == CHAR_NON_WORD:
+            return BONUS_BOUNDARY
+    if (previous_class == CHAR_LOWER and current_class == CHAR_UPPER) or (
+            previous_class != CHAR_NUMBER and current_class == CHAR_NUMBER
+    ):
+        return BONUS_CAMEL
+    if current_class == CHAR_NON_WORD or current_class == CHAR_DELIMITER:
+        return BONUS_NON_WORD
+    if current_class == CHAR_WHITE:
+        return BONUS_BOUNDARY_WHITE
+    return 0
+
+
+def _to_ranges(indices: List[int]) -> List[Tuple[int, int]]:
+    """
+    >>> _to_ranges([0, 1, 2, 5, 7, 8])
+    [(0, 3), (5, 6), (7, 9)]
+    """
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][1] == index:
+            ranges[-1] = (ranges[-1][0], index + 1)
+        else:
+            ranges.append((index, index + 1))
+    return ranges
+
+
+def fuzzy_match(pattern: str, text: str, text_bitmask: Optional[int] = None) -> Optional[FuzzyMatch]:
+    """Match pattern against text, ignoring cases. Returns None if pattern is not a subsequence of text.
+
+    :param text_bitmask: char_bitmask(text). Pass it in if it is precomputed, e.g. for texts that are matched often.
+
+    >>> fuzzy_match("anp", "Add New Prompt").positions
+    [(0, 1), (4, 5), (8, 9)]
+    >>> fuzzy_match("ab", "a_xab").positions
+    [(3, 5)]
+    >>> fuzzy_match("xyz", "Add New Prompt") is None
+    True
+    >>> fuzzy_match("np", "Add New Prompt").score > fuzzy_match("np", "unpack").score
+    True
+    """
+    if not pattern:
+        return None
+    pattern = pattern.lower()
+    lowered_text = text.lower()
+    if len(lowered_text) != len(text):
+        # lowercasing changed the length, e.g. for some non-ASCII characters, so positions would not line up
+        lowered_text = "".join(char.lower()[0] for char in text)
+    if text_bitmask is None:
+        text_bitmask = char_bitmask(lowered_text)
+    if char_bitmask(pattern) & ~text_bitmask:
+        return None
+
+    # find the first occurrence of pattern as a subsequence
+    end = -1
+    for char in pattern:
+        end = lowered_text.find(char, end + 1)
+        if end == -1:
+            return None
+    # shrink the occurrence by matching backwards from its end
+    start = end + 1
+    for char in reversed(pattern):
+        start = lowered_text.rfind(char, 0, start)
+    # match forwards again from the new start
+    indices = []
+    index = start - 1
+    for char in pattern:
+        index = lowered_text.find(char, index + 1)
+        indices.append(index)
+
+    score = BONUS_PREFIX if indices[0] == 0 else 0
+    first_bonus = 0  # bonus of the first character of the current run of consecutive matched characters
+    for pattern_index, index in enumerate(indices):
+        previous_class = _char_class(text[index - 1]) if index > 0 else CHAR_WHITE
+        bonus = _bonus(previous_class, _char_class(text[index]))
+        is_consecutive = pattern_index > 0 and indices[pattern_index - 1] == index - 1
+        if is_consecutive:
+            if bonus >= BONUS_BOUNDARY and bonus > first_bonus:
+                first_bonus = bonus
+            bonus = max(bonus, first_bonus, BONUS_CONSECUTIVE)
+        else:
+            first_bonus = bonus
+            if pattern_index > 0:
+                gap = index - indices[pattern_index - 1] - 1
+                score += SCORE_GAP_START + SCORE_GAP_EXTENSION * (gap - 1)
+        score += SCORE_MATCH + (bonus * BONUS_FIRST_CHAR_MULTIPLIER if pattern_index == 0 else bonus)
+    return FuzzyMatch(score=score, positions=_to_ranges(indices))
+
+
+def highlight_positions(pattern: str, text: str) -> List[Tuple[int, int]]:
+    """Ranges of text to highlight for pattern, ignoring cases.
+    Prompts and chat messages are found by substring, so the first occurrence of pattern as a substring is highlighted
+    if there is one. Otherwise, e.g. for semantic matches, the characters matched by fuzzy_match are highlighted.
+
+    >>> highlight_positions("abc", "a-b-c abc")
+    [(6, 9)]
+    >>> highlight_positions("anp", "Add New Prompt")
+    [(0, 1), (4, 5), (8, 9)]
+    >>> highlight_positions("xyz", "Add New Prompt")
+    []
+    """
+    if not pattern:
+        return []
+    lowered_text = text.lower()
+    start = lowered_text.find(pattern.lower())
+    # positions in lowered_text are only those in text if lowercasing kept the length
+    if start != -1 and len(lowered_text) == len(text):
+        return [(start, start + len(pattern))]
+    fuzzy = fuzzy_match(pattern, text)
+    return fuzzy.positions if fuzzy else []
+
+
+if __name__ == "__main__":
+    import doctest
+
+    doctest.testmod()
@@ -0,0 +1,127 @@
+"""
+An on-disk cache of LLM replies, so requests that are made again, e.g. revising the same text for search, are answered
+without a round trip to the API or paying for tokens.
+
+Replies are stored in their own SQLite file in user_data/, which can be deleted at any time.
+A reply is keyed by a hash of the model, the messages, the temperature and the name of the prompt of the request.
+Replies that are not read for CACHE_TTL are expired, and the least recently read replies are evicted when the replies
+take more than CACHE_MAX_SIZE bytes.
+"""
+import hashlib
+import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict
+
+import peewee as pw
+
+from backend.tools.database import WRITE_PRAGMAS
+from backend.tools.utils import logger
+from setting.setting_reader import setting
+
+CACHE_PATH = setting.user_data_path / "llm_cache.db"
+CACHE_TTL = timedelta(days=30)
+CACHE_MAX_SIZE = 20 * 1024 * 1024  # bytes of cached replies
+
+cache_db = pw.SqliteDatabase(CACHE_PATH, pragmas=WRITE_PRAGMAS)
+
+
+@dataclass
+class CachedReply:
+    content: str
+    input_token_usage: int  # tokens of the request that was answered with this reply
+    output_token_usage: int
+
+
+class LLMCacheEntry(pw.Model):
+    key = pw.CharField(primary_key=True)
+    content = pw.TextField()
+    input_token_usage = pw.IntegerField(default=0)
+    output_token_usage = pw.IntegerField(default=0)
+    size = pw.IntegerField()  # bytes of content in UTF-8
+
+    created_at = pw.DateTimeField(default=datetime.now)
+    accessed_at = pw.DateTimeField(default=datetime.now, index=True)
+
+    class Meta:
+        database = cache_db
+        table_name = "llm_cache_entry"
+
+
+class LLMCache:
+    def __init__(self, ttl: timedelta = CACHE_TTL, max_size: int = CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._is_table_created = False
+
+    @staticmethod
+    def make_key(model_name: str, messages: List[Dict[str, str]], temperature: float, prompt_name: str = "") -> str:
+        """
+        >>> LLMCache.make_key("m", [{"role": "user", "content": "hi"}], 0.5) == LLMCache.make_key(
+        ...     "m", [{"content": "hi", "role": "user"}], 0.5)
+        True
+        """
+        request = json.dumps([model_name, messages, temperature, prompt_name], ensure_ascii=False, sort_keys=True)
+        return hashlib.blake2b(request.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _create_table(self):
+        if not self._is_table_created:
+            cache_db.create_tables([LLMCacheEntry])
+            self._is_table_created = True
+
+    def get(self, key: str) -> Optional[CachedReply]:
+        try:
+            self._create_table()
+            entry = LLMCacheEntry.get_or_none(LLMCacheEntry.key == key)
+            if entry is None:
+                return None
+            now = datetime.now()
+            if entry.accessed_at < now - self.ttl:
+                entry.delete_instance()
+                return None
+            LLMCacheEntry.update(accessed_at=now).where(LLMCacheEntry.key == key).execute()
+        except pw.PeeweeException as e:  # a broken cache only costs a request
+            logger.error(f"error when reading LLM cache: {e}")
+            return None
+        return CachedReply(
+            content=entry.content,
+            input_token_usage=entry.input_token_usage,
+            output_token_usage=entry.output_token_usage,
+        )
+
+    def set(self, key: str, reply: CachedReply):
+        try:
+            self._create_table()
+            with cache_db.atomic():
+                LLMCacheEntry.replace(
+                    key=key,
+                    content=reply.content,
+                    input_token_usage=reply.input_token_usage,
+                    output_token_usage=reply.output_token_usage,
+                    size=len(reply.content.encode("utf-8")),
+                ).execute()
+                self.evict()
+        except pw.PeeweeException as e:
+            logger.error(f"error when writing LLM cache: {e}")
+
+    def evict(self):
+        """delete expired replies, then the least recently read replies beyond max_size"""
+        LLMCacheEntry.delete().where(LLMCacheEntry.accessed_at < datetime.now() - self.ttl).execute()
+        cache_db.execute_sql(
+            f"""
+            DELETE FROM "{LLMCacheEntry._meta.table_name}" WHERE "key" IN (
+                SELECT "key" FROM (
+                    SELECT "key", SUM("size") OVER (ORDER BY "accessed_at" DESC, "key") AS "total_size"
+                    FROM "{LLMCacheEntry._meta.table_name}"
+                ) WHERE "total_size" > ?
+            )
+            """,
+            (self.max_size,),
+        )
+
+    def clear(self):
+        self._create_table()
+        LLMCacheEntry.delete().execute()
+
+
+llm_cache = LLMCache()
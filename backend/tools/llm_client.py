@@ -0,0 +1,145 @@
+"""
+An asyncio-based client of LLM APIs shared by all windows.
+
+Requests of every window run on one event loop in a daemon thread, and share one HTTP session whose connection pool
+keeps connections alive, so only the first request to an API pays for the TCP and TLS handshakes.
+Agents run in other threads, and consume streamed replies as ordinary iterators, see ChatCompletionStream.
+
+aiohttp, which the openai package uses for asynchronous requests, speaks HTTP/1.1 only. Connections are reused with
+keep-alive instead of being multiplexed with HTTP/2.
+"""
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Optional, Dict, Any, Iterator
+
+import aiohttp
+import openai
+
+from backend.tools.utils import logger
+
+POOL_SIZE = 10  # maximum number of open connections
+KEEPALIVE_TIMEOUT = 60  # seconds an idle connection is kept open
+DNS_CACHE_TTL = 300  # seconds
+CLOSE_TIMEOUT = 5  # seconds waited for the session to close
+
+
+class ChatCompletionStream:
+    """Chunks of a streamed chat completion, which are received on the event loop and iterated in another thread.
+    Errors of the request, e.g. openai.error.APIConnectionError, are raised when the next chunk is read.
+    """
+
+    _END = object()  # put into the queue after the last chunk
+
+    def __init__(self):
+        self._chunks = queue.Queue()
+        self._future: Optional[Future] = None
+        self._is_finished = False
+
+    async def receive(self, response_coroutine):
+        try:
+            response = await response_coroutine
+            async for chunk in response:
+                self._chunks.put(chunk)
+        except Exception as e:
+            self._chunks.put(e)
+        finally:
+            self._chunks.put(self._END)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return self
+
+    def __next__(self) -> Dict[str, Any]:
+        if self._is_finished:
+            raise StopIteration
+        chunk = self._chunks.get()
+        if chunk is self._END:
+            self._is_finished = True
+            raise StopIteration
+        if isinstance(chunk, Exception):
+            self._is_finished = True
+            raise chunk
+        return chunk
+
+    def close(self):
+        """stop receiving the reply. The connection is closed instead of returned to the pool."""
+        self._is_finished = True
+        if self._future is not None:
+            self._future.cancel()
+
+
+class LLMClient:
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """the event loop, which is started in its own thread when first used"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="LLMClientLoop", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """return the shared session. Called on the event loop."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=DNS_CACHE_TTL
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _create_chat_completion(self, api_key: str, proxy: Optional[str], **params):
+        # openai reads the session from a context variable. Every task has its own copy of the context.
+        openai.aiosession.set(self._get_session())
+        # openai passes openai.proxy as the proxy of every request. It is read before acreate first yields to the loop,
+        # and all requests are made on this thread, so it is set right before each of them.
+        openai.proxy = proxy
+        return await openai.ChatCompletion.acreate(api_key=api_key, **params)
+
+    def stream_chat_completion(self, api_key: str, proxy: Optional[str] = None, **params) -> ChatCompletionStream:
+        """start a streamed chat completion, whose chunks are iterated in the calling thread"""
+        stream = ChatCompletionStream()
+        stream._future = asyncio.run_coroutine_threadsafe(
+            stream.receive(self._create_chat_completion(api_key, proxy or None, stream=True, **params)), self.loop
+        )
+        return stream
+
+    def chat_completion(self, api_key: str, proxy: Optional[str] = None, **params) -> Dict[str, Any]:
+        """make a chat completion, blocking the calling thread until the reply is received"""
+        future = asyncio.run_coroutine_threadsafe(
+            self._create_chat_completion(api_key, proxy or None, stream=False, **params), self.loop
+        )
+        return future.result()
+
+    async def _shut_down(self):
+        # cancelled requests end their streams, so threads that iterate them are not blocked forever
+        requests = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in requests:
+            task.cancel()
+        await asyncio.gather(*requests, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def close(self):
+        """close pooled connections and stop the event loop, e.g. when the application quits"""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shut_down(), loop).result(timeout=CLOSE_TIMEOUT)
+        except Exception as e:
+            logger.error(f"error when closing the HTTP session of LLM client: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(timeout=CLOSE_TIMEOUT)
+
+
+llm_client = LLMClient()
@@ -0,0 +1,240 @@
+"""
+An in-memory index of all prompts so that searching prompts while typing never touches the disk.
+
+The index is built from the database when it is first searched and then kept up to date by listening to writes of
+Prompt. It is built again if another database is opened, e.g. a temporary one for testing or benchmarking.
+Prompts are stored column by column in parallel lists, where the i-th element of every list belongs to the same prompt.
+For searching, lowercased contents (with identifiers masked out) and tags are concatenated into one string per column,
+so a search is a few str.find calls over a single string instead of a Python loop over all prompts.
+"""
+import heapq
+import threading
+from bisect import bisect_right
+from typing import List, Dict, Tuple, Optional
+
+from backend.models import Match
+from backend.tools.database import Prompt, SEARCH_RESULT_LIMIT, IDENTIFIER_PLACEHOLDER, read_only_db, db_manager, db
+
+ROW_SEPARATOR = "\x1e"  # separates prompts in the concatenated corpus
+FRAGMENT_SEPARATOR = IDENTIFIER_PLACEHOLDER  # separates content fragments around identifiers and tags of a prompt
+
+
+class PromptIndex:
+    def __init__(self):
+        self.ids: List = []
+        self.roles: List[str] = []
+        self.contents: List[str] = []
+        self.identifier_positions: List[str] = []
+        self.searchable_contents: List[str] = []
+        self.created_ats: List = []
+        self.updated_ats: List = []
+        self.tags: List[Tuple[str, ...]] = []
+        # lowercased searchable content, i.e. content whose identifiers are replaced by FRAGMENT_SEPARATOR
+        self.masked_contents: List[str] = []
+        self.lowered_tags: List[str] = []  # lowercased tags separated by FRAGMENT_SEPARATOR
+        self.row_of_id: Dict = {}  # key is prompt id, value is its row in the lists above
+
+        # concatenated corpora and start offset of each row in them, rebuilt lazily after writes
+        self._content_corpus = ""
+        self._content_starts: List[int] = []
+        self._tag_corpus = ""
+        self._tag_starts: List[int] = []
+        self._is_corpus_stale = True
+        # prompts are written on the GUI thread while searches run in a worker thread
+        self._lock = threading.RLock()
+        self._database: Optional[str] = None  # path of the database the index is built from
+
+        Prompt.add_write_listener(self._handle_prompt_write)
+        # migrations may change prompts without notifying write listeners
+        db_manager.add_migration_listener(self.invalidate)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _ensure_built(self):
+        """Build the index if it is not built from the open database.
+        Prompts cannot be read before pending migrations are finished, so it stays empty until then."""
+        with self._lock:
+            if self._database != db.database and not db_manager.is_migration_pending:
+                self.build()
+
+    def invalidate(self):
+        """build the index again when it is next used"""
+        with self._lock:
+            self._database = None
+
+    def build(self):
+        """load all prompts from the database"""
+        with self._lock:
+            self._database = db.database
+            for column in self._columns:
+                column.clear()
+            self.row_of_id.clear()
+            query = Prompt.select(
+                Prompt.id,
+                Prompt.role,
+                Prompt.content,
+                Prompt.tags,
+                Prompt.identifier_positions,
+                Prompt.searchable_content,
+                Prompt.created_at,
+                Prompt.updated_at,
+            ).tuples().bind(read_only_db)
+            for row in query:
+                self._append(*row)
+            self._is_corpus_stale = True
+
+    @property
+    def _columns(self) -> List[List]:
+        return [
+            self.ids,
+            self.roles,
+            self.contents,
+            self.identifier_positions,
+            self.searchable_contents,
+            self.created_ats,
+            self.updated_ats,
+            self.tags,
+            self.masked_contents,
+            self.lowered_tags,
+        ]
+
+    def _append(
+            self, prompt_id, role, content, tags, identifier_positions, searchable_content, created_at, updated_at
+    ):
+        self.row_of_id[prompt_id] = len(self.ids)
+        self.ids.append(prompt_id)
+        self.roles.append(role)
+        self.contents.append(content)
+        self.identifier_positions.append(identifier_positions)
+        self.searchable_contents.append(searchable_content)
+        self.created_ats.append(created_at)
+        self.updated_ats.append(updated_at)
+        # a string of tags would otherwise be indexed character by character
+        tags = tuple(Prompt.normalize_tag_names(tags))
+        self.tags.append(tags)
+        self.masked_contents.append((searchable_content or content).lower())
+        self.lowered_tags.append(FRAGMENT_SEPARATOR.join(tags).lower())
+
+    def upsert(self, prompt: Prompt):
+        with self._lock:
+            row = (
+                prompt.id,
+                prompt.role,
+                prompt.content,
+                prompt.tag_names,
+                prompt.identifier_positions,
+                prompt.searchable_content,
+                prompt.created_at,
+                prompt.updated_at,
+            )
+            if prompt.id in self.row_of_id:
+                self.remove(prompt.id)
+            self._append(*row)
+            self._is_corpus_stale = True
+
+    def remove(self, prompt_id):
+        """remove a prompt by moving the last row into its place, so no other rows need to be shifted"""
+        with self._lock:
+            row = self.row_of_id.pop(prompt_id, None)
+            if row is None:
+                return
+            for column in self._columns:
+                last = column.pop()
+                if row < len(column):
+                    column[row] = last
+            if row < len(self.ids):
+                self.row_of_id[self.ids[row]] = row
+            self._is_corpus_stale = True
+
+    def _handle_prompt_write(self, action: str, prompt: Prompt):
+        with self._lock:
+            if self._database != db.database:  # the prompt is read when the index is built
+                return
+            if action == "save":
+                self.upsert(prompt)
+            elif action == "delete":
+                self.remove(prompt.id)
+
+    def _rebuild_corpus(self):
+        self._content_corpus, self._content_starts = self._concatenate(self.masked_contents)
+        self._tag_corpus, self._tag_starts = self._concatenate(self.lowered_tags)
+        self._is_corpus_stale = False
+
+    @staticmethod
+    def _concatenate(texts: List[str]) -> Tuple[str, List[int]]:
+        starts = []
+        offset = 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text) + len(ROW_SEPARATOR)
+        return ROW_SEPARATOR.join(texts), starts
+
+    @staticmethod
+    def _find_rows(corpus: str, starts: List[int], search_str: str) -> List[int]:
+        """find rows of the corpus that contain search_str. Each row is returned at most once."""
+        rows = []
+        position = corpus.find(search_str)
+        while position != -1:
+            row = bisect_right(starts, position) - 1
+            rows.append(row)
+            if row + 1 >= len(starts):
+                break
+            # skip the remaining part of the row since it is already matched
+            position = corpus.find(search_str, starts[row + 1])
+        return rows
+
+    def get_prompt(self, row: int) -> Prompt:
+        return Prompt(
+            id=self.ids[row],
+            role=self.roles[row],
+            content=self.contents[row],
+            tags=list(self.tags[row]),
+            identifier_positions=self.identifier_positions[row],
+            searchable_content=self.searchable_contents[row],
+            created_at=self.created_ats[row],
+            updated_at=self.updated_ats[row],
+        )
+
+    def get_prompt_by_id(self, prompt_id) -> Optional[Prompt]:
+        with self._lock:
+            self._ensure_built()
+            row = self.row_of_id.get(prompt_id)
+            return None if row is None else self.get_prompt(row)
+
+    def search_by_string(self, search_str: str, limit: int = SEARCH_RESULT_LIMIT) -> List[Match]:
+        """Only the `limit` best prompts are returned, where a prompt is better if its matching text is shorter,
+        the same rule as in Prompt.search_by_string.
+        """
+        lowered_search_str = search_str.lower()
+        if not lowered_search_str or ROW_SEPARATOR in lowered_search_str or FRAGMENT_SEPARATOR in lowered_search_str:
+            return []
+        with self._lock:
+            self._ensure_built()
+            if self._is_corpus_stale:
+                self._rebuild_corpus()
+            content_rows = self._find_rows(self._content_corpus, self._content_starts, lowered_search_str)
+            tag_rows = set(self._find_rows(self._tag_corpus, self._tag_starts, lowered_search_str))
+            content_row_set = set(content_rows)
+            rows = content_rows + sorted(tag_rows - content_row_set)
+            if len(rows) > limit:
+                rows = heapq.nsmallest(
+                    limit,
+                    rows,
+                    key=lambda r: min(
+                        len(self.masked_contents[r]) if r in content_row_set else float("inf"),
+                        len(self.lowered_tags[r]) if r in tag_rows else float("inf"),
+                    ),
+                )
+
+            matches = []
+            for row in rows:
+                match = self.get_prompt(row).to_match(
+                    search_str, source="memory", is_content_match=row in content_row_set, is_tag_match=row in tag_rows
+                )
+                if match:
+                    matches.append(match)
+            return matches
+
+
+prompt_index = PromptIndex()
@@ -0,0 +1,146 @@
+"""
+Import and export prompt libraries as JSONL or CSV files, e.g. to sync prompts across machines.
+
+Every line of a JSONL file, or every row of a CSV file, is a prompt with fields "role", "content" and "tags".
+In JSONL files, tags are a list of strings. In CSV files, tags are separated by semi-colons.
+A prompt whose content already exists is not imported again, but its role and tags are updated from the file.
+Files are read and written as streams, so memory usage does not grow with the size of the library.
+"""
+import csv
+import hashlib
+import json
+from dataclasses import dataclass
+from itertools import islice
+from pathlib import Path
+from typing import Iterator, Dict, Any, Optional, List
+
+import peewee as pw
+
+from backend.tools.database import Prompt, BULK_QUERY_BATCH_SIZE
+
+FORMATS = ["jsonl", "csv"]
+CSV_FIELDS = ["role", "content", "tags"]
+IMPORT_CHUNK_SIZE = 5000  # prompts inserted in each transaction
+ROLES = {"user", "system"}
+
+
+@dataclass
+class ImportSummary:
+    imported: int = 0
+    updated: int = 0  # prompts whose content already exists, and whose role or tags are changed by the file
+    duplicated: int = 0  # prompts that are already in the database as they are, or earlier in the file
+    invalid: int = 0  # rows without content
+
+
+def content_hash(content: str) -> bytes:
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+
+def get_file_format(path: Path, file_format: Optional[str] = None) -> str:
+    file_format = (file_format or path.suffix.lstrip(".")).lower()
+    if file_format not in FORMATS:
+        raise ValueError(f"Unsupported file format: {file_format}. Supported formats are {', '.join(FORMATS)}")
+    return file_format
+
+
+def read_prompt_rows(path: Path, file_format: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    file_format = get_file_format(path, file_format)
+    with open(path, encoding="utf-8", newline="") as f:
+        if file_format == "jsonl":
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for row in csv.DictReader(f):
+                row["tags"] = row.get("tags").split(Prompt.tags.seperator) if row.get("tags") else []
+                yield row
+
+
+def import_prompts(
+        path: Path, file_format: Optional[str] = None, chunk_size: int = IMPORT_CHUNK_SIZE
+) -> ImportSummary:
+    """Import prompts from a file in chunks.
+    Prompts whose content already exists are updated with Prompt.bulk_update, which only writes prompts that change.
+    """
+    summary = ImportSummary()
+    # hashes rather than contents are kept in memory, which are much smaller for long prompts
+    existing_ids = {
+        content_hash(content): prompt_id
+        for prompt_id, content in Prompt.select(Prompt.id, Prompt.content).tuples().iterator()
+    }
+    seen_hashes = set()  # of prompts earlier in the file
+    rows = read_prompt_rows(Path(path), file_format)
+    while chunk := list(islice(rows, chunk_size)):
+        prompts = []
+        updated_rows = {}  # key is the id of an existing prompt, value is the row that updates it
+        for row in chunk:
+            content = row.get("content") if isinstance(row, dict) else None
+            if not isinstance(content, str) or not content.strip():
+                summary.invalid += 1
+                continue
+            hash_value = content_hash(content)
+            if hash_value in seen_hashes:
+                summary.duplicated += 1
+                continue
+            seen_hashes.add(hash_value)
+            if hash_value in existing_ids:
+                updated_rows[existing_ids[hash_value]] = row
+                continue
+            role = row.get("role") if row.get("role") in ROLES else "user"
+            prompts.append(Prompt(role=role, content=content, tags=get_tags(row)))
+        summary.imported += Prompt.bulk_insert(prompts)
+        updated = update_existing_prompts(updated_rows)
+        summary.updated += updated
+        summary.duplicated += len(updated_rows) - updated
+    return summary
+
+
+def get_tags(row: Dict[str, Any]) -> List[str]:
+    tags = row.get("tags") or []
+    if isinstance(tags, str):  # a single tag, which would otherwise be split into characters
+        tags = [tags]
+    return [str(tag) for tag in tags]
+
+
+def update_existing_prompts(rows: Dict[Any, Dict[str, Any]]) -> int:
+    """Update roles and tags of existing prompts from rows, keyed by ids of prompts. Fields missing from a row are kept.
+    Returns the number of prompts that change.
+    """
+    prompts = []
+    for batch in pw.chunked(list(rows), BULK_QUERY_BATCH_SIZE):
+        for prompt in Prompt.select(Prompt.id, Prompt.role, Prompt.tags).where(Prompt.id.in_(batch)):
+            row = rows[prompt.id]
+            if row.get("role") in ROLES:
+                prompt.role = row["role"]
+            if "tags" in row:
+                prompt.tags = get_tags(row)
+            prompts.append(prompt)
+    return Prompt.bulk_update(prompts, fields=[Prompt.role, Prompt.tags])
+
+
+def iterate_prompt_rows() -> Iterator[Dict[str, Any]]:
+    """iterate over prompts with a cursor, so prompts are not loaded into memory all at once"""
+    query = Prompt.select(Prompt.role, Prompt.content, Prompt.tags).order_by(Prompt.created_at).dicts()
+    for row in query.iterator():
+        row["tags"] = [tag for tag in row["tags"] or [] if tag]
+        yield row
+
+
+def export_prompts(path: Path, file_format: Optional[str] = None) -> int:
+    """export all prompts to a file, returning the number of exported prompts"""
+    path = Path(path)
+    file_format = get_file_format(path, file_format)
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if file_format == "jsonl":
+            for row in iterate_prompt_rows():
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                count += 1
+        else:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            for row in iterate_prompt_rows():
+                row["tags"] = Prompt.tags.seperator.join(row["tags"])
+                writer.writerow(row)
+                count += 1
+    return count
@@ -0,0 +1,372 @@
+"""
+Semantic search over prompts with TF-IDF vectors, so prompts that share words with the search string are found
+even if they do not contain it as a substring. It runs offline and needs no model, only NumPy.
+
+Features of a text are words and character trigrams of words for alphabetic languages,
+and characters and character bigrams for languages without spaces between words, e.g. Chinese.
+Features are hashed into N_FEATURES buckets, so there is no vocabulary to maintain.
+
+The index has two parts:
+1. a base segment, which is a sparse matrix of normalized TF-IDF weights in CSC layout, i.e. for each feature,
+    the rows of prompts that have it and their weights. It is saved as .npy files in user_data/semantic_index
+    (next to the database file) and memory-mapped when loaded, so it is not read into memory as a whole.
+2. a delta of prompts that are saved or deleted after the base segment is built, which is kept in memory.
+    Prompts in the delta are vectorized with the document frequencies of the base segment.
+    The base segment is rebuilt in a background thread when the delta grows large, and when prompts have changed
+    since it was saved, so even a small library is loaded from disk on the next start instead of being vectorized.
+The index is opened when it is first searched. Only keys of prompts are kept in the index. Matched prompts are read
+from the in-memory PromptIndex, so searching never touches the database.
+"""
+import json
+import os
+import re
+import shutil
+import threading
+import zlib
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Dict, Tuple, Optional
+
+import numpy as np
+
+from backend.models import Match
+from backend.tools.fuzzy_matcher import highlight_positions
+from backend.tools.database import Prompt, db, read_only_db, db_manager
+from backend.tools.prompt_index import prompt_index
+from backend.tools.utils import logger
+
+N_FEATURES = 2**18
+INDEX_DIRECTORY_NAME = "semantic_index"  # created next to the database file
+MIN_SEARCH_LENGTH = 3  # shorter search strings have too few features to be meaningful
+MIN_SCORE = 0.15  # minimum cosine similarity of a match
+SEMANTIC_RESULT_LIMIT = 20
+MIN_DELTA_SIZE_TO_REBUILD = 2000  # the base segment is rebuilt when the delta is larger than this and
+DELTA_RATIO_TO_REBUILD = 0.2  # this ratio of the base segment
+TOKEN_PATTERN = re.compile(r"[0-9a-z]+|[^\W0-9a-z_]+")  # ASCII words, or runs of other letters, e.g. Chinese
+
+
+def extract_features(text: str) -> List[int]:
+    """
+    >>> len(extract_features("Hi")), len(extract_features("你好"))  # word + 2 trigrams of " hi ", 2 chars + 1 bigram
+    (3, 3)
+    """
+    features = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token.isascii():
+            features.append("w " + token)
+            padded = f" {token} "
+            features.extend(padded[i: i + 3] for i in range(len(padded) - 2))
+        else:
+            features.extend(token)
+            features.extend(token[i: i + 2] for i in range(len(token) - 1))
+    return [zlib.crc32(feature.encode("utf-8")) % N_FEATURES for feature in features]
+
+
+def get_document(prompt: Prompt) -> str:
+    """the text of a prompt to index, where identifiers are masked out as in substring search"""
+    return " ".join([prompt.searchable_content or prompt.content or ""] + prompt.tag_names)
+
+
+def get_key(prompt_id) -> str:
+    return Prompt.id.db_value(prompt_id)
+
+
+def compute_idf(document_frequencies: "np.ndarray", document_count: int) -> "np.ndarray":
+    return (np.log((1 + document_count) / (1 + document_frequencies)) + 1).astype(np.float32)
+
+
+def vectorize(text: str, idf: "np.ndarray") -> Tuple["np.ndarray", "np.ndarray"]:
+    """features of text and their normalized TF-IDF weights"""
+    counts = Counter(extract_features(text))
+    features = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+    weights = (1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))) * idf[features]
+    norm = np.linalg.norm(weights)
+    return features, (weights / norm if norm else weights)
+
+
+@dataclass
+class Segment:
+    ids: List[str]
+    hashes: "np.ndarray"  # crc32 of the document of each row, used to find prompts that changed since the build
+    feature_starts: "np.ndarray"  # rows of feature f are rows[feature_starts[f]:feature_starts[f + 1]]
+    rows: "np.ndarray"
+    weights: "np.ndarray"
+    document_frequencies: "np.ndarray"
+
+    @property
+    def idf(self) -> "np.ndarray":
+        return compute_idf(self.document_frequencies, len(self.ids))
+
+    @classmethod
+    def empty(cls) -> "Segment":
+        return cls.build([])
+
+    @classmethod
+    def build(cls, documents: List[Tuple[str, str]]) -> "Segment":
+        """build from (key, text) of documents"""
+        ids, hashes, features, rows, counts = [], [], [], [], []
+        for row, (key, text) in enumerate(documents):
+            document_counts = Counter(extract_features(text))
+            ids.append(key)
+            hashes.append(zlib.crc32(text.encode("utf-8")))
+            features.extend(document_counts.keys())
+            rows.extend([row] * len(document_counts))
+            counts.extend(document_counts.values())
+        features = np.array(features, dtype=np.int32)
+        rows = np.array(rows, dtype=np.int32)
+        # every feature appears at most once per document, so the number of entries of a feature is its frequency
+        document_frequencies = np.bincount(features, minlength=N_FEATURES).astype(np.int32)
+        idf = compute_idf(document_frequencies, len(ids))
+        weights = (1 + np.log(np.array(counts, dtype=np.float32))) * idf[features]
+        norms = np.sqrt(np.bincount(rows, weights=weights**2, minlength=len(ids))).astype(np.float32)
+        weights /= norms[rows]
+
+        order = np.argsort(features, kind="stable")
+        feature_starts = np.zeros(N_FEATURES + 1, dtype=np.int64)
+        np.cumsum(document_frequencies, out=feature_starts[1:])
+        return cls(
+            ids=ids,
+            hashes=np.array(hashes, dtype=np.uint32),
+            feature_starts=feature_starts,
+            rows=rows[order],
+            weights=weights[order],
+            document_frequencies=document_frequencies,
+        )
+
+    def save(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / "ids.npy", np.array(self.ids, dtype="U32"))
+        for name in ["hashes", "feature_starts", "rows", "weights", "document_frequencies"]:
+            np.save(directory / f"{name}.npy", getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: Path) -> "Segment":
+        arrays = {
+            name: np.load(directory / f"{name}.npy", mmap_mode="r")
+            for name in ["hashes", "feature_starts", "rows", "weights", "document_frequencies"]
+        }
+        return cls(ids=np.load(directory / "ids.npy").tolist(), **arrays)
+
+    def scores(self, features: "np.ndarray", weights: "np.ndarray") -> "np.ndarray":
+        """cosine similarity between a query vector and every row"""
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for feature, weight in zip(features, weights):
+            start, end = self.feature_starts[feature], self.feature_starts[feature + 1]
+            # a row appears at most once per feature, so there are no duplicate indices to accumulate
+            scores[self.rows[start:end]] += weight * self.weights[start:end]
+        return scores
+
+
+@dataclass
+class DeltaEntry:
+    write_count: int  # value of SemanticIndex.write_count when the prompt was written
+    document: Optional[str]  # None if the prompt is deleted
+    vector: Optional[Dict[int, float]] = None  # weights of features, vectorized lazily when searched
+
+
+class SemanticIndex:
+    def __init__(self):
+        self.directory: Optional[Path] = None
+        self.base = Segment.empty()
+        self.row_of_key: Dict[str, int] = {}
+        self.idf = self.base.idf
+        self.delta: Dict[str, DeltaEntry] = {}  # key is prompt id
+        self.write_count = 0
+        self._removed_rows = set()  # rows of the base segment whose prompts are changed or deleted
+        self._is_rebuilding = False
+        self._lock = threading.RLock()
+        self._database: Optional[str] = None  # path of the database the index is opened for
+
+        Prompt.add_write_listener(self._handle_prompt_write)
+        # migrations may change prompts without notifying write listeners
+        db_manager.add_migration_listener(self.invalidate)
+
+    def open(self, synchronize: bool = True):
+        """Load the index of the open database, which is done when the index is first searched, or again after
+        open_database() switches to another database, e.g. when benchmarking.
+
+        :param synchronize: synchronize the index with the database in a background thread.
+        """
+        with self._lock:
+            self._database = db.database
+            # the index belongs to the database it is built from, e.g. not to user_data/ for a temporary one
+            self.directory = Path(db.database).parent / INDEX_DIRECTORY_NAME
+            self._set_base(Segment.empty())
+            self.delta = {}
+            self.load()
+            if synchronize:
+                # prompts may have been changed since the base segment was built, e.g. by importing a library
+                threading.Thread(target=self.synchronize, daemon=True).start()
+
+    def _ensure_open(self):
+        """Open the index if it is not opened for the open database.
+        Prompts cannot be read before pending migrations are finished, so it stays empty until then."""
+        with self._lock:
+            if self._database != db.database and not db_manager.is_migration_pending:
+                self.open()
+
+    def invalidate(self):
+        """open the index again when it is next used"""
+        with self._lock:
+            self._database = None
+
+    def load(self):
+        try:
+            with open(self.directory / "meta.json", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta["n_features"] != N_FEATURES:
+                return
+            self._set_base(Segment.load(self.directory / meta["segment"]))
+        except (OSError, ValueError, KeyError) as e:
+            logger.info(f"Semantic index is not loaded and will be rebuilt: {e}")
+            return
+        self._remove_segments_except(meta["segment"])
+
+    def _remove_segments_except(self, segment_name: str):
+        """Remove replaced segments. Segments that are still memory-mapped cannot be removed on Windows,
+        so they are removed the next time the index is loaded."""
+        for path in self.directory.iterdir():
+            if path.is_dir() and path.name != segment_name:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _set_base(self, base: Segment):
+        self.base = base
+        self.row_of_key = {key: row for row, key in enumerate(base.ids)}
+        self.idf = base.idf
+        self._removed_rows = set()
+
+    def _handle_prompt_write(self, action: str, prompt: Prompt):
+        with self._lock:
+            if self._database != db.database:  # the prompt is synchronized when the index is opened
+                return
+            self.write_count += 1
+            key = get_key(prompt.id)
+            document = get_document(prompt) if action == "save" else None
+            self.delta[key] = DeltaEntry(write_count=self.write_count, document=document)
+            if key in self.row_of_key:
+                self._removed_rows.add(self.row_of_key[key])
+            if self._is_delta_large():
+                self.start_rebuild()
+
+    def _is_delta_large(self) -> bool:
+        return len(self.delta) > max(MIN_DELTA_SIZE_TO_REBUILD, DELTA_RATIO_TO_REBUILD * len(self.base.ids))
+
+    def synchronize(self):
+        """Put prompts that differ from the base segment into the delta, unless there are many of them.
+        The base segment is then rebuilt to include them."""
+        documents = self._read_documents()
+        with self._lock:
+            changed = {}
+            for key, document in documents.items():
+                row = self.row_of_key.get(key)
+                if row is None or self.base.hashes[row] != zlib.crc32(document.encode("utf-8")):
+                    changed[key] = document
+            for key in self.row_of_key:
+                if key not in documents:
+                    changed[key] = None
+            if not changed:
+                return
+            if len(changed) <= max(MIN_DELTA_SIZE_TO_REBUILD, DELTA_RATIO_TO_REBUILD * len(self.base.ids)):
+                # searched until the rebuild below is finished
+                for key, document in changed.items():
+                    # prompts written since the documents were read are already in the delta and newer
+                    self.delta.setdefault(key, DeltaEntry(write_count=0, document=document))
+                    if key in self.row_of_key:
+                        self._removed_rows.add(self.row_of_key[key])
+            # saved whatever the size of the library, so it is not vectorized again on the next start
+            self.start_rebuild()
+
+    @staticmethod
+    def _read_documents() -> Dict[str, str]:
+        query = Prompt.select(Prompt.id, Prompt.content, Prompt.searchable_content, Prompt.tags).bind(read_only_db)
+        return {get_key(prompt.id): get_document(prompt) for prompt in query.iterator()}
+
+    def start_rebuild(self):
+        with self._lock:
+            if self._is_rebuilding:
+                return
+            self._is_rebuilding = True
+        threading.Thread(target=self.rebuild, daemon=True).start()
+
+    def rebuild(self):
+        """build a new base segment from the database and replace the current one with it"""
+        try:
+            with self._lock:
+                # prompts written after this are kept in the delta, since they may be missing from the documents read
+                write_count = self.write_count
+            documents = self._read_documents()
+            base = Segment.build(list(documents.items()))
+            segment_name = f"segment_{write_count}_{len(documents)}"
+            base.save(self.directory / segment_name)
+            with open(self.directory / "meta.json.tmp", "w", encoding="utf-8") as f:
+                json.dump({"n_features": N_FEATURES, "segment": segment_name}, f)
+            os.replace(self.directory / "meta.json.tmp", self.directory / "meta.json")
+            base = Segment.load(self.directory / segment_name)
+            with self._lock:
+                self._set_base(base)
+                self.delta = {key: entry for key, entry in self.delta.items() if entry.write_count > write_count}
+                for key in self.delta:
+                    if key in self.row_of_key:
+                        self._removed_rows.add(self.row_of_key[key])
+            self._remove_segments_except(segment_name)
+        except Exception as e:
+            logger.exception(f"Failed to rebuild the semantic index: {e}")
+        finally:
+            with self._lock:
+                self._is_rebuilding = False
+                # many prompts may have been written during the rebuild, e.g. by importing a library
+                if self._is_delta_large():
+                    self.start_rebuild()
+
+    def search_by_string(self, search_str: str, limit: int = SEMANTIC_RESULT_LIMIT) -> List[Match]:
+        if len(search_str.strip()) < MIN_SEARCH_LENGTH:
+            return []
+        with self._lock:
+            self._ensure_open()
+            features, weights = vectorize(search_str, self.idf)
+            if not len(features):
+                return []
+            scores = self.base.scores(features, weights)
+            if self._removed_rows:
+                scores[list(self._removed_rows)] = 0
+            rows = np.flatnonzero(scores >= MIN_SCORE)
+            if len(rows) > limit:
+                rows = rows[np.argpartition(scores[rows], -limit)[-limit:]]
+            scored_keys = [(float(scores[row]), self.base.ids[row]) for row in rows]
+
+            query_vector = dict(zip(features.tolist(), weights.tolist()))
+            # vectorizing a large delta, e.g. while a library is being imported, would stall searching.
+            # It is left to the rebuild that is running.
+            is_vectorizing = not (self._is_rebuilding and self._is_delta_large())
+            for key, entry in self.delta.items():
+                if entry.document is None:
+                    continue
+                if entry.vector is None:
+                    if not is_vectorizing:
+                        continue
+                    entry.vector = dict(zip(*(array.tolist() for array in vectorize(entry.document, self.idf))))
+                score = sum(weight * entry.vector.get(feature, 0) for feature, weight in query_vector.items())
+                if score >= MIN_SCORE:
+                    scored_keys.append((score, key))
+        scored_keys = sorted(scored_keys, reverse=True)[:limit]
+
+        matches = []
+        for _, key in scored_keys:
+            prompt = prompt_index.get_prompt_by_id(Prompt.id.python_value(key))
+            if prompt is None:
+                continue
+            matches.append(
+                Match(
+                    source="semantic",
+                    category="prompt",
+                    data=prompt,
+                    match_fields=["content"],
+                    match_fields_values={"content": prompt.content},
+                    match_positions={"content": highlight_positions(search_str, prompt.content)},
+                )
+            )
+        return matches
+
+
+semantic_index = SemanticIndex()
@@ -1,6 +1,8 @@
 import logging
 from enum import Enum
 
+from setting.setting_reader import setting
+
 
 def get_subsequences(seq, exclude_indices):
     """
@@ -112,7 +114,7 @@ def setup_logger():
     logger.setLevel(logging.DEBUG)
 
     # create a file handler
-    file_handler = logging.FileHandler('debug.log')
+    file_handler = logging.FileHandler(setting.user_data_path / 'debug.log')
     file_handler.setLevel(logging.DEBUG)
 
     # create a console handler
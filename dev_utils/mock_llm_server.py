@@ -0,0 +1,157 @@
+"""
+A local stand-in for the OpenAI chat completions API, so streaming can be developed and benchmarked without an API key
+or network.
+
+Replies are made of numbered words, e.g. "w0 w1 w2 ", where a word stands for a token. Streamed replies are sent as SSE
+events like the real API, with a latency before the first chunk, a delay between chunks and a number of tokens per
+chunk. Errors can be injected: a request can fail with an HTTP error, or its stream can be cut off midway.
+
+Usage:
+    python -m dev_utils.mock_llm_server --port 8765 --token-delay 0.02 --error-rate 0.1
+and point openai.api_base to http://127.0.0.1:8765/v1
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from aiohttp import web
+
+
+@dataclass
+class MockLLMConfig:
+    reply_tokens: int = 200  # tokens of every reply
+    chunk_size: int = 1  # tokens of every streamed chunk
+    first_token_latency: float = 0.3  # seconds before the first chunk
+    token_delay: float = 0.02  # seconds between chunks
+    error_rate: float = 0.0  # ratio of requests that fail with error_status
+    error_status: int = 500
+    disconnect_rate: float = 0.0  # ratio of streams that are cut off in the middle
+    seed: Optional[int] = None
+
+
+class MockLLMServer:
+    def __init__(self, config: Optional[MockLLMConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        """:param port: 0 to pick a free port, which is known after start()"""
+        self.config = config or MockLLMConfig()
+        self.host = host
+        self.port = port
+        self.random = random.Random(self.config.seed)
+        self.request_count = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def api_base(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completions)
+        return app
+
+    @staticmethod
+    def error_response(status: int, message: str) -> web.Response:
+        return web.json_response({"error": {"message": message, "type": "server_error", "code": None}}, status=status)
+
+    @staticmethod
+    def completion_object(model: str, **kwargs) -> dict:
+        return {"id": "chatcmpl-mock", "created": int(time.time()), "model": model, **kwargs}
+
+    async def handle_chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.request_count += 1
+        body = await request.json()
+        model = body.get("model", "")
+        if self.random.random() < self.config.error_rate:
+            return self.error_response(self.config.error_status, "Injected error of the mock server")
+        await asyncio.sleep(self.config.first_token_latency)
+        words = [f"w{i} " for i in range(self.config.reply_tokens)]
+        if not body.get("stream"):
+            await asyncio.sleep(self.config.token_delay * len(words))
+            message = {"role": "assistant", "content": "".join(words)}
+            return web.json_response(self.completion_object(
+                model,
+                object="chat.completion",
+                choices=[{"index": 0, "message": message, "finish_reason": "stop"}],
+            ))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        disconnect_at = (
+            self.random.randrange(len(words)) if self.random.random() < self.config.disconnect_rate else None
+        )
+        for start in range(0, len(words), self.config.chunk_size):
+            if disconnect_at is not None and start >= disconnect_at:
+                # cut off the stream without the final event
+                request.transport.close()
+                return response
+            if start:
+                await asyncio.sleep(self.config.token_delay)
+            chunk = self.completion_object(
+                model,
+                object="chat.completion.chunk",
+                choices=[{
+                    "index": 0,
+                    "delta": {"content": "".join(words[start: start + self.config.chunk_size])},
+                    "finish_reason": None,
+                }],
+            )
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def _start(self):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.port = self._runner.addresses[0][1]
+
+    def start(self):
+        """serve in a daemon thread, returning once the server accepts connections"""
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._start())
+        self._thread = threading.Thread(target=self._loop.run_forever, name="MockLLMServer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve a mock OpenAI chat completions API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--reply-tokens", type=int, default=200)
+    parser.add_argument("--chunk-size", type=int, default=1, help="tokens of every streamed chunk")
+    parser.add_argument("--first-token-latency", type=float, default=0.3, help="seconds")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    server = MockLLMServer(
+        MockLLMConfig(
+            reply_tokens=args.reply_tokens,
+            chunk_size=args.chunk_size,
+            first_token_latency=args.first_token_latency,
+            token_delay=args.token_delay,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            disconnect_rate=args.disconnect_rate,
+            seed=args.seed,
+        ),
+        port=args.port,
+    )
+    web.run_app(server.make_app(), host=server.host, port=server.port)
@@ -0,0 +1,224 @@
+"""
+Benchmark of searching prompts and commands while typing.
+
+Prompt libraries of different sizes are generated into temporary SQLite files. For each library, keystroke sequences
+are replayed against every stage of searching, and latencies (p50/p95/p99) and peak memory allocated per call are
+reported as JSON, so results of different commits can be compared.
+
+Usage:
+    python -m dev_utils.search_benchmark --sizes 1000 10000 --output bench.json
+"""
+import argparse
+import json
+import math
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import List, Dict, Callable, Any
+
+from backend.tools.database import db, read_only_db, db_manager, Prompt, open_database
+
+ENGLISH_WORDS = [
+    "explain", "translate", "summarize", "review", "code", "python", "function", "error", "write", "email",
+    "article", "story", "teacher", "student", "question", "answer", "improve", "grammar", "polish", "outline",
+]
+CHINESE_WORDS = ["解释", "翻译", "总结", "代码", "审查", "函数", "错误", "写作", "邮件", "文章", "故事", "老师", "问题", "回答"]
+IDENTIFIERS = ["lang", "topic", "text", "code", "name", "tone"]
+TAGS = ["teacher", "coding", "writing", "translation", "教师", "编程", "写作", "翻译", "daily", "work"]
+
+# what users type, one keystroke at a time. "\b" is a backspace.
+KEYSTROKE_SEQUENCES = [
+    "explain",
+    "translate to",
+    "cod\b\bode review",
+    "翻译",
+    "解释代码",
+    "writing",
+    "xyz",
+]
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """nearest-rank percentile of values that are already sorted
+
+    >>> percentile(list(range(1, 21)), 95)
+    19
+    """
+    if not sorted_values:
+        return 0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(percent / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def replay_keystrokes(sequence: str) -> List[str]:
+    """search strings after each keystroke of the sequence"""
+    search_strs = []
+    typed = ""
+    for keystroke in sequence:
+        typed = typed[:-1] if keystroke == "\b" else typed + keystroke
+        if typed.strip():
+            search_strs.append(typed)
+    return search_strs
+
+
+class PromptLibraryGenerator:
+    def __init__(self, seed: int = 0):
+        self.random = random.Random(seed)
+
+    def generate_prompt(self) -> Dict[str, Any]:
+        words = self.random.choice([ENGLISH_WORDS, CHINESE_WORDS])
+        separator = " " if words is ENGLISH_WORDS else ""
+        content = separator.join(self.random.choices(words, k=self.random.randint(3, 40)))
+        for _ in range(self.random.choice([0, 0, 1, 2])):
+            content += separator + "${" + self.random.choice(IDENTIFIERS) + "}"
+        tags = self.random.sample(TAGS, k=self.random.choice([0, 1, 1, 2, 3]))
+        return {"role": self.random.choice(["user", "system"]), "content": content, "tags": tags}
+
+    def populate(self, size: int, batch_size: int = 1000):
+        for batch_start in range(0, size, batch_size):
+            Prompt.bulk_insert([Prompt(**self.generate_prompt()) for _ in range(min(batch_size, size - batch_start))])
+
+
+class SearchBenchmark:
+    def __init__(self, sizes: List[int], repeat: int = 3, seed: int = 0):
+        self.sizes = sizes
+        self.repeat = repeat
+        self.seed = seed
+        self.retriever_agent = None
+
+    def stages(self) -> Dict[str, Callable[[str], Any]]:
+        """stages of searching, each of which is called with the search string after every keystroke"""
+        # imported here, because they load prompts from the database when imported
+        from backend.agents.retriever_agent import RetrieverAgent
+        from backend.tools.prompt_index import prompt_index
+        from backend.tools.semantic_index import semantic_index
+        from frontend.commands import command_manager
+        from frontend.components.command_result_list import TextMatchesSorter
+
+        # built from the library being measured before measuring, rather than when first searched
+        prompt_index.build()
+        semantic_index.open(synchronize=False)
+        semantic_index.rebuild()
+        self.retriever_agent = RetrieverAgent()
+        stages = {
+            "Prompt.search_by_string(like)": lambda s: Prompt.search_by_string(s, use_fts=False),
+            "Prompt.search_by_string(fts)": lambda s: Prompt.search_by_string(s, use_fts=True),
+            "DBManager.search_by_string": db_manager.search_by_string,
+            "PromptIndex.search_by_string": prompt_index.search_by_string,
+            "SemanticIndex.search_by_string": semantic_index.search_by_string,
+            "CommandManager.search": command_manager.search,
+            "TextMatchesSorter.sort": lambda s: TextMatchesSorter.sort(
+                prompt_index.search_by_string(s) + command_manager.search(s), s
+            ),
+            # includes refinement of the previous keystroke's matches and the query cache
+            "RetrieverAgent.search": self.retriever_agent.search,
+        }
+        if not db_manager.fts_enabled:
+            stages.pop("Prompt.search_by_string(fts)")
+        return stages
+
+    def reset_caches(self):
+        """RetrieverAgent caches results of searches, which are cleared before each keystroke sequence"""
+        self.retriever_agent.refinement_cache.clear()
+        self.retriever_agent.query_cache.clear()
+
+    def measure_stage(self, stage: Callable[[str], Any], reset: Callable[[], None]) -> Dict[str, Any]:
+        latencies = []
+        for _ in range(self.repeat):
+            for sequence in KEYSTROKE_SEQUENCES:
+                reset()
+                for search_str in replay_keystrokes(sequence):
+                    start = time.perf_counter()
+                    stage(search_str)
+                    latencies.append((time.perf_counter() - start) * 1000)
+
+        # tracemalloc slows down every allocation, so allocations are measured in a separate pass
+        peak_allocations = []
+        tracemalloc.start()
+        for sequence in KEYSTROKE_SEQUENCES:
+            reset()
+            for search_str in replay_keystrokes(sequence):
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                stage(search_str)
+                peak_allocations.append(tracemalloc.get_traced_memory()[1] - baseline)
+        tracemalloc.stop()
+
+        latencies.sort()
+        peak_allocations.sort()
+        return {
+            "calls": len(latencies),
+            "mean_ms": sum(latencies) / len(latencies),
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": latencies[-1],
+            "peak_allocated_bytes_p50": percentile(peak_allocations, 50),
+            "peak_allocated_bytes_max": peak_allocations[-1],
+        }
+
+    def run_library(self, size: int, directory: Path) -> Dict[str, Any]:
+        open_database(directory / f"prompts_{size}.db")
+        db_manager._create_tables()
+
+        start = time.perf_counter()
+        PromptLibraryGenerator(seed=self.seed).populate(size)
+        populate_seconds = time.perf_counter() - start
+
+        stages = self.stages()
+        result = {"populate_s": populate_seconds, "fts_enabled": db_manager.fts_enabled, "stages": {}}
+        for name, stage in stages.items():
+            print(f"{size} prompts: {name}", file=sys.stderr)
+            result["stages"][name] = self.measure_stage(stage, reset=self.reset_caches)
+        self.retriever_agent.close()
+        db.close()
+        read_only_db.close()
+        return result
+
+    def run(self) -> Dict[str, Any]:
+        report = {"meta": self.meta(), "libraries": {}}
+        with tempfile.TemporaryDirectory() as directory:
+            for size in self.sizes:
+                report["libraries"][str(size)] = self.run_library(size, Path(directory))
+        return report
+
+    def meta(self) -> Dict[str, Any]:
+        try:
+            commit = subprocess.run(
+                ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent
+            ).stdout.strip()
+        except OSError:
+            commit = ""
+        return {
+            "commit": commit,
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "repeat": self.repeat,
+            "seed": self.seed,
+            "keystroke_sequences": KEYSTROKE_SEQUENCES,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark searching over synthetic prompt libraries")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3, help="times to replay the keystroke sequences")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = SearchBenchmark(sizes=args.sizes, repeat=args.repeat, seed=args.seed).run()
+    report_json = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        args.output.write_text(report_json, encoding="utf-8")
+    else:
+        print(report_json)
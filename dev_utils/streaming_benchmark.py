@@ -0,0 +1,284 @@
+"""
+Benchmark of streaming LLM replies, against the local mock server of dev_utils/mock_llm_server.py.
+
+Three stages are measured:
+1. LLMAgent, whose streamed chunks are iterated directly.
+2. ChatWindow, shown headless, into which several conversations send messages at once. Chunks are timed when they
+    are delivered to the window on the GUI thread. Meanwhile, a timer on the GUI thread measures how late it fires,
+    i.e. how long the GUI thread is stalled.
+3. CommandWindow, shown headless, which talks to AI one request at a time, timed in the same way as ChatWindow.
+
+Time to first token (TTFT, the first chunk shown, which holds a few tokens), tokens/sec delivered and GUI stall
+times are reported as JSON, so results of different commits can be compared.
+
+Usage:
+    python -m dev_utils.streaming_benchmark --requests 10 --concurrency 1 4 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Dict, Any
+
+# windows are shown without a display
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import openai
+from PySide6.QtCore import QTimer, QEventLoop
+from PySide6.QtWidgets import QApplication
+
+from backend.agents.llm_agent import LLMAgent, LLMResult
+from backend.tools.database import db, read_only_db, db_manager, open_database
+from dev_utils.mock_llm_server import MockLLMServer, MockLLMConfig
+from dev_utils.search_benchmark import percentile
+from setting.setting_reader import setting
+
+STALL_TIMER_INTERVAL = 5  # milliseconds
+FRAME_BUDGET = 16  # milliseconds. Stalls longer than a frame at 60Hz are noticeable.
+REQUEST_TIMEOUT = 120  # seconds waited for all replies of a round
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    if not values:
+        return {}
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": values[-1],
+    }
+
+
+class RequestTiming:
+    def __init__(self, sent_at: float):
+        self.sent_at = sent_at
+        self.first_chunk_at = None
+        self.finished_at = None
+        self.output_tokens = 0
+        self.success = False
+
+    def chunk_received(self):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+
+    def result_received(self, result: LLMResult):
+        self.finished_at = time.perf_counter()
+        self.output_tokens = result.output_token_usage
+        self.success = result.success
+
+    @staticmethod
+    def report(timings: List["RequestTiming"]) -> Dict[str, Any]:
+        succeeded = [t for t in timings if t.success and t.first_chunk_at is not None]
+        return {
+            "requests": len(timings),
+            "failed": len(timings) - len(succeeded),
+            "ttft_ms": summarize([(t.first_chunk_at - t.sent_at) * 1000 for t in succeeded]),
+            "tokens_per_s": summarize(
+                [t.output_tokens / (t.finished_at - t.sent_at) for t in succeeded if t.finished_at > t.sent_at]
+            ),
+            "duration_ms": summarize([(t.finished_at - t.sent_at) * 1000 for t in succeeded]),
+        }
+
+
+class StallMonitor:
+    """a timer on the GUI thread, which fires late by as long as the GUI thread is busy"""
+
+    def __init__(self, interval: int = STALL_TIMER_INTERVAL):
+        self.interval = interval
+        self.timer = QTimer()
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self._tick)
+        self.stalls: List[float] = []  # milliseconds each tick is late
+        self._last_tick = None
+
+    def start(self):
+        self.stalls.clear()
+        self._last_tick = time.perf_counter()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def _tick(self):
+        now = time.perf_counter()
+        self.stalls.append(max(0.0, (now - self._last_tick) * 1000 - self.interval))
+        self._last_tick = now
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "ticks": len(self.stalls),
+            "stall_ms": summarize(self.stalls),
+            "stalled_over_frame_budget_ms": sum(stall for stall in self.stalls if stall > FRAME_BUDGET),
+        }
+
+
+class StreamingBenchmark:
+    def __init__(self, config: MockLLMConfig, requests: int = 10, concurrency: List[int] = None):
+        self.config = config
+        self.requests = requests
+        self.concurrency = concurrency or [1, 4]
+        self.server = MockLLMServer(config)
+        self.app = QApplication.instance() or QApplication([])
+
+    def run_agent(self) -> Dict[str, Any]:
+        agent = LLMAgent()
+        timings = []
+        for i in range(self.requests):
+            timing = RequestTiming(sent_at=time.perf_counter())
+            for chunk in agent.act(trigger_attrs={"user_input": f"question {i}"}):
+                if isinstance(chunk, LLMResult):
+                    timing.result_received(chunk)
+                else:
+                    timing.chunk_received()
+            timings.append(timing)
+        return RequestTiming.report(timings)
+
+    def run_chat_window(self, concurrency: int) -> Dict[str, Any]:
+        # imported here, because they load prompts from the database when imported
+        from frontend.windows.chat_window import ChatWindow
+
+        window = ChatWindow()
+        window.show()
+        # connected after the window's own slots, so chunks are timed once the window has displayed them
+        timings: Dict[str, RequestTiming] = {}
+        window.llm_scheduler.content_received.connect(lambda request_id, _: timings[request_id].chunk_received())
+        window.llm_scheduler.result_received.connect(
+            lambda request_id, result: timings[request_id].result_received(result)
+        )
+        stall_monitor = StallMonitor()
+        stall_monitor.start()
+
+        finished_timings = []
+        for round_start in range(0, self.requests, concurrency):
+            timings.clear()
+            for i in range(round_start, min(round_start + concurrency, self.requests)):
+                window.start_new_conversation()
+                sent_at = time.perf_counter()
+                window.send_message(f"question {i}")
+                request_id = next(r for r in window.responding_conversations if r not in timings)
+                timings[request_id] = RequestTiming(sent_at=sent_at)
+            self.wait_until(lambda: not window.responding_conversations)
+            finished_timings.extend(timings.values())
+
+        stall_monitor.stop()
+        window.llm_scheduler.stop()
+        window.close()
+        return {**RequestTiming.report(finished_timings), "gui_thread": stall_monitor.report()}
+
+    def run_command_window(self) -> Dict[str, Any]:
+        # imported here, because they load prompts from the database when imported
+        from frontend.windows.command_window import CommandWindow, Mode
+
+        window = CommandWindow()
+        window.show()
+        # connected after the window's own slots, so chunks are timed once the window has displayed them
+        timings: Dict[str, RequestTiming] = {}
+        window.llm_scheduler.content_received.connect(lambda request_id, _: timings[request_id].chunk_received())
+        window.llm_scheduler.result_received.connect(
+            lambda request_id, result: timings[request_id].result_received(result)
+        )
+        stall_monitor = StallMonitor()
+        stall_monitor.start()
+
+        for i in range(self.requests):
+            window.text_edit.setPlainText(f"question {i}")
+            sent_at = time.perf_counter()
+            window._talk_to_ai()
+            timings[window.llm_request_id] = RequestTiming(sent_at=sent_at)
+            self.wait_until(lambda: window.mode != Mode.LLM_RESPONDING)
+
+        stall_monitor.stop()
+        window.llm_scheduler.stop()
+        window.search_thread.stop()
+        window.hide()
+        return {**RequestTiming.report(list(timings.values())), "gui_thread": stall_monitor.report()}
+
+    def wait_until(self, condition, timeout: float = REQUEST_TIMEOUT):
+        """run the GUI event loop until condition is met"""
+        loop = QEventLoop()
+        timer = QTimer()
+        timer.setInterval(1)
+        timer.timeout.connect(lambda: condition() and loop.quit())
+        deadline = QTimer()
+        deadline.setSingleShot(True)
+        deadline.timeout.connect(loop.quit)
+        timer.start()
+        deadline.start(int(timeout * 1000))
+        loop.exec()
+        timer.stop()
+
+    def run(self) -> Dict[str, Any]:
+        self.server.start()
+        openai.api_base = self.server.api_base
+        # not saved to user_data/user_setting.json
+        setting.user.update({"OPENAI_API_KEY": "mock", "PROXY": ""})
+        report = {"meta": self.meta(), "stages": {}}
+        with tempfile.TemporaryDirectory() as directory:
+            open_database(Path(directory) / "chat.db")
+            db_manager._create_tables()
+            print("LLMAgent", file=sys.stderr)
+            report["stages"]["LLMAgent"] = self.run_agent()
+            for concurrency in self.concurrency:
+                print(f"ChatWindow, {concurrency} conversations at once", file=sys.stderr)
+                report["stages"][f"ChatWindow(concurrency={concurrency})"] = self.run_chat_window(concurrency)
+            print("CommandWindow", file=sys.stderr)
+            report["stages"]["CommandWindow"] = self.run_command_window()
+            db.close()
+            read_only_db.close()
+        self.server.stop()
+        return report
+
+    def meta(self) -> Dict[str, Any]:
+        try:
+            commit = subprocess.run(
+                ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent
+            ).stdout.strip()
+        except OSError:
+            commit = ""
+        return {
+            "commit": commit,
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "requests": self.requests,
+            "mock_server": vars(self.config),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark streaming LLM replies against a mock server")
+    parser.add_argument("--requests", type=int, default=10, help="requests of every stage")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4],
+                        help="conversations that send messages at once in ChatWindow")
+    parser.add_argument("--reply-tokens", type=int, default=200)
+    parser.add_argument("--chunk-size", type=int, default=1, help="tokens of every streamed chunk")
+    parser.add_argument("--first-token-latency", type=float, default=0.3, help="seconds")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    mock_config = MockLLMConfig(
+        reply_tokens=args.reply_tokens,
+        chunk_size=args.chunk_size,
+        first_token_latency=args.first_token_latency,
+        token_delay=args.token_delay,
+        error_rate=args.error_rate,
+        disconnect_rate=args.disconnect_rate,
+        seed=args.seed,
+    )
+    report = StreamingBenchmark(mock_config, requests=args.requests, concurrency=args.concurrency).run()
+    report_json = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        args.output.write_text(report_json, encoding="utf-8")
+    else:
+        print(report_json)
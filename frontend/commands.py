@@ -1,10 +1,53 @@
+import csv
 from typing import List
 
-from PySide6.QtCore import QTranslator
-from PySide6.QtWidgets import QApplication
+from PySide6.QtCore import QTranslator, QThread, Signal
+from PySide6.QtWidgets import QApplication, QFileDialog
 
 from backend.models import Match
-from frontend.components.form_dialogs import NewPromptFormDialog, LLMConnectionFormDialog
+from backend.tools.prompt_library import import_prompts, export_prompts
+from backend.tools.fuzzy_matcher import fuzzy_match, char_bitmask
+from frontend.components.form_dialogs import NewPromptFormDialog, LLMConnectionFormDialog, MessageDialog
+
+
+class PromptLibraryThread(QThread):
+    """Import or export a prompt library off the GUI thread, since a large library takes a while"""
+
+    FINISHED_SIGNAL = Signal(str, str)  # title and message of the result to show to the user
+
+    def __init__(self, path: str, is_import: bool, parent=None):
+        super().__init__(parent=parent)
+        self.path = path
+        self.is_import = is_import
+
+    def run(self):
+        try:
+            if self.is_import:
+                summary = import_prompts(self.path)
+                title = QTranslator.tr("Prompts imported")
+                message = QTranslator.tr(
+                    "Imported: {imported}\nUpdated: {updated}\n"
+                    "Skipped as duplicated: {duplicated}\nSkipped as invalid: {invalid}"
+                ).format(
+                    imported=summary.imported,
+                    updated=summary.updated,
+                    duplicated=summary.duplicated,
+                    invalid=summary.invalid,
+                )
+            else:
+                title = QTranslator.tr("Prompts exported")
+                message = QTranslator.tr("Exported: {exported}").format(exported=export_prompts(self.path))
+        except (OSError, ValueError, csv.Error) as e:  # json.JSONDecodeError is a ValueError
+            title = QTranslator.tr("Import failed") if self.is_import else QTranslator.tr("Export failed")
+            message = str(e)
+        self.FINISHED_SIGNAL.emit(title, message)
+
+    @staticmethod
+    def start_with_summary(path: str, is_import: bool, parent):
+        thread = PromptLibraryThread(path=path, is_import=is_import, parent=parent)
+        thread.FINISHED_SIGNAL.connect(lambda title, message: MessageDialog(title, message, parent=parent).exec())
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
 
 
 class Command:
@@ -46,6 +89,28 @@ class SetOpenAIKeyCommand(Command):
         dialog.exec()
 
 
+class ImportPromptsCommand(Command):
+    name = "ImportPrompts"
+    display_name = QTranslator.tr("Import Prompts")
+
+    @staticmethod
+    def execute(parent):
+        path, _ = QFileDialog.getOpenFileName(parent, filter="Prompt Library (*.jsonl *.csv)")
+        if path:
+            PromptLibraryThread.start_with_summary(path, is_import=True, parent=parent)
+
+
+class ExportPromptsCommand(Command):
+    name = "ExportPrompts"
+    display_name = QTranslator.tr("Export Prompts")
+
+    @staticmethod
+    def execute(parent):
+        path, _ = QFileDialog.getSaveFileName(parent, filter="JSON Lines (*.jsonl);;CSV (*.csv)")
+        if path:
+            PromptLibraryThread.start_with_summary(path, is_import=False, parent=parent)
+
+
 class QuitApplicationCommand(Command):
     name = "QuitApplication"
     display_name = QTranslator.tr("Quit")
@@ -61,33 +126,27 @@ class CommandManager:
         self.commands = {}
         for command in Command.__subclasses__():
             self.commands[command.name] = command()
+        # key is command name, value is the bitmask of its display name used to prefilter fuzzy matching
+        self.bitmasks = {name: char_bitmask(command.display_name) for name, command in self.commands.items()}
 
     def search(self, search_str: str) -> List[Match]:
-        """Search commands by search_str"""
-        raw_matches = [
-            command for command in self.commands.values() if search_str.lower() in command.display_name.lower()
-        ]
-        # search for commands with initials matching search_str
+        """Search commands by search_str with fuzzy matching, so both consecutive letters and initials work"""
+        matches = []
         for command in self.commands.values():
-            if command in raw_matches:
-                continue
-            command_words = command.display_name.lower().split(" ")
-            if len(command_words) < len(search_str):
+            fuzzy = fuzzy_match(search_str, command.display_name, text_bitmask=self.bitmasks[command.name])
+            if not fuzzy:
                 continue
-            if all(
-                    command_word.startswith(search_char) for search_char, command_word in zip(search_str, command_words)
-            ):
-                raw_matches.append(command)
-        return [
-            Match(
-                source="command",
-                category="command",
-                data=x,
-                match_fields=["display_name"],
-                match_fields_values={"display_name": x.display_name},
+            matches.append(
+                Match(
+                    source="command",
+                    category="command",
+                    data=command,
+                    match_fields=["display_name"],
+                    match_fields_values={"display_name": command.display_name},
+                    match_positions={"display_name": fuzzy.positions},
+                )
             )
-            for x in raw_matches
-        ]
+        return matches
 
     @staticmethod
     def execute_command(command: Command, **kwargs):
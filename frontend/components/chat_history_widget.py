@@ -62,6 +62,18 @@ class ChatHistoryWidget(QWidget):
         self.layout().addWidget(input_widget)
         return input_widget
 
+    def insert_message(self, index, message, avatar_position='right'):
+        """insert a message above the message at index, e.g. an older message at index 0"""
+        input_widget = MessageWidget(message=message, avatar_position=avatar_position)
+        self.layout().insertWidget(index, input_widget)
+        return input_widget
+
+    def clear_messages(self):
+        while self.layout().count():
+            widget = self.layout().takeAt(0).widget()
+            if widget is not None:
+                widget.deleteLater()
+
     def update_content_in_message_widget(self, message_widget, content):
         message_widget.set_message_content(content)
         # self.adjustSize()
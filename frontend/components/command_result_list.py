@@ -1,12 +1,16 @@
+import bisect
+import heapq
 from numbers import Number
-from typing import List, Any, Iterable
+from typing import List, Any, Iterable, Dict, Tuple, Optional, Set
 
-from PySide6.QtCore import Qt, QTranslator, QSize, Signal
+from PySide6.QtCore import Qt, QTranslator, QSize, Signal, QAbstractListModel, QModelIndex
 from PySide6.QtGui import QKeyEvent
-from PySide6.QtWidgets import QListWidgetItem
-from qfluentwidgets import ListWidget
+from PySide6.QtWidgets import QStyleOptionViewItem
+from qfluentwidgets import ListView
+from qfluentwidgets.components.widgets.list_view import ListItemDelegate
 
 from backend.models import Match
+from backend.tools.fuzzy_matcher import fuzzy_match
 from frontend.hotkey_manager import hotkey_manager
 from setting.setting_reader import setting
 
@@ -17,10 +21,10 @@ class TextMatchesSorter:
         """get the shortest text of the field that matches the search string"""
         shortest_value = ""
         for value in values:
-            if not isinstance(value, str):
-                continue
             if isinstance(value, list):
                 value = cls.get_shortest_text_value(value)
+            if not isinstance(value, str) or not value:
+                continue
             if not shortest_value:
                 shortest_value = value
             if len(value) < len(shortest_value):
@@ -30,13 +34,27 @@ class TextMatchesSorter:
     @classmethod
     def score_match(cls, match: Match, search_str: str) -> Number:
         """score a match by the following rules:
-        1. TODO: if search_str matches the initials of words in match, give a higher score
-        2. the shorter the match text, the higher the score
+        1. the fuzzy matching score of search_str against the match text,
+            which favours consecutive letters, initials of words and prefixes
+        2. the shorter the match text, the higher the score. This is at most 1 and only breaks ties of rule 1.
+        """
+        text = cls.get_shortest_text_value(match.match_fields_values.values())
+        if not text:
+            return 0
+        fuzzy = fuzzy_match(search_str, text)
+        return (fuzzy.score if fuzzy else 0) + len(search_str) / max(len(text), len(search_str))
+
+    @classmethod
+    def quick_score_match(cls, match: Match, search_str: str) -> Number:
+        """A cheap estimate of score_match without fuzzy matching, used to pick which matches to score fully.
+        A match text that contains search_str is ranked above one that only matches it as a subsequence,
+        and shorter texts are ranked higher, as in rule 2 of score_match.
         """
         text = cls.get_shortest_text_value(match.match_fields_values.values())
         if not text:
             return 0
-        return len(search_str) / len(text)
+        is_substring = search_str.lower() in text.lower()
+        return is_substring + len(search_str) / max(len(text), len(search_str))
 
     @classmethod
     def sort(cls, matches: List[Match], search_str: str) -> List[Match]:
@@ -44,9 +62,243 @@ class TextMatchesSorter:
         return sorted(matches, key=lambda x: cls.score_match(x, search_str), reverse=True)
 
 
-class CommandResultList(ListWidget):
-    # TODO: replace the parent of CommandResultList to list view and use custom ListItem to customize ui
-    # or use setCellWidget of QTableWidget, or setItemWidget of QListWidget
+class CommandResultModel(QAbstractListModel):
+    """Model of the search result.
+    Fuzzy matching every match would delay the first row, so matches are first kept in a heap of candidates ordered
+    by TextMatchesSorter.quick_score_match. Only as many candidates as rows to load are popped and scored fully, into
+    a heap ordered by their scores, from which rows are loaded. Only BATCH_SIZE rows are loaded at a time,
+    and more are loaded when the view scrolls to the end (see canFetchMore and fetchMore),
+    so the rest of the matches are never scored or sorted. The text of a row is formatted the first time the row is
+    displayed. Matches that arrive later, e.g. from slower sources, are merged into the ranked rows by add_matches.
+    """
+
+    BATCH_SIZE = 50
+
+    def __init__(self, parent=None):
+        super().__init__(parent=parent)
+        self.search_str = ""
+        self.matches: List[Match] = []  # matches that are loaded, in the order they are displayed
+        self._loaded_keys: List[Tuple[Number, int]] = []  # (-score, order) of loaded matches, in ascending order
+        self._pending_matches: List[Tuple[Number, int, Match]] = []  # heap of (-score, order, match) not loaded yet
+        self._candidates: List[Tuple[Number, int, Match]] = []  # heap of (-quick score, order, match) not scored yet
+        self._loaded_target = self.BATCH_SIZE  # number of matches the view has asked for
+        self._next_order = 0  # breaks ties of scores by the order that matches arrive
+        self._display_texts: Dict[int, str] = {}  # key is id of match
+        self._found_ids: Set[Tuple[str, Any]] = set()  # (category, id) of prompts and chat messages in the model
+        self._talk_to_ai_match = Match(category="talk_to_ai")
+        self._is_talk_to_ai_first = False
+
+    def _make_candidate(self, match: Match) -> Tuple[Number, int, Match]:
+        self._next_order += 1
+        return -TextMatchesSorter.quick_score_match(match, self.search_str), self._next_order, match
+
+    def _remove_found_matches(self, matches: List[Match]) -> List[Match]:
+        """the same prompt or chat message may arrive in more than one batch. Only its first match is kept."""
+        new_matches = []
+        for match in matches:
+            if match.category in ("prompt", "chat_message"):
+                if (match.category, match.data.id) in self._found_ids:
+                    continue
+                self._found_ids.add((match.category, match.data.id))
+            new_matches.append(match)
+        return new_matches
+
+    def _score_candidates(self, count: int):
+        """fully score the `count` best candidates, moving them into the heap of pending matches"""
+        for _ in range(min(count, len(self._candidates))):
+            _, order, match = heapq.heappop(self._candidates)
+            score = TextMatchesSorter.score_match(match, self.search_str)
+            heapq.heappush(self._pending_matches, (-score, order, match))
+
+    def set_matches(self, matches: List[Match], search_str: str):
+        self.beginResetModel()
+        self.search_str = search_str
+        self._next_order = 0
+        self._found_ids.clear()
+        self._candidates = [self._make_candidate(match) for match in self._remove_found_matches(matches)]
+        heapq.heapify(self._candidates)
+        self._pending_matches = []
+        self.matches = []
+        self._loaded_keys = []
+        self._loaded_target = self.BATCH_SIZE
+        self._display_texts.clear()
+        self._is_talk_to_ai_first = len(search_str) > 5
+        self._load_batch()
+        self.endResetModel()
+
+    def add_matches(self, matches: List[Match]):
+        """Merge more matches of the same search string into the rows without resetting the view.
+        A match that ranks above a loaded row is inserted at its rank, and the lowest loaded rows are put back into the
+        heap if there are more rows than the view has asked for. Other matches wait in the heap.
+        Matches of prompts or chat messages that are already in the model are left out.
+        """
+        for match in self._remove_found_matches(matches):
+            heapq.heappush(self._candidates, self._make_candidate(match))
+        # at most this many matches can be merged into the loaded rows
+        self._score_candidates(self._loaded_target)
+        while self._pending_matches and (
+                len(self.matches) < self._loaded_target or self._pending_matches[0][:2] < self._loaded_keys[-1]
+        ):
+            negative_score, order, match = heapq.heappop(self._pending_matches)
+            position = bisect.bisect(self._loaded_keys, (negative_score, order))
+            row = self._row_of_position(position)
+            self.beginInsertRows(QModelIndex(), row, row)
+            self._loaded_keys.insert(position, (negative_score, order))
+            self.matches.insert(position, match)
+            self.endInsertRows()
+        while len(self.matches) > self._loaded_target:
+            row = self._row_of_position(len(self.matches) - 1)
+            self.beginRemoveRows(QModelIndex(), row, row)
+            negative_score, order = self._loaded_keys.pop()
+            match = self.matches.pop()
+            self.endRemoveRows()
+            self._display_texts.pop(id(match), None)
+            heapq.heappush(self._pending_matches, (negative_score, order, match))
+
+    def clear(self):
+        self.beginResetModel()
+        self.search_str = ""
+        self.matches = []
+        self._loaded_keys = []
+        self._pending_matches = []
+        self._candidates = []
+        self._display_texts.clear()
+        self._found_ids.clear()
+        self.endResetModel()
+
+    def _load_batch(self) -> int:
+        self._score_candidates(self._loaded_target - len(self.matches))
+        batch_size = min(self._loaded_target - len(self.matches), len(self._pending_matches))
+        for _ in range(batch_size):
+            negative_score, order, match = heapq.heappop(self._pending_matches)
+            key = (negative_score, order)
+            if self._loaded_keys:
+                # a match scored after the loaded rows, which may outscore some of them, is ranked after them,
+                # so rows that are already displayed are not moved
+                key = max(key, self._loaded_keys[-1])
+            self._loaded_keys.append(key)
+            self.matches.append(match)
+        return batch_size
+
+    def _row_of_position(self, position: int) -> int:
+        """row of the view of the match at position of self.matches"""
+        return position + (1 if self._is_talk_to_ai_first else 0)
+
+    def rowCount(self, parent: QModelIndex = QModelIndex()) -> int:
+        if parent.isValid() or not self.search_str:
+            return 0
+        # the last row or the first row is always "Talk to AI"
+        return len(self.matches) + 1
+
+    def canFetchMore(self, parent: QModelIndex) -> bool:
+        return not parent.isValid() and bool(self._pending_matches or self._candidates)
+
+    def fetchMore(self, parent: QModelIndex) -> None:
+        if parent.isValid():
+            return
+        batch_size = min(self.BATCH_SIZE, len(self._pending_matches) + len(self._candidates))
+        # newly loaded matches are inserted before "Talk to AI" if it is the last row
+        first_row = self._row_of_position(len(self.matches))
+        self.beginInsertRows(QModelIndex(), first_row, first_row + batch_size - 1)
+        self._loaded_target = len(self.matches) + batch_size
+        self._load_batch()
+        self.endInsertRows()
+
+    def match_at(self, row: int) -> Optional[Match]:
+        if self._is_talk_to_ai_first:
+            row -= 1
+        if row == -1 or row == len(self.matches):
+            return self._talk_to_ai_match
+        if 0 <= row < len(self.matches):
+            return self.matches[row]
+        return None
+
+    def remove_match(self, match: Match) -> None:
+        position = next((i for i, loaded_match in enumerate(self.matches) if loaded_match is match), None)
+        if position is None:
+            return
+        row = self._row_of_position(position)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.matches[position]
+        del self._loaded_keys[position]
+        self._display_texts.pop(id(match), None)
+        self.endRemoveRows()
+
+    def data(self, index: QModelIndex, role: int = Qt.DisplayRole) -> Any:
+        match = self.match_at(index.row()) if index.isValid() else None
+        if match is None:
+            return None
+        if role == Qt.DisplayRole:
+            if id(match) not in self._display_texts:
+                self._display_texts[id(match)] = self._format_text(match)
+            return self._display_texts[id(match)]
+        if role == Qt.UserRole:
+            return match
+        if role == Qt.FontRole:
+            return setting.default_font
+        return None
+
+    def _format_text(self, match: Match) -> str:
+        text = ""
+        if match.category == "prompt":
+            text += "    " + match.category.capitalize() + "    " + self._format_content(match)
+
+            if hasattr(match.data, "tag_names") and match.data.tag_names:
+                text += "    " + ", ".join(match.data.tag_names)
+        elif match.category == "chat_message":
+            text += "    " + QTranslator.tr("Chat") + "    " + self._format_content(match)
+        elif match.category == "command":
+            text += "    " + "Command" + "    " + match.data.display_name
+        elif match.category == "talk_to_ai":
+            text += "    " + QTranslator.tr("Talk to AI") + "    " + self.search_str
+        return text
+
+    @classmethod
+    def _format_content(cls, match: Match) -> str:
+        """content of a prompt or chat message in a single line, cut off around the first match"""
+        cutoff_text = match.data.content.replace("\n", "\\n")
+        if match.match_positions.get("content"):
+            match_position = match.match_positions["content"][0]
+            center_position = int((match_position[1] - match_position[0]) / 2) + match_position[0]
+            cutoff_text = cls._cutoff_text(cutoff_text, center_position=center_position)
+        return cutoff_text
+
+    @staticmethod
+    def _cutoff_text(text: str, center_position: int) -> str:
+        if len(text) < setting.get("MAXIMUM_DISPLAY_LENGTH_IN_SEARCH_RESULT"):
+            return text
+        half_length = int(setting.get("MAXIMUM_DISPLAY_LENGTH_IN_SEARCH_RESULT") / 2)
+
+        start = max(0, center_position - half_length)
+        end = min(len(text), center_position + half_length)
+        # if one side is shorter than half of the maximum length, then extend the other side
+        if center_position < half_length:
+            end = min(len(text), end + half_length - center_position)
+        if len(text) - center_position < half_length:
+            start = max(0, start - (half_length - (len(text) - center_position)))
+        cutoff_text = text[start:end]
+        if start > 0:
+            cutoff_text = "... " + cutoff_text
+        if end < len(text):
+            cutoff_text = cutoff_text + " ..."
+        return cutoff_text
+
+
+class CommandResultDelegate(ListItemDelegate):
+    """All rows are single lines of the same font, so the size of a row is measured once and reused for every row,
+    instead of laying out the text of each row."""
+
+    def __init__(self, parent: ListView):
+        super().__init__(parent)
+        self._row_size: Optional[QSize] = None
+
+    def sizeHint(self, option: QStyleOptionViewItem, index: QModelIndex) -> QSize:
+        if self._row_size is None:
+            self._row_size = super().sizeHint(option, index)
+        return self._row_size
+
+
+class CommandResultList(ListView):
     GO_BEYOND_START_OF_LIST_SIGNAL = Signal()
 
     def __init__(self, matches: List[Match] = None, search_str: str = "", width=1000, parent=None):
@@ -55,16 +307,23 @@ class CommandResultList(ListWidget):
             Each element is in the form of {"type": "prompt", "data": Prompt(), "match_fields": ["content", "tag"]}
         """
         super().__init__(parent=parent)
-        self.matches = matches if matches else []
-        self.search_str = search_str
+        self.result_model = CommandResultModel(parent=self)
         self.fixed_width = width
         self.setup_ui()
         self.connect_hotkey()
         if matches:
-            self.load_list_items(matches=self.matches, search_str=self.search_str)
+            self.load_list_items(matches=matches, search_str=search_str)
+
+    @property
+    def matches(self) -> List[Match]:
+        return self.result_model.matches
+
+    @property
+    def search_str(self) -> str:
+        return self.result_model.search_str
 
     def keyPressEvent(self, event: QKeyEvent) -> None:
-        if event.key() == Qt.Key_Up and self.currentRow() == 0:
+        if event.key() == Qt.Key_Up and self.currentIndex().row() == 0:
             self.GO_BEYOND_START_OF_LIST_SIGNAL.emit()
         else:
             super().keyPressEvent(event)
@@ -76,77 +335,43 @@ class CommandResultList(ListWidget):
     def setup_ui(self):
         self.setStyleSheet("background-color:white;")
         self.setFont(setting.default_font)
+        self.setItemDelegate(CommandResultDelegate(self))
+        self.setUniformItemSizes(True)
+        self.setModel(self.result_model)
 
     def sizeHint(self) -> QSize:
         """set up proper size of the widget to help parent widget determine its proper size"""
-        height = self.sizeHintForRow(0) * self.count() + 2 * self.frameWidth()
+        height = self.sizeHintForRow(0) * self.result_model.rowCount() + 2 * self.frameWidth()
         return QSize(self.fixed_width, height)
 
     def reset_widget(self) -> None:
-        self.clear()
-        self.matches = []
-        self.search_str = ""
+        self.result_model.clear()
 
     def load_list_items(self, matches: List[Match], search_str: str):
-        self.reset_widget()
-        self.matches = matches
-        self.search_str = search_str
+        self.result_model.set_matches(matches=matches, search_str=search_str)
+        self.setCurrentIndex(self.result_model.index(0))
 
-        for match in TextMatchesSorter.sort(matches=self.matches, search_str=search_str):
-            text = ""
-            if match.source == "database":
-                cutoff_text = match.data.content.replace("\n", "\\n")
-                if match.match_positions.get("content"):
-                    match_position = match.match_positions["content"][0]
-                    center_position = int((match_position[1] - match_position[0]) / 2) + match_position[0]
-                    cutoff_text = self._cutoff_text(cutoff_text, center_position=center_position)
-                text += "    " + match.category.capitalize() + "    " + cutoff_text
-
-                if hasattr(match.data, "tags") and match.data.tags:
-                    text += "    " + ", ".join(match.data.tags)
-            elif match.source == "command":
-                text += "    " + "Command" + "    " + match.data.display_name
-            item = QListWidgetItem(text, self)
-            item.setData(Qt.UserRole, match)
-            item.setFont(setting.default_font)
-
-        talk_to_ai_item = QListWidgetItem("    " + QTranslator.tr("Talk to AI") + "    " + self.search_str)
-        talk_to_ai_item.setData(Qt.UserRole, Match(category="talk_to_ai"))
-        talk_to_ai_item.setFont(setting.default_font)
-        if len(self.search_str) > 5:
-            self.insertItem(0, talk_to_ai_item)
-        else:
-            self.addItem(talk_to_ai_item)
-        self.setCurrentRow(0)
+    def add_list_items(self, matches: List[Match]):
+        """merge matches of the current search string, e.g. from a slower source, into the list"""
+        # the first row stays selected unless the user has moved the selection
+        is_first_row_selected = self.currentIndex().row() <= 0
+        self.result_model.add_matches(matches)
+        if is_first_row_selected:
+            self.setCurrentIndex(self.result_model.index(0))
 
-    @staticmethod
-    def _cutoff_text(text: str, center_position: int) -> str:
-        if len(text) < setting.get("MAXIMUM_DISPLAY_LENGTH_IN_SEARCH_RESULT"):
-            return text
-        half_length = int(setting.get("MAXIMUM_DISPLAY_LENGTH_IN_SEARCH_RESULT") / 2)
-
-        start = max(0, center_position - half_length)
-        end = min(len(text), center_position + half_length)
-        # if one side is shorter than half of the maximum length, then extend the other side
-        if center_position < half_length:
-            end = min(len(text), end + half_length - center_position)
-        if len(text) - center_position < half_length:
-            start = max(0, start - (half_length - (len(text) - center_position)))
-        cutoff_text = text[start:end]
-        if start > 0:
-            cutoff_text = "... " + cutoff_text
-        if end < len(text):
-            cutoff_text = cutoff_text + " ..."
-        return cutoff_text
+    def current_match(self) -> Optional[Match]:
+        index = self.currentIndex()
+        if not index.isValid():
+            return None
+        return self.result_model.match_at(index.row())
 
     def delete_prompt(self):
         if not self.hasFocus():
             return
-        item = self.currentItem()
-        match = item.data(Qt.UserRole)
-        if not match.category == "prompt":
+        match = self.current_match()
+        if not match or not match.category == "prompt":
             return
         match.data.delete_instance()
-        self.takeItem(self.currentRow())
-        self.matches.remove(match)
+        self.result_model.remove_match(match)
+        self.updateSelectedRows()
         self.update()
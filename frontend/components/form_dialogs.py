@@ -1,7 +1,7 @@
 import webbrowser
 
 from PySide6.QtCore import QTranslator, Signal
-from PySide6.QtWidgets import QWidget, QVBoxLayout, QGroupBox, QFormLayout, QLabel
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QGroupBox, QFormLayout, QLabel, QProgressBar
 from qfluentwidgets import PlainTextEdit, LineEdit
 
 from backend.tools.database import Prompt
@@ -153,6 +153,55 @@ class StringTemplateFillingDialog(FormDialog):
             super().accept()
 
 
+class MessageDialog(FormDialog):
+    """show a message to the user, e.g. the result of a task that runs in the background"""
+
+    def __init__(self, title: str, message: str, parent=None):
+        self.message = message
+        super().__init__(title=title, accept_text=QTranslator.tr("OK"), parent=parent)
+        self.cancel_button.hide()
+
+    def setup_central_layout(self):
+        self.setFont(setting.default_font)
+        self.central_layout.addWidget(Label(text=self.message))
+
+
+class MigrationProgressDialog(FormDialog):
+    """show the progress of upgrading the database. It is modal, so prompts are not edited during the upgrade."""
+
+    def __init__(self, parent=None):
+        self.description_label = Label(text=QTranslator.tr("Upgrading the database..."))
+        self.progress_bar = QProgressBar()
+        self.is_finished = False
+        super().__init__(title=QTranslator.tr("Upgrading Database"), size=(400, 120), parent=parent)
+        self.button_box.hide()
+        self.setModal(True)
+
+    def setup_central_layout(self):
+        self.setFont(setting.default_font)
+        self.progress_bar.setRange(0, 0)  # busy until the first progress is reported
+        self.central_layout.addWidget(self.description_label)
+        self.central_layout.addWidget(self.progress_bar)
+
+    def update_progress(self, description: str, done: int, total: int):
+        self.description_label.setText(f"{description}: {done}/{total}")
+        self.progress_bar.setRange(0, max(total, 1))
+        self.progress_bar.setValue(done)
+
+    def finish(self):
+        self.is_finished = True
+        self.accept()
+
+    def accept(self) -> None:
+        # the upgrade cannot be cancelled
+        if self.is_finished:
+            super().accept()
+
+    def reject(self) -> None:
+        if self.is_finished:
+            super().reject()
+
+
 class NewVersionAvailableDialog(FormDialog):
     def __init__(self, parent=None):
         super().__init__(title=QTranslator.tr("New version available"),
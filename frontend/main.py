@@ -1,16 +1,25 @@
 import sys
 from pathlib import Path
+from typing import Optional
 
+from PySide6.QtCore import QTranslator
 from PySide6.QtWidgets import QApplication
 
+from backend.tools.llm_client import llm_client
 from frontend.windows.chat_window import ChatWindow
 from setting.setting_reader import setting
 
 if str(Path(__file__).parent) not in sys.path:
     sys.path.append(str(Path(__file__).parent))
 
-from frontend.utils import NewVersionChecker
-from frontend.components.form_dialogs import NewVersionAvailableDialog, LLMConnectionFormDialog
+from backend.tools.database import db_manager
+from frontend.utils import NewVersionChecker, DatabaseMigrator
+from frontend.components.form_dialogs import (
+    NewVersionAvailableDialog,
+    LLMConnectionFormDialog,
+    MigrationProgressDialog,
+    MessageDialog,
+)
 from frontend.hotkey_manager import HotkeyManager
 
 new_version_checker = NewVersionChecker()
@@ -26,6 +35,24 @@ class MyApp(QApplication):
         # self.search_window.show()
         self.chat_window.show()
         # self.chat_window.chat_text_edit.setFocus()
+        self.database_migrator = DatabaseMigrator()
+        self.migration_progress_dialog: Optional[MigrationProgressDialog] = None
+        self.migrate_database()
+
+    def migrate_database(self):
+        """upgrade the database in a worker thread once the window is shown, since it is slow for large libraries"""
+        if not db_manager.is_migration_pending:
+            return
+        self.migration_progress_dialog = MigrationProgressDialog(parent=self.chat_window)
+        self.database_migrator.PROGRESS_SIGNAL.connect(self.migration_progress_dialog.update_progress)
+        self.database_migrator.FAILED_SIGNAL.connect(
+            lambda error: MessageDialog(
+                title=QTranslator.tr("Failed to upgrade the database"), message=error, parent=self.chat_window
+            ).exec()
+        )
+        self.database_migrator.finished.connect(self.migration_progress_dialog.finish)
+        self.migration_progress_dialog.show()
+        self.database_migrator.start()
 
     @staticmethod
     def initial_checks():
@@ -39,6 +66,7 @@ class MyApp(QApplication):
 
 app = MyApp([])
 app.setQuitOnLastWindowClosed(False)
+app.aboutToQuit.connect(llm_client.close)
 new_version_checker.NEW_VERSION_AVAILABLE.connect(app.show_new_version_dialog)
 
 new_version_checker.start()
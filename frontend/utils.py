@@ -2,8 +2,11 @@ import re
 from urllib import request
 from urllib.error import URLError
 
+import peewee as pw
 from PySide6.QtCore import QThread, Signal
 
+from backend.tools.database import db_manager, MigrationProgress
+from backend.tools.utils import logger
 from frontend import version
 
 
@@ -45,3 +48,21 @@ class NewVersionChecker(QThread):
             return
         if self.check_new_version_available(remote_version=remote_version, local_version=version):
             self.NEW_VERSION_AVAILABLE.emit(remote_version)
+
+
+class DatabaseMigrator(QThread):
+    """upgrade a database created by an older version of ProPal, without blocking the GUI thread"""
+
+    PROGRESS_SIGNAL = Signal(str, int, int)  # description of the running migration, rows done, rows in total
+    FAILED_SIGNAL = Signal(str)
+
+    def report_progress(self, progress: MigrationProgress):
+        self.PROGRESS_SIGNAL.emit(progress.description, progress.done, progress.total)
+
+    def run(self):
+        try:
+            db_manager.migrate(progress_callback=self.report_progress)
+        except pw.PeeweeException as e:
+            # an interrupted migration resumes from its last batch the next time ProPal starts
+            logger.exception(f"Failed to migrate the database: {e}")
+            self.FAILED_SIGNAL.emit(str(e))
@@ -1,9 +1,20 @@
-from PySide6.QtCore import Qt, QThread, Signal
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Optional
+
+from PySide6.QtCore import Qt, QThread, Signal, QObject, QTranslator
 from PySide6.QtGui import QMouseEvent
 from PySide6.QtWidgets import QWidget
 
 from backend.agents.llm_agent import LLMResult
+from backend.agents.retriever_agent import RetrieverResult
+from backend.models import Error
 from backend.tools.utils import logger
+from setting.setting_reader import setting
+
+# default of the setting MAX_CONCURRENT_LLM_REQUESTS. More requests are queued.
+DEFAULT_MAX_CONCURRENT_LLM_REQUESTS = 4
 
 
 class FramelessWindow(QWidget):
@@ -27,39 +38,165 @@ class FramelessWindow(QWidget):
             event.accept()
 
 
-class LLMRequestThread(QThread):
-    content_received = Signal(str)
-    result_received = Signal(LLMResult)
+class LLMRequestScheduler(QObject):
+    """Run LLM requests in a bounded pool of worker threads, so several replies are streamed at once.
+    Every request gets an id, which comes with its chunks and its result. Requests beyond max_workers are queued.
+    A request can be cancelled while queued, or stopped while its reply is streamed, see cancel.
+    """
+
+    content_received = Signal(str, str)  # request id, reply so far
+    result_received = Signal(str, LLMResult)  # request id, result. It is the last signal of a request.
 
-    def __init__(self, llm_agent, user_input: str = ""):
+    def __init__(self, llm_agent, max_workers: Optional[int] = None):
         super().__init__()
         self.llm_agent = llm_agent
-        self.user_input = user_input
+        max_workers = max_workers or setting.get("MAX_CONCURRENT_LLM_REQUESTS", DEFAULT_MAX_CONCURRENT_LLM_REQUESTS)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="LLMRequest")
+        self._futures: Dict[str, Future] = {}  # requests that are queued or running
+        self._stop_events: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, trigger_attrs: Dict) -> str:
+        """queue a request with trigger_attrs of LLMAgent, returning its id"""
+        request_id = uuid.uuid4().hex
+        with self._lock:
+            self._stop_events[request_id] = threading.Event()
+            self._futures[request_id] = self.executor.submit(self._run, request_id, trigger_attrs)
+        return request_id
+
+    def cancel(self, request_id: str):
+        """Drop the request if it is queued, or stop streaming its reply if it is running.
+        Either way, its result is still received: a dropped request fails with Error.CANCELLED,
+        and a stopped request succeeds with the reply received so far.
+        """
+        with self._lock:
+            future = self._futures.get(request_id)
+            if future is None:
+                return
+            self._stop_events[request_id].set()
+            is_dropped = future.cancel()
+            if is_dropped:
+                self._forget(request_id)
+        if is_dropped:
+            self.result_received.emit(
+                request_id,
+                LLMResult(trigger=None, success=False, error=Error.CANCELLED,
+                          error_message=QTranslator.tr("Request cancelled.")),
+            )
+
+    def is_pending(self, request_id: Optional[str]) -> bool:
+        """whether the request is queued or running"""
+        with self._lock:
+            return request_id in self._futures
+
+    def stop(self):
+        """cancel all requests, e.g. when the application quits"""
+        with self._lock:
+            request_ids = list(self._futures)
+        for request_id in request_ids:
+            self.cancel(request_id)
+        self.executor.shutdown(wait=False)
+
+    def _forget(self, request_id: str):
+        self._futures.pop(request_id, None)
+        self._stop_events.pop(request_id, None)
+
+    def _run(self, request_id: str, trigger_attrs: Dict):
+        stop_event = self._stop_events[request_id]
+        try:
+            response = self.llm_agent.act(trigger_attrs=trigger_attrs)
+            chunk = response if isinstance(response, LLMResult) else next(response)
+            while True:
+                if isinstance(chunk, LLMResult):
+                    self.result_received.emit(request_id, chunk)
+                    break
+                self.content_received.emit(request_id, chunk)
+                # a stopped response yields its result right away
+                chunk = response.send("STOP") if stop_event.is_set() else next(response)
+        except StopIteration:
+            pass
+        except Exception as e:
+            logger.error(f"error when receiving response from llm agent: {e}")
+            self.result_received.emit(
+                request_id, LLMResult(trigger=None, success=False, error=Error.UNKNOWN, error_message=str(e))
+            )
+        finally:
+            with self._lock:
+                self._forget(request_id)
+
+
+class SearchThread(QThread):
+    """Run searches off the GUI thread.
+    Every submitted search string gets a generation number. Only the newest one is searched: a search string that is
+    superseded before it starts is dropped, and one that is superseded while running is cancelled while its sources are
+    being waited for.
+    """
+
+    # generation, search string, new matches of a source. Batches of the same search string come before its result.
+    batch_received = Signal(int, str, list)
+    result_received = Signal(int, str, RetrieverResult)  # generation, search string, result with all matches
+
+    def __init__(self, retriever_agent):
+        super().__init__()
+        self.retriever_agent = retriever_agent
+        self.generation = 0  # generation of the newest submitted search string
+        self._pending_search_str = None  # the newest search string that is not started yet
+        self._condition = threading.Condition()
         self.stop_flag = False  # whether to stop the thread
 
+    def submit(self, search_str: str) -> int:
+        """search search_str in the thread and return its generation"""
+        with self._condition:
+            self.generation += 1
+            self._pending_search_str = search_str
+            self._condition.notify()
+        if not self.isRunning():
+            self.start()
+        return self.generation
+
+    def cancel(self):
+        """drop the pending search and cancel the running one"""
+        with self._condition:
+            self.generation += 1
+            self._pending_search_str = None
+
+    def is_stale(self, generation: int) -> bool:
+        return generation != self.generation
+
+    def stop(self):
+        with self._condition:
+            self.stop_flag = True
+            self._condition.notify()
+        self.wait()
+
     def run(self):
-        response = self.llm_agent.act(trigger_attrs={"user_input": self.user_input})
         while True:
-            if self.stop_flag:
-                llm_result = response.send("STOP")  # stop streaming response
-                self.result_received.emit(llm_result)
-                self.reset()
-                break
+            with self._condition:
+                while self._pending_search_str is None and not self.stop_flag:
+                    self._condition.wait()
+                if self.stop_flag:
+                    break
+                generation, search_str = self.generation, self._pending_search_str
+                self._pending_search_str = None
 
+            result = None
             try:
-                chunk = next(response)
-                if isinstance(chunk, str):
-                    self.content_received.emit(chunk)
-                elif isinstance(chunk, LLMResult):
-                    self.result_received.emit(chunk)
-            except StopIteration:
-                self.reset()
-                break
+                response = self.retriever_agent.act(
+                    trigger_attrs={
+                        "content": search_str,
+                        "is_cancelled": lambda: self.is_stale(generation),
+                        "stream": True,
+                    }
+                )
+                for chunk in response:
+                    if self.is_stale(generation):
+                        break
+                    if isinstance(chunk, RetrieverResult):
+                        result = chunk
+                    else:
+                        self.batch_received.emit(generation, search_str, chunk)
             except Exception as e:
-                logger.error(f"error when receiving response from llm agent: {e}")
-                raise e
-
-    def reset(self):
-        """restore the thread to initial state"""
-        self.stop_flag = False
-        self.user_input = ""
+                logger.error(f"error when searching {search_str}: {e}")
+                continue
+            if result is not None and result.success and not self.is_stale(generation):
+                self.result_received.emit(generation, search_str, result)
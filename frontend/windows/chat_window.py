@@ -1,43 +1,61 @@
 import re
+from typing import Optional, Dict
 
-from PySide6.QtCore import Qt
-from PySide6.QtWidgets import QHBoxLayout, QWidget, QSizePolicy, QListWidget, QVBoxLayout
-from qfluentwidgets import ScrollArea
+from PySide6.QtCore import Qt, QTranslator
+from PySide6.QtWidgets import (
+    QHBoxLayout, QWidget, QSizePolicy, QListWidget, QVBoxLayout, QListWidgetItem, QApplication
+)
+from qfluentwidgets import ScrollArea, PushButton
 
 from backend.agents.llm_agent import LLMAgent, LLMResult
+from backend.tools.database import Conversation, ChatMessage, CHAT_PAGE_SIZE, CONVERSATION_PAGE_SIZE
 from frontend.components.chat_history_widget import ChatHistoryWidget
 from frontend.components.chat_text_edit import ChatTextEdit
-from frontend.windows.base import LLMRequestThread
+from frontend.windows.base import LLMRequestScheduler
 
 
 class ChatWindow(QWidget):
     WIDTH = 1000
     HEIGHT = 750
+    TITLE_LENGTH = 50  # a new conversation is titled with the beginning of its first message
 
     def __init__(self):
         super().__init__()
         self.global_layout = QHBoxLayout(self)
         self.left_panel = ScrollArea()
+        self.new_conversation_button = PushButton(QTranslator.tr("New chat"))
         self.conversation_list = QListWidget()
         self.right_panel = QWidget()
+        self.chat_history_area = ScrollArea()  # scrolls chat history widget
         self.chat_history_widget = ChatHistoryWidget()
         self.chat_text_edit = ChatTextEdit()
-        self.llm_thread = LLMRequestThread(llm_agent=LLMAgent())
+        self.llm_scheduler = LLMRequestScheduler(llm_agent=LLMAgent())
 
         # key is conversation id, value is the latest message widget of that conversation
         self.conversations_latest_message_widgets = {}
-        self.active_conversation_id = None
+        self.active_conversation_id = None  # None for a new conversation, which is saved with its first message
+        # key is the id of a request to the AI, value is the conversation whose latest message is being answered.
+        # Several conversations can be answered at once, but a conversation waits for its answer before a new message.
+        self.responding_conversations = {}
+        self.partial_responses: Dict[str, str] = {}  # key is request id, value is the reply received so far
+        # conversations and messages are loaded a page at a time. These are the cursors of the next pages.
+        self.last_loaded_conversation: Optional[Conversation] = None
+        self.has_more_conversations = False
+        self.oldest_loaded_message: Optional[ChatMessage] = None
+        self.has_older_messages = False
+        # when older messages are inserted above, the distance from the bottom of the chat history is kept
+        self._scroll_anchor: Optional[int] = None
+        self._is_scrolled_to_bottom = True  # new messages are followed if the chat history is scrolled to the bottom
         self._test_ui()
         self.setup_ui()
         self.connect_signals()
+        self.load_conversations()
         self.chat_text_edit.setFocus()
 
     def _test_ui(self):
         """TODO: DELETE THIS AFTER DEVELOPMENT"""
         self.left_panel.setStyleSheet('background-color: lightblue;')
         self.conversation_list.setStyleSheet('background-color: yellow;')
-        self.conversation_list.addItem('test')
-        self.active_conversation_id = '0'
 
     def setup_ui(self):
         self.global_layout.setSpacing(0)
@@ -45,13 +63,22 @@ class ChatWindow(QWidget):
         self.global_layout.addWidget(self.left_panel)
         self.global_layout.addWidget(self.right_panel)
 
-        self.left_panel.setWidget(self.conversation_list)
+        left_panel_widget = QWidget()
+        left_panel_layout = QVBoxLayout(left_panel_widget)
+        left_panel_layout.addWidget(self.new_conversation_button)
+        left_panel_layout.addWidget(self.conversation_list)
+        self.left_panel.setWidget(left_panel_widget)
+        self.left_panel.setWidgetResizable(True)
         self.left_panel.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.left_panel.setFixedWidth(200)
         self.conversation_list.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
 
+        self.chat_history_area.setWidget(self.chat_history_widget)
+        self.chat_history_area.setWidgetResizable(True)
+        self.chat_history_area.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+
         right_panel_layout = QVBoxLayout()
-        right_panel_layout.addWidget(self.chat_history_widget)
+        right_panel_layout.addWidget(self.chat_history_area)
         right_panel_layout.addWidget(self.chat_text_edit)
         self.right_panel.setLayout(right_panel_layout)
 
@@ -61,28 +88,170 @@ class ChatWindow(QWidget):
 
     def connect_signals(self):
         self.chat_text_edit.MESSAGE_WRITTEN_SIGNAL.connect(self.send_message)
-        self.llm_thread.content_received.connect(self.update_ai_response)
-        self.llm_thread.result_received.connect(self.update_ai_response)
+        self.llm_scheduler.content_received.connect(self.update_ai_response)
+        self.llm_scheduler.result_received.connect(self.update_ai_response)
+        QApplication.instance().aboutToQuit.connect(self.llm_scheduler.stop)
+        self.new_conversation_button.clicked.connect(self.start_new_conversation)
+        self.conversation_list.itemClicked.connect(
+            lambda item: self.open_conversation(item.data(Qt.UserRole))
+        )
+        self.conversation_list.verticalScrollBar().valueChanged.connect(self._load_more_conversations_at_bottom)
+        self.chat_history_area.verticalScrollBar().valueChanged.connect(self._load_older_messages_at_top)
+        self.chat_history_area.verticalScrollBar().rangeChanged.connect(self._keep_scroll_position)
+
+    def load_conversations(self):
+        """append the next page of conversations to the list of conversations"""
+        conversations = Conversation.select_page(before=self.last_loaded_conversation)
+        self.has_more_conversations = len(conversations) == CONVERSATION_PAGE_SIZE
+        if conversations:
+            self.last_loaded_conversation = conversations[-1]
+        for conversation in conversations:
+            self.conversation_list.addItem(self._create_conversation_item(conversation))
+
+    @staticmethod
+    def _create_conversation_item(conversation: Conversation) -> QListWidgetItem:
+        item = QListWidgetItem(conversation.title)
+        item.setData(Qt.UserRole, conversation.id)
+        return item
+
+    def _load_more_conversations_at_bottom(self, value: int):
+        if self.has_more_conversations and value == self.conversation_list.verticalScrollBar().maximum():
+            self.load_conversations()
+
+    def _move_conversation_to_top(self, conversation_id):
+        """move the conversation to the top of the list after a new message, as ordered by Conversation.updated_at"""
+        for row in range(self.conversation_list.count()):
+            if self.conversation_list.item(row).data(Qt.UserRole) == conversation_id:
+                item = self.conversation_list.takeItem(row)
+                break
+        else:
+            # the conversation is on a page that is not loaded yet
+            item = self._create_conversation_item(Conversation.get_by_id(conversation_id))
+        self.conversation_list.insertItem(0, item)
+        self.conversation_list.setCurrentItem(item)
+
+    def start_new_conversation(self):
+        self.active_conversation_id = None
+        self._clear_chat_history()
+        self.conversation_list.clearSelection()
+        self.chat_text_edit.setFocus()
+
+    def open_conversation(self, conversation_id):
+        """show the newest page of messages of the conversation. Older pages are loaded when scrolling up."""
+        self.active_conversation_id = conversation_id
+        self._clear_chat_history()
+        messages = ChatMessage.select_page(conversation_id)
+        self.has_older_messages = len(messages) == CHAT_PAGE_SIZE
+        self.oldest_loaded_message = messages[0] if messages else None
+        for message in messages:
+            self._add_message_widget(message)
+        request_id = self._request_of_conversation(conversation_id)
+        if request_id is not None:
+            # the AI is still answering the latest message
+            response_widget = self.chat_history_widget.add_message(
+                self.partial_responses.get(request_id, '...'), avatar_position='left'
+            )
+            self.conversations_latest_message_widgets[conversation_id] = response_widget
+        self.chat_text_edit.setFocus()
+
+    def _request_of_conversation(self, conversation_id) -> Optional[str]:
+        """the request that is answering the latest message of the conversation"""
+        for request_id, responding_conversation_id in self.responding_conversations.items():
+            if responding_conversation_id == conversation_id:
+                return request_id
+        return None
+
+    def _clear_chat_history(self):
+        self.chat_history_widget.clear_messages()
+        self.conversations_latest_message_widgets.clear()  # the widgets are deleted
+        self.oldest_loaded_message = None
+        self.has_older_messages = False
+        self._scroll_anchor = None
+        self._is_scrolled_to_bottom = True
+
+    def _add_message_widget(self, message: ChatMessage, index: Optional[int] = None):
+        if message.role == "user":
+            content, avatar_position = self._convert_single_to_double_line_breaks(message.content), 'right'
+        else:
+            content, avatar_position = message.content, 'left'
+        if index is None:
+            return self.chat_history_widget.add_message(content, avatar_position=avatar_position)
+        return self.chat_history_widget.insert_message(index, content, avatar_position=avatar_position)
+
+    def load_older_messages(self):
+        messages = ChatMessage.select_page(self.active_conversation_id, before=self.oldest_loaded_message)
+        self.has_older_messages = len(messages) == CHAT_PAGE_SIZE
+        if not messages:
+            return
+        self.oldest_loaded_message = messages[0]
+        scrollbar = self.chat_history_area.verticalScrollBar()
+        self._scroll_anchor = scrollbar.maximum() - scrollbar.value()
+        for index, message in enumerate(messages):
+            self._add_message_widget(message, index=index)
+
+    def _load_older_messages_at_top(self, value: int):
+        scrollbar = self.chat_history_area.verticalScrollBar()
+        self._is_scrolled_to_bottom = value == scrollbar.maximum()
+        if self.has_older_messages and self._scroll_anchor is None and value == scrollbar.minimum():
+            self.load_older_messages()
+
+    def _keep_scroll_position(self, minimum: int, maximum: int):
+        """the range of the scrollbar changes after messages are inserted or a response grows"""
+        scrollbar = self.chat_history_area.verticalScrollBar()
+        if self._scroll_anchor is not None:
+            scrollbar.setValue(maximum - self._scroll_anchor)
+            self._scroll_anchor = None
+        elif self._is_scrolled_to_bottom:
+            scrollbar.setValue(maximum)
 
     def send_message(self, message: str):
+        if self.active_conversation_id is not None and self._request_of_conversation(self.active_conversation_id):
+            # the AI is still answering this conversation. Give the message back so that it can be sent later.
+            self.chat_text_edit.setPlainText(message)
+            return
+        if self.active_conversation_id is None:
+            conversation = Conversation.create(title=message.strip().split("\n")[0][:self.TITLE_LENGTH])
+            self.active_conversation_id = conversation.id
+        # the history is read before the message is saved, since the message is sent as the input of the trigger
+        history = ChatMessage.get_history(self.active_conversation_id)
+        ChatMessage.create(conversation=self.active_conversation_id, role="user", content=message)
+        self._move_conversation_to_top(self.active_conversation_id)
+
         self.chat_history_widget.add_message(self._convert_single_to_double_line_breaks(message),
                                              avatar_position='right')
         response_widget = self.chat_history_widget.add_message('...', avatar_position='left')
         self.conversations_latest_message_widgets[self.active_conversation_id] = response_widget
-        self.llm_thread.user_input = message
-        self.llm_thread.start()
+        request_id = self.llm_scheduler.submit(
+            trigger_attrs={
+                "user_input": message,
+                "conversation_id": str(self.active_conversation_id),
+                "history": history,
+            }
+        )
+        self.responding_conversations[request_id] = self.active_conversation_id
 
-    def update_ai_response(self, response: str | LLMResult):
-        response_widget = self.conversations_latest_message_widgets[self.active_conversation_id]
+    def update_ai_response(self, request_id: str, response: str | LLMResult):
+        conversation_id = self.responding_conversations.get(request_id)
+        if conversation_id is None:
+            return
+        # None if another conversation is displayed
+        response_widget = self.conversations_latest_message_widgets.get(conversation_id)
         if isinstance(response, str):
+            self.partial_responses[request_id] = response
+            if response_widget is None:
+                return
             response_widget.set_message_content(response)
             response_widget.adjustSize()
             response_widget.update()
             response_widget.repaint()
         elif isinstance(response, LLMResult):
-            if not response.success:
+            if response.success and response.content:
+                ChatMessage.create(conversation=conversation_id, role="assistant", content=response.content)
+            elif not response.success and response_widget is not None:
                 response_widget.set_message_content(response.error_message)
-            self.conversations_latest_message_widgets.pop(self.active_conversation_id)
+            self.conversations_latest_message_widgets.pop(conversation_id, None)
+            self.responding_conversations.pop(request_id)
+            self.partial_responses.pop(request_id, None)
         else:
             raise ValueError(f"Unknown type of chunk: {type(response)}")
 
@@ -1,15 +1,15 @@
 from enum import Enum
-from typing import Optional
+from typing import Optional, List
 
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QTimer
 from PySide6.QtGui import QHideEvent, QTextCursor
 from PySide6.QtWidgets import QHBoxLayout, QLabel, QApplication, QWidget, QVBoxLayout, QScrollArea
 from qframelesswindow import FramelessWindow
 
 from backend.agents.llm_agent import LLMAgent, LLMResult
-from backend.agents.retriever_agent import RetrieverAgent
+from backend.agents.retriever_agent import RetrieverAgent, RetrieverResult
 from backend.models import Match
-from backend.tools.database import Prompt
+from backend.tools.database import Prompt, ChatMessage
 from frontend.commands import Command
 from frontend.components.command_result_list import CommandResultList
 # from frontend.windows.base import FramelessWindow
@@ -18,7 +18,7 @@ from frontend.components.form_dialogs import StringTemplateFillingDialog
 from frontend.components.llm_response_commands import LLMResponseDialog
 from frontend.components.short_text_viewer import ShortTextViewer
 from frontend.hotkey_manager import hotkey_manager
-from frontend.windows.base import LLMRequestThread
+from frontend.windows.base import LLMRequestScheduler, SearchThread
 from setting.setting_reader import setting
 
 
@@ -41,8 +41,15 @@ class CommandWindow(FramelessWindow):
         self.result_list = CommandResultList(width=self.WIDTH)  # contains search result
         self.text_viewer = ShortTextViewer()  # contains ai response
         self.result_container = QScrollArea()  # contains search result, ai response, etc.
-        self.llm_thread = LLMRequestThread(llm_agent=LLMAgent())
+        self.llm_scheduler = LLMRequestScheduler(llm_agent=LLMAgent(), max_workers=1)
+        self.llm_request_id: Optional[str] = None  # the request whose reply is displayed in text viewer
         self.retriever_agent = RetrieverAgent()
+        self.search_thread = SearchThread(retriever_agent=self.retriever_agent)
+        self.displayed_search_generation = 0  # generation of the search whose matches are in the result list
+        # searching starts only after the user stops typing for a while
+        self.search_debounce_timer = QTimer()
+        self.search_debounce_timer.setSingleShot(True)
+        self.search_debounce_timer.setInterval(setting.get("SEARCH_DEBOUNCE_INTERVAL", 80))
 
         self.result_container_maximum_height = QApplication.instance().primaryScreen().size().height() * 0.5
         self.input_container_maximum_height = QApplication.instance().primaryScreen().size().height() * 0.25
@@ -80,14 +87,20 @@ class CommandWindow(FramelessWindow):
         self.text_edit.GO_BEYOND_END_OF_DOCUMENT_SIGNAL.connect(
             lambda: self._move_focus(from_widget=self.text_edit, to_widget=self.result_container)
         )
-        self.text_edit.textChanged.connect(self._search)
+        self.text_edit.textChanged.connect(self._schedule_search)
+        self.search_debounce_timer.timeout.connect(self._search)
+        self.search_thread.batch_received.connect(self._load_search_batch)
+        self.search_thread.result_received.connect(self._load_search_result)
+        QApplication.instance().aboutToQuit.connect(self.search_thread.stop)
+        QApplication.instance().aboutToQuit.connect(self.retriever_agent.close)
         self.text_edit.textChanged.connect(self._adjust_input_container_height)
         self.result_list.GO_BEYOND_START_OF_LIST_SIGNAL.connect(
             lambda: self._move_focus(from_widget=self.result_list, to_widget=self.text_edit)
         )
-        self.result_list.itemActivated.connect(self._execute_search_selection)
-        self.llm_thread.content_received.connect(self._update_ai_response)
-        self.llm_thread.result_received.connect(self._update_ai_response)
+        self.result_list.activated.connect(self._execute_search_selection)
+        self.llm_scheduler.content_received.connect(self._update_ai_response)
+        self.llm_scheduler.result_received.connect(self._update_ai_response)
+        QApplication.instance().aboutToQuit.connect(self.llm_scheduler.stop)
 
     def toggle_visibility(self):
         if self.isVisible():
@@ -97,6 +110,7 @@ class CommandWindow(FramelessWindow):
             self.show()
 
     def reset_widget(self):
+        self._cancel_search()
         self.text_edit.reset_widget()
         self.text_viewer.reset_widget()
         self.result_list.reset_widget()
@@ -167,10 +181,10 @@ class CommandWindow(FramelessWindow):
                     getattr(widget, f"enter_{to.value}_mode")()
         else:
             if self.mode == Mode.LLM_RESPONDING:
-                if self.llm_thread.isRunning():
+                if self.llm_scheduler.is_pending(self.llm_request_id):
                     # stop the llm if it is running
-                    self.llm_thread.stop_flag = True
                     self._switch_mode(to=Mode.TALK)
+                    self.llm_scheduler.cancel(self.llm_request_id)
             # the user is reading the response from llm, switch focus to text edit when user presses esc
             elif self.mode == Mode.SEARCH and isinstance(self.result_container.widget(), ShortTextViewer):
                 self._move_focus(from_widget=self.result_container.widget(), to_widget=self.text_edit)
@@ -217,8 +231,12 @@ class CommandWindow(FramelessWindow):
         text = self.text_edit.toPlainText()
         if text.strip() == "":
             return
-        selected_item = self.result_container.widget().selectedItems()[0]
-        match: Match = selected_item.data(Qt.UserRole)
+        if self.result_list.search_str != text:
+            # the user confirms before the search result arrives
+            self._flush_search()
+        match: Optional[Match] = self.result_list.current_match()
+        if match is None:
+            return
         if match.category == "talk_to_ai":
             self._switch_mode(to=Mode.TALK)
             self._talk_to_ai()
@@ -230,6 +248,9 @@ class CommandWindow(FramelessWindow):
                 dialog.exec()
             else:
                 self._wait_for_talking_to_ai(prompt.content)
+        elif match.category == "chat_message":
+            message: ChatMessage = match.data
+            self._wait_for_talking_to_ai(message.content)
         elif match.category == "command":
             command: Command = match.data
             command.execute(parent=self)
@@ -246,10 +267,14 @@ class CommandWindow(FramelessWindow):
         text = self.text_edit.toPlainText()
         self.set_widget_in_result_container(self.text_viewer, allow_horizontal_scrollbar=True)
         self._switch_mode(to=Mode.LLM_RESPONDING)
-        self.llm_thread.user_input = text
-        self.llm_thread.start()
+        previous_request_id = self.llm_request_id
+        self.llm_request_id = self.llm_scheduler.submit(trigger_attrs={"user_input": text})
+        # only one reply is displayed at a time
+        self.llm_scheduler.cancel(previous_request_id)
 
-    def _update_ai_response(self, response: str | LLMResult):
+    def _update_ai_response(self, request_id: str, response: str | LLMResult):
+        if request_id != self.llm_request_id:  # the reply of a cancelled request
+            return
         if isinstance(response, str):
             self.text_viewer.set_text(response)
             self.result_container.setFixedSize(
@@ -272,14 +297,56 @@ class CommandWindow(FramelessWindow):
         # keep the scroll bar always at the end
         self.result_container.verticalScrollBar().setValue(self.result_container.verticalScrollBar().maximum())
 
-    def _search(self):
+    def _schedule_search(self):
         text = self.text_edit.toPlainText()
         if text.strip() == "":
+            self._cancel_search()
             if self.mode != Mode.SEARCH:
                 self._switch_mode(to=Mode.SEARCH)
             self.set_widget_in_result_container(widget=None)
             return
+        # the user is talking to AI, there is no need to search
+        if self.mode != Mode.SEARCH:
+            self._cancel_search()
+            return
+        self.search_debounce_timer.start()
+
+    def _cancel_search(self):
+        self.search_debounce_timer.stop()
+        self.search_thread.cancel()
+
+    def _search(self):
+        text = self.text_edit.toPlainText()
+        if text.strip() == "" or self.mode != Mode.SEARCH:
+            return
+        self.search_thread.submit(text)
+
+    def _flush_search(self):
+        """search the current text right away on the GUI thread"""
+        self._cancel_search()
+        text = self.text_edit.toPlainText()
         result = self.retriever_agent.act(trigger_attrs={"content": text})
-        self.result_list.load_list_items(matches=result.content, search_str=text)
+        self._load_search_result(generation=self.search_thread.generation, search_str=text, result=result)
+
+    def _load_search_batch(self, generation: int, search_str: str, matches: List[Match]):
+        """Show matches of the fastest source right away, and merge matches of slower sources into them.
+        Matches of the previous search string stay on display until the first batch of the new one arrives.
+        """
+        # a newer search may have been submitted after the batch was emitted
+        if self.search_thread.is_stale(generation) or self.mode != Mode.SEARCH:
+            return
+        if generation == self.displayed_search_generation:
+            self.result_list.add_list_items(matches=matches)
+        else:
+            self.result_list.load_list_items(matches=matches, search_str=search_str)
+            self.displayed_search_generation = generation
+        self.set_widget_in_result_container(self.result_list)
+
+    def _load_search_result(self, generation: int, search_str: str, result: RetrieverResult):
+        if self.search_thread.is_stale(generation) or self.mode != Mode.SEARCH:
+            return
+        # all matches have been displayed batch by batch, unless there were no batches, e.g. nothing matches
+        if generation != self.displayed_search_generation:
+            self.result_list.load_list_items(matches=result.content, search_str=search_str)
+            self.displayed_search_generation = generation
         self.set_widget_in_result_container(self.result_list)
-        return result
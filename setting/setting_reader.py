@@ -1,4 +1,5 @@
 import json
+import os
 from pathlib import Path
 from typing import Any
 
@@ -8,7 +9,9 @@ from PySide6.QtGui import QFont
 class Setting:
     def __init__(self):
         self.root_path = Path(__file__).parent.parent
-        self.user_setting_path = self.root_path / "user_data/user_setting.json"
+        # user data can be moved elsewhere, e.g. into a temporary directory when testing
+        self.user_data_path = Path(os.environ.get("PROPAL_USER_DATA_PATH", self.root_path / "user_data"))
+        self.user_setting_path = self.user_data_path / "user_setting.json"
         self.default_path = self.root_path / "setting/default.json"
         self.initialize()
         with open(self.default_path, "r", encoding="utf-8") as f:
@@ -0,0 +1,29 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from backend.tools.database import db, read_only_db, db_manager, open_database
+
+
+def wait_until(condition, timeout: float = 10) -> bool:
+    """wait for a condition that is met by a background thread"""
+    deadline = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """a test case whose database is a new file in a temporary directory"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = Path(self.directory.name)
+        open_database(self.path / "data.db")
+        db_manager._create_tables()
+
+    def tearDown(self):
+        db.close()
+        read_only_db.close()
+        self.directory.cleanup()
@@ -0,0 +1,12 @@
+"""
+Tests never touch the real user_data/ directory. Settings, databases, caches and debug.log are put into a temporary
+directory, which is set before any module of ProPal is imported.
+"""
+import os
+import tempfile
+
+user_data_directory = tempfile.TemporaryDirectory(prefix="propal_test_")
+os.environ["PROPAL_USER_DATA_PATH"] = user_data_directory.name
+# tests run without a display
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+os.environ.setdefault("PYNPUT_BACKEND", "dummy")
@@ -0,0 +1,51 @@
+import dataclasses
+import unittest
+
+from PySide6.QtCore import QModelIndex
+from PySide6.QtWidgets import QApplication
+
+from backend.models import Match
+from backend.tools.database import Prompt
+from frontend.components.command_result_list import CommandResultModel
+
+app = QApplication.instance() or QApplication([])
+
+
+def create_match(content: str, source: str = "memory") -> Match:
+    prompt = Prompt(content=content)
+    return Match(source=source, category="prompt", data=prompt, match_fields_values={"content": content})
+
+
+class CommandResultModelTest(unittest.TestCase):
+    def setUp(self):
+        self.model = CommandResultModel()
+        self.model.BATCH_SIZE = 2
+
+    def contents(self):
+        return [match.data.content for match in self.model.matches]
+
+    def test_matches_found_by_more_than_one_source_are_added_once(self):
+        match = create_match("translate")
+        self.model.set_matches([match], search_str="trans")
+        self.model.add_matches([create_match("translate to English"), dataclasses.replace(match, source="semantic")])
+        self.assertEqual(self.contents(), ["translate", "translate to English"])
+        self.model.set_matches([match], search_str="transl")
+        self.assertEqual(self.contents(), ["translate"])
+
+    def test_only_the_best_candidates_by_quick_score_are_scored_and_loaded(self):
+        matches = [create_match(content) for content in ["t-r-a-n-s", "text to translate", "trans"]]
+        self.model.set_matches(matches, search_str="trans")
+        # the match that only contains "trans" as a subsequence is not scored until it is fetched
+        self.assertEqual(self.contents(), ["trans", "text to translate"])
+        self.assertEqual([match.data.content for _, _, match in self.model._candidates], ["t-r-a-n-s"])
+
+    def test_more_matches_are_fetched_a_batch_at_a_time(self):
+        matches = [create_match("trans" + "x" * length) for length in range(5)]
+        self.model.set_matches(list(reversed(matches)), search_str="trans")
+        self.assertEqual(self.model.rowCount(), 3)  # including "Talk to AI"
+        for row_count in [5, 6]:
+            self.assertTrue(self.model.canFetchMore(QModelIndex()))
+            self.model.fetchMore(QModelIndex())
+            self.assertEqual(self.model.rowCount(), row_count)
+        self.assertFalse(self.model.canFetchMore(QModelIndex()))
+        self.assertEqual(self.model.matches, matches)
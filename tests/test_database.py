@@ -0,0 +1,73 @@
+from backend.tools.database import db_manager, Prompt, Tag, _Meta, SCHEMA_VERSION, MigrationProgress
+from tests.base import DatabaseTestCase
+
+
+class DBManagerMigrationTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.listeners = list(db_manager._migration_listeners)
+
+    def tearDown(self):
+        db_manager._migration_listeners[:] = self.listeners
+        db_manager.is_migration_pending = False
+        super().tearDown()
+
+    def test_migrations_wait_for_migrate(self):
+        Prompt.insert(content="old prompt", tags=["a", "b"]).execute()
+        _Meta.update(version=SCHEMA_VERSION - 1).execute()
+        db_manager._create_tables()
+        self.assertTrue(db_manager.is_migration_pending)
+        self.assertFalse(db_manager.fts_enabled)
+        self.assertEqual(_Meta.get().version, SCHEMA_VERSION - 1)
+
+        migrated = []
+        progress = []
+        db_manager.add_migration_listener(lambda: migrated.append(True))
+        db_manager.migrate(progress_callback=progress.append)
+        self.assertFalse(db_manager.is_migration_pending)
+        self.assertEqual(_Meta.get().version, SCHEMA_VERSION)
+        self.assertEqual(migrated, [True])
+        self.assertIn(MigrationProgress(SCHEMA_VERSION, db_manager.MIGRATIONS[-1].description, 1, 1), progress)
+        self.assertEqual(Prompt.get().tag_names, ["a", "b"])
+
+    def test_new_database_needs_no_migration(self):
+        self.assertFalse(db_manager.is_migration_pending)
+        self.assertEqual(_Meta.get().version, SCHEMA_VERSION)
+
+
+class PromptSearchTest(DatabaseTestCase):
+    def test_fts_and_like_search_find_the_same_prompts(self):
+        Prompt(content="Explain ${code} in Python", tags=["coding"]).save(force_insert=True)
+        Prompt(content="translate to English", tags=["translation", "python"]).save(force_insert=True)
+        Prompt(content="code review").save(force_insert=True)
+        self.assertTrue(db_manager.fts_enabled)
+        for search_str in ["python", "cod", "ion;py", "review", "${code}"]:
+            fts_matches = Prompt.search_by_string(search_str, use_fts=True)
+            like_matches = Prompt.search_by_string(search_str, use_fts=False)
+            self.assertEqual(
+                sorted((m.data.content, m.match_fields) for m in fts_matches),
+                sorted((m.data.content, m.match_fields) for m in like_matches),
+                search_str,
+            )
+
+    def test_highlight_positions_of_matched_content(self):
+        Prompt(content="Py-thon and Python").save(force_insert=True)
+        [match] = Prompt.search_by_string("python")
+        self.assertEqual(match.match_positions, {"content": [(12, 18)]})
+
+
+class TagTest(DatabaseTestCase):
+    def test_select_prompts_by_exact_tag(self):
+        Prompt(content="a", tags=["python", "coding"]).save(force_insert=True)
+        Prompt(content="b", tags=["python3"]).save(force_insert=True)
+        Prompt(content="c").save(force_insert=True)
+        self.assertEqual([prompt.content for prompt in Prompt.select_by_tag("python")], ["a"])
+        self.assertEqual(list(Prompt.select_by_tag("pyth")), [])
+
+    def test_list_names_of_tags_in_use(self):
+        prompt = Prompt(content="a", tags=["writing", "email"])
+        prompt.save(force_insert=True)
+        Prompt(content="b", tags=["email", "daily"]).save(force_insert=True)
+        self.assertEqual(Tag.list_names(), ["daily", "email", "writing"])
+        prompt.delete_instance()
+        self.assertEqual(Tag.list_names(), ["daily", "email"])
@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+
+from backend.agents import llm_agent
+from backend.agents.llm_agent import ContextBuilder, MessageTokenCache, Model
+
+
+class WordEncoding:
+    """counts a token per word, so that tests need not download encodings of tiktoken"""
+
+    @staticmethod
+    def encode(text):
+        return text.split()
+
+
+def create_message(role: str, words: int) -> dict:
+    return {"role": role, "content": " ".join([role] * words)}
+
+
+class ContextBuilderTest(unittest.TestCase):
+    def setUp(self):
+        patchers = [
+            mock.patch("tiktoken.encoding_for_model", return_value=WordEncoding()),
+            mock.patch.object(llm_agent, "message_token_cache", MessageTokenCache()),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # every message has 3 extra tokens and a token of its role, so a message of 6 words has 10 tokens
+        self.system_message = create_message("system", 1)
+        self.history = [self.system_message] + [create_message(role, 6) for role in ["user", "assistant"] * 2]
+        self.message = create_message("user", 6)
+
+    def test_oldest_turns_are_left_out_to_fit_the_budget(self):
+        # 5 tokens of the system message, 10 of every other message and 3 that prime the reply
+        context = ContextBuilder(Model.GPT_3_5_TURBO, max_input_tokens=40).build(self.history, self.message)
+        self.assertEqual(context.messages, [self.system_message] + self.history[3:] + [self.message])
+        self.assertEqual(context.dropped_messages, self.history[1:3])
+        self.assertEqual(context.saved_tokens, 20)
+        self.assertEqual(context.input_tokens, 38)
+
+    def test_system_message_and_new_message_are_always_kept(self):
+        context = ContextBuilder(Model.GPT_3_5_TURBO, max_input_tokens=10).build(self.history, self.message)
+        self.assertEqual(context.messages, [self.system_message, self.message])
+        self.assertEqual(context.input_tokens, 18)
+
+    def test_history_within_the_budget_is_kept(self):
+        context = ContextBuilder(Model.GPT_3_5_TURBO, max_input_tokens=100).build(self.history, self.message)
+        self.assertEqual(context.messages, self.history + [self.message])
+        self.assertEqual(context.saved_tokens, 0)
@@ -0,0 +1,26 @@
+from backend.tools.database import Prompt, open_database, db_manager
+from backend.tools.prompt_index import PromptIndex
+from tests.base import DatabaseTestCase
+
+
+class PromptIndexTest(DatabaseTestCase):
+    def test_tags_that_are_a_string(self):
+        Prompt(content="built", tags="physics;math").save(force_insert=True)
+        index = PromptIndex()
+        index.build()
+        index.upsert(Prompt(id="upserted", content="upserted", tags="chemistry"))
+        self.assertEqual(sorted(index.tags), [("chemistry",), ("physics", "math")])
+        self.assertEqual([match.data.content for match in index.search_by_string("chem")], ["upserted"])
+        self.assertEqual(index.search_by_string("y;m"), [])
+
+    def test_built_from_the_open_database_when_searched(self):
+        index = PromptIndex()
+        Prompt(content="saved before the first search").save(force_insert=True)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(len(index.search_by_string("first search")), 1)
+        Prompt(content="saved after the first search").save(force_insert=True)
+        self.assertEqual(len(index.search_by_string("first search")), 2)
+
+        open_database(self.path / "another.db")
+        db_manager._create_tables()
+        self.assertEqual(index.search_by_string("first search"), [])
@@ -0,0 +1,67 @@
+import json
+from pathlib import Path
+
+from backend.tools.database import Prompt
+from backend.tools.prompt_library import import_prompts, export_prompts
+from tests.base import DatabaseTestCase
+
+
+class PromptLibraryTest(DatabaseTestCase):
+    def write_jsonl(self, rows) -> Path:
+        path = self.path / "library.jsonl"
+        path.write_text("\n".join(json.dumps(row, ensure_ascii=False) for row in rows), encoding="utf-8")
+        return path
+
+    def test_import_prompts_without_tags(self):
+        path = self.write_jsonl([{"role": "user", "content": "no tags"}, {"content": "empty tags", "tags": []}])
+        summary = import_prompts(path)
+        self.assertEqual(summary.imported, 2)
+        self.assertEqual(sorted(p.tag_names == [] for p in Prompt.select()), [True, True])
+
+    def test_import_prompt_whose_tags_are_a_string(self):
+        import_prompts(self.write_jsonl([{"content": "one tag", "tags": "physics"}]))
+        self.assertEqual(Prompt.get().tag_names, ["physics"])
+
+    def test_bulk_insert_prompt_whose_tags_are_none(self):
+        self.assertEqual(Prompt.bulk_insert([Prompt(content="tags are none", tags=None)]), 1)
+        self.assertIsNone(Prompt.get(Prompt.content == "tags are none").tags)
+
+    def test_import_skips_duplicated_and_invalid_prompts(self):
+        path = self.write_jsonl([{"content": "a"}, {"content": "a"}, {"content": ""}, {"role": "user"}])
+        summary = import_prompts(path)
+        self.assertEqual((summary.imported, summary.duplicated, summary.invalid), (1, 1, 2))
+
+    def test_import_updates_role_and_tags_of_existing_prompts(self):
+        import_prompts(self.write_jsonl([
+            {"content": "retag me", "tags": ["old"]}, {"content": "keep me", "tags": ["kept"]}, {"content": "no tags"},
+        ]))
+        summary = import_prompts(self.write_jsonl([
+            {"content": "retag me", "role": "system", "tags": ["new"]},
+            {"content": "keep me"},  # missing tags are kept
+            {"content": "no tags", "tags": []},  # the same as no tags
+        ]))
+        self.assertEqual((summary.imported, summary.updated, summary.duplicated), (0, 1, 2))
+        retagged = Prompt.get(Prompt.content == "retag me")
+        self.assertEqual((retagged.role, retagged.tag_names), ("system", ["new"]))
+        self.assertEqual(Prompt.get(Prompt.content == "keep me").tag_names, ["kept"])
+
+    def test_bulk_update_prompts_whose_tags_are_none(self):
+        Prompt.bulk_insert([Prompt(content="a", tags=None), Prompt(content="b", tags=["x"])])
+        prompts = list(Prompt.select())
+        for prompt in prompts:
+            prompt.tags = None if prompt.tags else ["y"]
+        self.assertEqual(Prompt.bulk_update(prompts, fields=["tags"]), 2)
+        self.assertEqual(Prompt.bulk_update(prompts, fields=["tags"]), 0)
+        self.assertEqual({p.content: p.tag_names for p in Prompt.select()}, {"a": ["y"], "b": []})
+
+    def test_export_then_import_round_trip(self):
+        import_prompts(self.write_jsonl([{"content": "with tags", "tags": ["a", "b"]}, {"content": "without"}]))
+        for file_format in ["jsonl", "csv"]:
+            exported_path = self.path / f"exported.{file_format}"
+            self.assertEqual(export_prompts(exported_path), 2)
+            summary = import_prompts(exported_path)
+            self.assertEqual((summary.imported, summary.duplicated), (0, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import threading
+
+from backend.agents.retriever_agent import RetrieverAgent, RetrieverSource, RefinementCache, QueryCache
+from backend.models import Match
+from backend.tools.database import Prompt, ChatMessage, Conversation
+from tests.base import DatabaseTestCase
+
+
+class RetrieverAgentTest(DatabaseTestCase):
+    def test_closed_agents_stop_listening_to_writes(self):
+        prompt_listeners = list(Prompt._write_listeners)
+        chat_message_listeners = list(ChatMessage._write_listeners)
+        for _ in range(3):
+            agent = RetrieverAgent()
+            agent.close()
+        self.assertEqual(Prompt._write_listeners, prompt_listeners)
+        self.assertEqual(ChatMessage._write_listeners, chat_message_listeners)
+        self.assertTrue(agent.executor._shutdown)
+
+    def test_matches_come_from_the_searched_source(self):
+        conversation = Conversation.create()
+        ChatMessage.create(conversation=conversation, role="user", content="explain quantum physics")
+        agent = RetrieverAgent()
+        self.addCleanup(agent.close)
+        matches = agent.search("quantum", sources=["chat"])
+        self.assertEqual([(match.source, match.category) for match in matches], [("chat", "chat_message")])
+
+    def test_sources_that_miss_their_deadline_are_dropped(self):
+        released = threading.Event()
+        self.addCleanup(released.set)
+        fast_matches = [Match(source="fast")]
+        RetrieverAgent.register_source(RetrieverSource("fast", lambda search_str: fast_matches), is_default=False)
+        RetrieverAgent.register_source(
+            RetrieverSource("slow", lambda search_str: released.wait() and [Match(source="slow")], deadline=0.05),
+            is_default=False,
+        )
+        for source in ["fast", "slow"]:
+            self.addCleanup(RetrieverAgent.SOURCES.pop, source)
+        agent = RetrieverAgent()
+        self.addCleanup(agent.close)
+        self.assertEqual(agent.search("query", sources=["slow", "fast"]), fast_matches)
+        # results without the dropped source are incomplete, so they are not cached
+        self.assertEqual(agent.query_cache.stats()["entries"], 0)
+
+
+class RefinementCacheTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.searched = []  # search strings that the source is searched for rather than refined
+
+        def search(search_str):
+            self.searched.append(search_str)
+            return Prompt.search_by_string(search_str)
+
+        RetrieverAgent.register_source(RetrieverSource("test", search, refine=Prompt.refine_matches), is_default=False)
+        self.addCleanup(RetrieverAgent.SOURCES.pop, "test")
+        self.agent = RetrieverAgent()
+        self.addCleanup(self.agent.close)
+        for content in ["explain", "explain it", "expect", "translate"]:
+            Prompt(content=content).save(force_insert=True)
+
+    def test_matches_of_a_longer_search_string_are_refined_from_a_prefix(self):
+        self.agent.search_source("exp", "test")
+        matches = self.agent.search_source("expla", "test")
+        self.assertEqual(self.searched, ["exp"])
+        self.assertEqual(sorted(match.data.content for match in matches), ["explain", "explain it"])
+        self.assertEqual(self.agent.refinement_cache.get_longest_prefix("test", "explai")[0], "expla")
+        # deleting characters returns cached matches
+        self.assertEqual(len(self.agent.search_source("exp", "test")), 3)
+        self.assertEqual(self.searched, ["exp"])
+
+    def test_writes_invalidate_matches(self):
+        self.agent.search_source("exp", "test")
+        Prompt(content="expand").save(force_insert=True)
+        self.assertIsNone(self.agent.refinement_cache.get("test", "exp"))
+        self.assertEqual(len(self.agent.search_source("exp", "test")), 4)
+
+        generation = self.agent.refinement_cache.generation
+        ChatMessage.create(conversation=Conversation.create(), role="user", content="hello")
+        self.assertEqual(self.agent.refinement_cache.generation, generation + 1)
+        self.assertIsNone(self.agent.refinement_cache.get("test", "exp"))
+
+    def test_matches_searched_before_a_write_are_not_cached(self):
+        cache = RefinementCache()
+        generation = cache.generation
+        cache.clear()
+        cache.put("test", "exp", [], generation=generation)
+        self.assertIsNone(cache.get("test", "exp"))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = RefinementCache(max_size=2)
+        cache.put("test", "a", [], generation=0)
+        cache.put("test", "b", [], generation=0)
+        cache.get("test", "a")
+        cache.put("test", "c", [], generation=0)
+        self.assertEqual(cache.get("test", "a"), [])
+        self.assertIsNone(cache.get("test", "b"))
+
+
+class QueryCacheTest(DatabaseTestCase):
+    @staticmethod
+    def create_matches(*contents):
+        return [Match(match_fields_values={"content": content}) for content in contents]
+
+    def test_hits_and_misses_ignore_cases(self):
+        cache = QueryCache()
+        matches = self.create_matches("Translate")
+        self.assertIsNone(cache.get("Trans", ["memory"]))
+        cache.put("Trans", ["memory"], matches, generation=0, depends_on_writes=True)
+        self.assertEqual(cache.get("trans", ["memory"]), matches)
+        self.assertIsNone(cache.get("trans", ["command"]))
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = QueryCache(max_entries=2)
+        for search_str in ["a", "b"]:
+            cache.put(search_str, ["memory"], self.create_matches(search_str), generation=0, depends_on_writes=False)
+        cache.get("a", ["memory"])
+        cache.put("c", ["memory"], self.create_matches("c"), generation=0, depends_on_writes=False)
+        self.assertIsNotNone(cache.get("a", ["memory"]))
+        self.assertIsNone(cache.get("b", ["memory"]))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_entries_are_evicted_to_fit_in_max_bytes(self):
+        entry_size = QueryCache.estimate_size(self.create_matches("a" * 100))
+        cache = QueryCache(max_bytes=entry_size * 2)
+        for search_str in ["a", "b", "c"]:
+            cache.put(search_str, ["memory"], self.create_matches("a" * 100), generation=0, depends_on_writes=False)
+        self.assertEqual(cache.stats()["entries"], 2)
+        self.assertEqual(cache.stats()["bytes"], entry_size * 2)
+        self.assertIsNone(cache.get("a", ["memory"]))
+        # an entry larger than the cache is not cached
+        cache.put("d", ["memory"], self.create_matches("a" * 1000), generation=0, depends_on_writes=False)
+        self.assertIsNone(cache.get("d", ["memory"]))
+
+    def test_writes_invalidate_entries_that_depend_on_them(self):
+        agent = RetrieverAgent()
+        self.addCleanup(agent.close)
+        cache = agent.query_cache
+        cache.put("prompt", ["memory"], self.create_matches("prompt"), generation=0, depends_on_writes=True)
+        cache.put("command", ["command"], self.create_matches("command"), generation=0, depends_on_writes=False)
+        Prompt(content="prompt").save(force_insert=True)
+        self.assertIsNone(cache.get("prompt", ["memory"]))
+        self.assertIsNotNone(cache.get("command", ["command"]))
+
+        cache.put("chat", ["chat"], self.create_matches("chat"), generation=cache.generation, depends_on_writes=True)
+        ChatMessage.create(conversation=Conversation.create(), role="user", content="chat")
+        self.assertIsNone(cache.get("chat", ["chat"]))
+        # results searched before a write are not cached after it
+        cache.put("chat", ["chat"], self.create_matches("chat"), generation=0, depends_on_writes=True)
+        self.assertIsNone(cache.get("chat", ["chat"]))
@@ -0,0 +1,19 @@
+from backend.tools.database import Prompt
+from backend.tools.semantic_index import SemanticIndex
+from tests.base import DatabaseTestCase, wait_until
+
+
+class SemanticIndexTest(DatabaseTestCase):
+    def test_small_library_is_saved(self):
+        for content in ["translate this article into english", "review my python code", "write an email"]:
+            Prompt(content=content).save(force_insert=True)
+        index = SemanticIndex()
+        index.open()
+        self.assertTrue(wait_until(lambda: len(index.base.ids) == 3 and not index._is_rebuilding))
+        self.assertEqual(index.delta, {})
+
+        reloaded = SemanticIndex()
+        reloaded.open(synchronize=False)
+        self.assertEqual(len(reloaded.base.ids), 3)
+        matches = reloaded.search_by_string("python coding")
+        self.assertEqual([match.data.content for match in matches], ["review my python code"])
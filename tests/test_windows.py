@@ -0,0 +1,89 @@
+import threading
+import unittest
+
+from PySide6.QtWidgets import QApplication
+
+from backend.agents.llm_agent import LLMResult
+from backend.agents.retriever_agent import RetrieverResult
+from backend.models import Match, Error
+from frontend.windows.base import SearchThread, LLMRequestScheduler
+from tests.base import wait_until
+
+app = QApplication.instance() or QApplication([])
+
+
+class BlockingRetrieverAgent:
+    """yields a batch and a result for every search string. Searching "block" waits until it is released."""
+
+    def __init__(self):
+        self.blocked = threading.Event()
+        self.released = threading.Event()
+
+    def act(self, trigger_attrs):
+        search_str = trigger_attrs["content"]
+        if search_str == "block":
+            self.blocked.set()
+            self.released.wait()
+        matches = [Match(match_fields_values={"content": search_str})]
+        yield matches
+        yield RetrieverResult(content=matches)
+
+
+class BlockingLLMAgent:
+    """streams "partial", and then " reply" unless it is stopped. Replies wait until they are released."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def act(self, trigger_attrs):
+        self.started.set()
+        self.released.wait()
+        reply = "partial"
+        if (yield reply) != "STOP":
+            reply += " reply"
+        yield LLMResult(trigger=None, content=reply)
+
+
+class SearchThreadTest(unittest.TestCase):
+    def test_results_of_superseded_searches_are_dropped(self):
+        agent = BlockingRetrieverAgent()
+        thread = SearchThread(retriever_agent=agent)
+        self.addCleanup(thread.stop)
+        batches, results = [], []
+        thread.batch_received.connect(lambda generation, search_str, matches: batches.append((generation, search_str)))
+        thread.result_received.connect(lambda generation, search_str, result: results.append((generation, search_str)))
+
+        thread.submit("block")
+        self.assertTrue(agent.blocked.wait(timeout=10))
+        generation = thread.submit("newer")
+        agent.released.set()
+        # signals of the thread are delivered by the event loop
+        self.assertTrue(wait_until(lambda: app.processEvents() or results))
+        self.assertEqual(batches, [(generation, "newer")])
+        self.assertEqual(results, [(generation, "newer")])
+
+
+class LLMRequestSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = BlockingLLMAgent()
+        self.scheduler = LLMRequestScheduler(llm_agent=self.agent, max_workers=1)
+        self.addCleanup(self.scheduler.stop)
+        self.results = {}
+        self.scheduler.result_received.connect(lambda request_id, result: self.results.update({request_id: result}))
+
+    def test_cancelled_requests_get_a_cancelled_result(self):
+        running_id = self.scheduler.submit({"content": "running"})
+        self.assertTrue(self.agent.started.wait(timeout=10))
+        queued_id = self.scheduler.submit({"content": "queued"})
+        self.scheduler.cancel(queued_id)
+        self.assertFalse(self.scheduler.is_pending(queued_id))
+        self.assertFalse(self.results[queued_id].success)
+        self.assertEqual(self.results[queued_id].error, Error.CANCELLED)
+
+        # a running request is stopped with the reply received so far
+        self.scheduler.cancel(running_id)
+        self.agent.released.set()
+        self.assertTrue(wait_until(lambda: app.processEvents() or running_id in self.results))
+        self.assertTrue(self.results[running_id].success)
+        self.assertEqual(self.results[running_id].content, "partial")